@@ -0,0 +1,228 @@
+import cv2
+import hashlib
+import numpy as np
+
+"""
+Approximate nearest neighbour search for the VGG fvectors.
+
+IVF-PQ index: a coarse k-means quantizer splits the database in nlist inverted
+lists, the residual of every vector (vector - coarse centroid) is compressed with a
+product quantizer (m sub-vectors, 256 centroids each, one byte per sub-vector).
+A query only visits the nprobe closest lists and computes distances with lookup
+tables (asymmetric distance computation). nprobe is the recall/speed knob, the
+optional rerank step recomputes the exact euclidean distance of the best candidates.
+
+An index stores the fingerprint of the fvectors it was built for, an index whose
+fingerprint does not match the database is stale (its ids are other rows).
+"""
+
+KMEANS_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 25, 1e-4)
+
+def kmeans(data, k, attempts=1):
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    k = max(1, min(k, len(data)))
+    _, labels, centers = cv2.kmeans(data, k, None, KMEANS_CRITERIA, attempts, cv2.KMEANS_PP_CENTERS)
+    return centers, labels.ravel()
+
+def fingerprint(fvectors):
+    # SHA-1 of the shape and the float32 values of the database fvectors.
+    fvectors = np.ascontiguousarray(fvectors, dtype=np.float32)
+    digest = hashlib.sha1(np.array(fvectors.shape, dtype=np.int64).tobytes())
+    digest.update(fvectors.data)
+    return digest.hexdigest()
+
+class IVFPQIndex():
+    def __init__(self, coarse_centroids, codebooks, codes, list_offsets, list_ids, nprobe=8, fingerprint=None):
+        self.coarse_centroids = coarse_centroids    # (nlist, dim)
+        self.codebooks = codebooks                  # (m, 256, dim / m)
+        self.codes = codes                          # (n, m) uint8, ordered by inverted list
+        self.list_offsets = list_offsets            # (nlist + 1,) list l holds codes[offsets[l]:offsets[l+1]]
+        self.list_ids = list_ids                    # (n,) database row of every code
+        self.nprobe = nprobe
+        self.fingerprint = fingerprint              # fingerprint of the indexed fvectors
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    @property
+    def nlist(self):
+        return len(self.coarse_centroids)
+
+    @property
+    def m(self):
+        return self.codebooks.shape[0]
+
+    @staticmethod
+    def build(fvectors, nlist=None, m=64, nprobe=8):
+        """
+        Train the coarse quantizer and the product quantizer on the database fvectors
+        and encode them.
+
+        - nlist: amount of inverted lists, defaults to ~sqrt(n).
+        - m: amount of sub-quantizers, has to divide the fvector dimension.
+        """
+
+        fvectors = np.ascontiguousarray(fvectors, dtype=np.float32)
+        n, dim = fvectors.shape
+        if dim % m != 0:
+            raise ValueError('Dimension {} is not divisible by m={}'.format(dim, m))
+
+        if nlist is None:
+            nlist = max(1, int(np.sqrt(n)))
+
+        coarse_centroids, assignment = kmeans(fvectors, nlist)
+        residuals = fvectors - coarse_centroids[assignment]
+
+        sub_dim = dim // m
+        codebooks = np.zeros((m, 256, sub_dim), dtype=np.float32)
+        codes = np.zeros((n, m), dtype=np.uint8)
+        for j in range(m):
+            sub = residuals[:, j * sub_dim:(j + 1) * sub_dim]
+            centers, labels = kmeans(sub, 256)
+            codebooks[j, :len(centers)] = centers
+            codes[:, j] = labels
+
+        # Group the codes per inverted list so every list is one contiguous block.
+        order = np.argsort(assignment, kind='stable')
+        list_offsets = np.zeros(len(coarse_centroids) + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignment, minlength=len(coarse_centroids)))
+
+        return IVFPQIndex(coarse_centroids, codebooks, codes[order], list_offsets, order.astype(np.int64), nprobe, fingerprint(fvectors))
+
+    def encode(self, fvectors):
+        """
+        Returns the inverted list and the PQ code of every vector.
+        """
+
+        fvectors = np.atleast_2d(np.asarray(fvectors, dtype=np.float32))
+        sub_dim = self.codebooks.shape[2]
+
+        coarse = (self.coarse_centroids ** 2).sum(axis=1)[None, :] - 2 * fvectors @ self.coarse_centroids.T
+        lists = np.argmin(coarse, axis=1)
+        residuals = fvectors - self.coarse_centroids[lists]
+
+        codes = np.zeros((len(fvectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub = residuals[:, j * sub_dim:(j + 1) * sub_dim]
+            codes[:, j] = np.argmin((self.codebooks[j] ** 2).sum(axis=1)[None, :] - 2 * sub @ self.codebooks[j].T, axis=1)
+        return lists, codes
+
+    def update(self, mapping, fvectors=None, ids=None, database=None):
+        """
+        Follow a change of the database rows without retraining the quantizers.
+
+        - mapping: (n_old,) new row of every old row, -1 for removed rows.
+        - fvectors, ids: vectors added to the database and their (new) rows.
+        - database: all fvectors of the updated database (for the fingerprint).
+        """
+
+        mapping = np.asarray(mapping, dtype=np.int64)
+        lists = np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+        ids = np.zeros(0, np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+
+        keep = mapping[self.list_ids] >= 0
+        lists = lists[keep]
+        codes = self.codes[keep]
+        list_ids = mapping[self.list_ids[keep]]
+
+        if len(ids) > 0:
+            new_lists, new_codes = self.encode(fvectors)
+            lists = np.concatenate((lists, new_lists))
+            codes = np.concatenate((codes, new_codes))
+            list_ids = np.concatenate((list_ids, ids))
+
+        order = np.argsort(lists, kind='stable')
+        self.codes = codes[order]
+        self.list_ids = list_ids[order]
+        self.list_offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        self.list_offsets[1:] = np.cumsum(np.bincount(lists, minlength=self.nlist))
+        self.fingerprint = None if database is None else fingerprint(database)
+
+    def search(self, queries, k=10, nprobe=None, fvectors=None, rerank=0, rows=None):
+        """
+        Returns one list of (index, distance) tuples per query, sorted on (approximate)
+        euclidean distance.
+
+        - nprobe: amount of inverted lists visited per query (more = better recall, slower).
+        - fvectors, rerank: recompute the exact distance for the best `rerank` candidates.
+        - rows: only these database rows are candidates. More than nprobe lists are
+                visited when the probed lists hold fewer than k of them.
+        """
+
+        nprobe = self.nprobe if nprobe is None else nprobe
+        nprobe = max(1, min(nprobe, self.nlist))
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        sub_dim = self.codebooks.shape[2]
+
+        allowed = None
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            allowed = np.zeros(max(len(self), int(self.list_ids.max(initial=-1)) + 1), dtype=bool)
+            allowed[rows[(rows >= 0) & (rows < len(allowed))]] = True
+            wanted = min(k, int(allowed[self.list_ids].sum()))
+
+        coarse = ((queries[:, None, :] - self.coarse_centroids[None, :, :]) ** 2).sum(axis=2)
+        probes = np.argsort(coarse, axis=1)
+
+        results = []
+        for q, query in enumerate(queries):
+            candidate_ids = []
+            candidate_dist = []
+            found = 0
+            for probed, l in enumerate(probes[q]):
+                if probed >= nprobe and (allowed is None or found >= wanted):
+                    break
+
+                start, end = self.list_offsets[l], self.list_offsets[l + 1]
+                ids = self.list_ids[start:end]
+                codes = self.codes[start:end]
+                if allowed is not None:
+                    codes, ids = codes[allowed[ids]], ids[allowed[ids]]
+                if len(ids) == 0:
+                    continue
+
+                # Lookup table with the squared distance of every residual sub-vector to every code.
+                residual = (query - self.coarse_centroids[l]).reshape((self.m, 1, sub_dim))
+                table = ((residual - self.codebooks) ** 2).sum(axis=2)
+
+                candidate_dist.append(table[np.arange(self.m)[None, :], codes].sum(axis=1))
+                candidate_ids.append(ids)
+                found += len(ids)
+
+            if len(candidate_ids) == 0:
+                results.append([])
+                continue
+
+            ids = np.concatenate(candidate_ids)
+            dist = np.concatenate(candidate_dist)
+
+            if fvectors is not None and rerank > 0:
+                keep = min(len(ids), max(k, rerank))
+                # Sorted ids keep the reads of a memory-mapped fvector matrix sequential.
+                ids = np.sort(ids[np.argpartition(dist, keep - 1)[:keep]])
+                dist = ((np.asarray(fvectors[ids], dtype=np.float32) - query) ** 2).sum(axis=1)
+
+            keep = min(len(ids), k)
+            best = np.argpartition(dist, keep - 1)[:keep]
+            best = best[np.argsort(dist[best], kind='stable')]
+            results.append(list(zip(ids[best].tolist(), np.sqrt(np.maximum(dist[best], 0)).tolist())))
+
+        return results
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f,
+                coarse_centroids=self.coarse_centroids,
+                codebooks=self.codebooks,
+                codes=self.codes,
+                list_offsets=self.list_offsets,
+                list_ids=self.list_ids,
+                nprobe=np.array(self.nprobe),
+                fingerprint=np.array('' if self.fingerprint is None else self.fingerprint))
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        # Indexes saved without a fingerprint never match a database.
+        fingerprint = str(data['fingerprint']) if 'fingerprint' in data.files else ''
+        return IVFPQIndex(data['coarse_centroids'], data['codebooks'], data['codes'], data['list_offsets'], data['list_ids'], int(data['nprobe']), fingerprint or None)
@@ -1,20 +1,32 @@
-from turtle import distance
 import pandas as pd
 import numpy as np
 import os
 import cv2
 import argparse
-import matplotlib.pyplot as plt
 import time
+import sys
+import subprocess
+import resource
+import importlib.util
 
 from shapely.geometry import Polygon
 import json
 
-from detector import PaintingDetector
+from detector import PaintingDetector, DETECTOR_WIDTH
 from matcher import PaintingMatcher
 from matcher import Distance
 from matcher import Mode
-from util import printProgressBar, rectify_contour
+from matcher import CustomResNet
+from util import printProgressBar, rectify_contour, resize_with_aspectratio
+from database import PaintingDatabase
+from distances import FvectorEngine, top_k
+from ann import IVFPQIndex
+from compression import FvectorCompressor, CompressedEngine
+from orb_index import cross_check_scores, rank_scores
+from hmm import HMM
+from preprocessing import FrameProcessor, FrameContext, blur_detect
+from sharpness import HaarGate, LaplacianGate, TenengradGate
+from blur_reference import blur_detect_windows
 
 """
 Usage:
@@ -27,11 +39,12 @@ Usage:
 """
 
 parser = argparse.ArgumentParser(description="My Script")
-parser.add_argument('--csv', help='Path to master CSV', required=True, type=str)
-parser.add_argument('--basefolder', help='Path to the base folder that contains the images', required=True, type=str)
+parser.add_argument('--csv', help='Path to master CSV', required=False, default=None, type=str)
+parser.add_argument('--basefolder', help='Path to the base folder that contains the images', required=False, default=None, type=str)
 parser.add_argument('--out', help='Path to store the output csv', required=True, type=str)
 parser.add_argument('--display', help='Display intermediate images', required=False, default='y', type=str)
-parser.add_argument('--what', help='Which benchmark to run: all|detector|matcher', required=True, type=str)
+parser.add_argument('--what', help='Which benchmark to run: all|detector|matcherkeypoints|matcherfvector|ann|backbone|compression|orbkernel|startup|hmm|undistort|blur|sharpness', required=True, type=str)
+parser.add_argument('--descriptor', help='Fvector backbone used by the backbone benchmark worker', required=False, default='fc2', type=str)
 
 args = vars(parser.parse_args())
 CSV_PATH = args['csv']
@@ -39,6 +52,7 @@ IMAGES_PATH = args['basefolder']
 OUT_PATH = args['out']
 display = args['display'] == 'y'
 what = args['what']
+descriptor = args['descriptor']
 
 # Calculate the intersection over union ratio for two bouning boxes
 def calculate_iou(box_1, box_2):
@@ -52,6 +66,8 @@ def string_to_array(val):
   return list(map(lambda x: int(x.strip()), val[1: -1].split(',')))
 
 def benchmark_detector():
+    import matplotlib.pyplot as plt
+
     print('---------------------------------------------')
     print('BENCHMARKING PAINTING DETECTOR')
     print('---------------------------------------------')
@@ -573,6 +589,451 @@ def benchmark_matcher_vector():
 
     df.to_csv(OUT_PATH)  
 
+def benchmark_ann(k=10, nprobes=[1, 2, 4, 8, 16, 32, 64]):
+    print('---------------------------------------------')
+    print('BENCHMARKING APPROXIMATE FVECTOR SEARCH')
+    print('---------------------------------------------')
+
+    # --csv points to the painting database (binary directory or legacy CSV).
+    db = PaintingDatabase.open(CSV_PATH) if PaintingDatabase.is_database(CSV_PATH) else PaintingDatabase.from_csv(CSV_PATH)
+    fvectors = np.asarray(db.fvectors, dtype=np.float32)
+
+    tic = time.perf_counter()
+    index = IVFPQIndex.build(fvectors)
+    toc = time.perf_counter()
+    print('Index with {} lists built in {:.2f}s'.format(index.nlist, toc - tic))
+
+    # Every database fvector is used as a query, the query itself is left out of the results.
+    engine = FvectorEngine(fvectors)
+    tic = time.perf_counter()
+    exact = top_k(engine.distances(fvectors), k + 1)
+    exact_time = (time.perf_counter() - tic) / len(fvectors)
+    exact = [ [i for i in row if i != q][:k] for q, row in enumerate(exact.tolist()) ]
+
+    df = pd.DataFrame(columns=['nprobe', 'rerank', 'recall_at_1', 'recall_at_{}'.format(k), 'time_ms', 'exact_time_ms'])
+    for nprobe in [n for n in nprobes if n <= index.nlist]:
+        for rerank in [0, 100]:
+            tic = time.perf_counter()
+            approx = index.search(fvectors, k=k + 1, nprobe=nprobe, fvectors=fvectors, rerank=rerank)
+            approx_time = (time.perf_counter() - tic) / len(fvectors)
+            approx = [ [i for i, _ in row if i != q][:k] for q, row in enumerate(approx) ]
+
+            recall_1 = np.mean([ len(a) > 0 and a[0] == e[0] for a, e in zip(approx, exact) ])
+            recall_k = np.mean([ len(set(a) & set(e)) / len(e) for a, e in zip(approx, exact) ])
+
+            df.loc[len(df)] = [nprobe, rerank, recall_1, recall_k, approx_time * 1000, exact_time * 1000]
+            print('nprobe {:3d} rerank {:3d}: recall@1 {:.3f}, recall@{} {:.3f}, {:.3f} ms/query (exact {:.3f} ms/query)'.format(
+                nprobe, rerank, recall_1, k, recall_k, approx_time * 1000, exact_time * 1000))
+
+    df.to_csv(OUT_PATH)
+
+def benchmark_compression(k=10, dims=[64, 128, 256, 512], dtypes=['float32', 'float16', 'int8']):
+    print('---------------------------------------------')
+    print('BENCHMARKING COMPRESSED FVECTORS')
+    print('---------------------------------------------')
+
+    # --csv points to the painting database (binary directory or legacy CSV).
+    db = PaintingDatabase.open(CSV_PATH) if PaintingDatabase.is_database(CSV_PATH) else PaintingDatabase.from_csv(CSV_PATH)
+    fvectors = np.asarray(db.fvectors, dtype=np.float32)
+
+    # Reference: exact euclidean ranking on the full fvectors, every DB fvector is a query
+    # and the query itself is left out of the results.
+    engine = FvectorEngine(fvectors)
+    tic = time.perf_counter()
+    exact = top_k(engine.distances(fvectors), k + 1)
+    exact_time = (time.perf_counter() - tic) / len(fvectors)
+    exact = [ [i for i in row if i != q][:k] for q, row in enumerate(exact.tolist()) ]
+
+    df = pd.DataFrame(columns=['dim', 'dtype', 'bytes', 'compression', 'recall_at_1', 'recall_at_{}'.format(k), 'time_ms', 'speedup'])
+    for dim in dims:
+        for dtype in dtypes:
+            compressor = FvectorCompressor.train(fvectors, dim=dim, dtype=dtype)
+            compressed = CompressedEngine(compressor, compressor.encode(fvectors))
+
+            tic = time.perf_counter()
+            approx = top_k(compressed.distances(fvectors), k + 1)
+            approx_time = (time.perf_counter() - tic) / len(fvectors)
+            approx = [ [i for i in row if i != q][:k] for q, row in enumerate(approx.tolist()) ]
+
+            recall_1 = np.mean([ a[0] == e[0] for a, e in zip(approx, exact) ])
+            recall_k = np.mean([ len(set(a) & set(e)) / len(e) for a, e in zip(approx, exact) ])
+
+            df.loc[len(df)] = [compressor.dim, dtype, compressed.nbytes, fvectors.nbytes / compressed.nbytes, recall_1, recall_k, approx_time * 1000, exact_time / approx_time]
+            print('dim {:4d} {:8s}: {:6.1f}x smaller, recall@1 {:.3f}, recall@{} {:.3f}, {:.3f} ms/query ({:.1f}x faster)'.format(
+                compressor.dim, dtype, fvectors.nbytes / compressed.nbytes, recall_1, k, recall_k, approx_time * 1000, exact_time / approx_time))
+
+    df.to_csv(OUT_PATH)
+
+def perturb(img, rng):
+    # Simulates a detected painting: slightly off crop, blur and a change in exposure.
+    h, w = img.shape[:2]
+    y, x = rng.integers(0, h // 10 + 1), rng.integers(0, w // 10 + 1)
+    crop = img[y:y + int(h * 0.9), x:x + int(w * 0.9)]
+    crop = cv2.GaussianBlur(crop, (5, 5), 1)
+    return cv2.convertScaleAbs(crop, alpha=rng.uniform(0.8, 1.2), beta=0)
+
+def benchmark_backbone_worker():
+    # Runs in its own process (see benchmark_backbone) so the peak RSS only contains one backbone.
+    tic = time.perf_counter()
+    neuralnet = CustomResNet(descriptor=descriptor)
+    load_time = time.perf_counter() - tic
+
+    filenames = sorted(os.listdir(IMAGES_PATH))
+    rng = np.random.default_rng(0)
+    db_vectors = []
+    query_vectors = []
+    inference_time = 0
+
+    for start in range(0, len(filenames), 32):
+        imgs = [ cv2.imread(os.path.join(IMAGES_PATH, f)) for f in filenames[start:start + 32] ]
+        queries = [ perturb(img, rng) for img in imgs ]
+
+        tic = time.perf_counter()
+        db_vectors.append(neuralnet.get_vectors(imgs))
+        inference_time += time.perf_counter() - tic
+        query_vectors.append(neuralnet.get_vectors(queries))
+
+    engine = FvectorEngine(np.concatenate(db_vectors))
+    matches = engine.match(np.concatenate(query_vectors), Distance.EUCLIDEAN, k=1)
+    top1 = np.mean([ m[0][0] == i for i, m in enumerate(matches) ])
+
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+    print(json.dumps({
+        'descriptor': descriptor,
+        'dim': int(neuralnet.dim),
+        'params': int(neuralnet.model.count_params()),
+        'load_time_s': load_time,
+        'time_per_image_ms': inference_time / len(filenames) * 1000,
+        'latency_p50_ms': neuralnet.inference.stats()['p50_ms'],
+        'latency_p95_ms': neuralnet.inference.stats()['p95_ms'],
+        'peak_rss_mb': rss_mb,
+        'top1': float(top1),
+    }))
+
+def benchmark_backbone(descriptors=['fc2', 'max', 'gem', 'rmac']):
+    print('---------------------------------------------')
+    print('BENCHMARKING FVECTOR BACKBONES')
+    print('---------------------------------------------')
+
+    # --basefolder points to the database images, every image is matched against the
+    # others after a random perturbation (top-1 = the original image is found).
+    results = []
+    for d in descriptors:
+        out = subprocess.run([sys.executable, __file__, '--what', 'backbone_worker', '--descriptor', d, '--basefolder', IMAGES_PATH, '--out', OUT_PATH],
+            capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        print(results[-1])
+
+    df = pd.DataFrame(results)
+    print(df)
+    if OUT_PATH is not None:
+        df.to_csv(OUT_PATH)
+
+def benchmark_orb_kernel(queries=20, features=300):
+    print('---------------------------------------------')
+    print('BENCHMARKING ORB MATCHING KERNEL')
+    print('---------------------------------------------')
+
+    # --csv points to the painting database, --basefolder to the database images. Every
+    # query is a perturbed database image, scored against the full DB by both paths.
+    db = PaintingDatabase.open(CSV_PATH) if PaintingDatabase.is_database(CSV_PATH) else PaintingDatabase.from_csv(CSV_PATH)
+    orb = cv2.ORB_create(nfeatures=features)
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    image_descriptors = [ np.asarray(db.image_descriptors(i)) for i in range(len(db)) ]
+
+    rng = np.random.default_rng(0)
+    results = []
+    for index in rng.choice(len(db), min(queries, len(db)), replace=False):
+        img = perturb(cv2.imread(os.path.join(IMAGES_PATH, db.table.id[index])), rng)
+        _, des_t = orb.detectAndCompute(resize_with_aspectratio(img, width=800), None)
+        if des_t is None:
+            continue
+
+        tic = time.perf_counter()
+        reference = []
+        for i, desc in enumerate(image_descriptors):
+            matches = sorted(bf.match(desc, des_t), key = lambda x:x.distance)
+            if len(matches) >= 20:
+                reference.append((i, sum(m.distance for m in matches[:20])))
+        reference = sorted(reference, key=lambda t: t[1])
+        bf_time = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        scores = rank_scores(cross_check_scores(des_t, db.descriptors, db.offsets))
+        kernel_time = time.perf_counter() - tic
+
+        results.append({'query': int(index), 'bf_ms': bf_time * 1000, 'kernel_ms': kernel_time * 1000,
+            'speedup': bf_time / kernel_time, 'identical': scores == reference})
+        print(results[-1])
+
+    df = pd.DataFrame(results)
+    print('Median speedup {:.1f}x, identical scores for {}/{} queries'.format(df.speedup.median(), df.identical.sum(), len(df)))
+    df.to_csv(OUT_PATH)
+
+# Measures the import and the initialisation time of an entry point in a fresh interpreter.
+STARTUP_SNIPPET = """
+import sys, time, json
+sys.argv = {argv}
+start = time.perf_counter()
+{imports}
+imported = time.perf_counter()
+{init}
+print(json.dumps({{'import_s': imported - start, 'init_s': time.perf_counter() - imported, 'tensorflow': 'tensorflow' in sys.modules}}))
+"""
+
+def benchmark_startup(repeats=3):
+    print('---------------------------------------------')
+    print('BENCHMARKING STARTUP TIME')
+    print('---------------------------------------------')
+
+    # --csv points to the painting database, the matchers are created in ORB mode.
+    entry_points = {
+        'main': (['main.py'], 'import main', 'main.PaintingMatcher({db!r}, mode=main.Mode.ORB)'),
+        'localiser': (['localiser.py'], 'import localiser\nfrom matcher import Mode', 'localiser.Localiser(localiser.PaintingMatcher({db!r}, mode=Mode.ORB))'),
+        # The benchmark script parses its arguments at import, --help stops right after the imports.
+        'benchmark': (['benchmark.py', '--help'], 'import runpy, contextlib, io\ntry:\n    with contextlib.redirect_stdout(io.StringIO()): runpy.run_path("benchmark.py")\nexcept SystemExit: pass', ''),
+    }
+
+    results = []
+    for name, (argv, imports, init) in entry_points.items():
+        runs = []
+        for _ in range(repeats):
+            code = STARTUP_SNIPPET.format(argv=argv, imports=imports, init=init.format(db=os.path.abspath(CSV_PATH)) if CSV_PATH else '')
+            tic = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+            run = json.loads(out.stdout.strip().splitlines()[-1])
+            run['total_s'] = time.perf_counter() - tic
+            runs.append(run)
+
+        result = {'entry_point': name}
+        for key in ['import_s', 'init_s', 'total_s']:
+            result[key] = float(np.median([r[key] for r in runs]))
+        result['tensorflow'] = any(r['tensorflow'] for r in runs)
+        results.append(result)
+        print(result)
+
+    df = pd.DataFrame(results)
+    print(df)
+    df.to_csv(OUT_PATH)
+
+def synthetic_museum(rooms, rng, extra_doors=0.1):
+    # Floor plan of a grid of rooms, every room has a door to the room on its right and
+    # below it, a fraction of the rooms also to the room diagonally below it.
+    # Returns the CSR (indptr, indices) of the doors.
+    side = int(np.ceil(np.sqrt(rooms)))
+    room = np.arange(rooms)
+    right = room[((room + 1) % side != 0) & (room + 1 < rooms)]
+    below = room[room + side < rooms]
+    diagonal = right[(right + side + 1 < rooms) & (rng.random(len(right)) < extra_doors)]
+    edges = [np.stack([right, right + 1]), np.stack([below, below + side]), np.stack([diagonal, diagonal + side + 1])]
+
+    u, v = np.concatenate(edges, axis=1)
+    u, v = np.concatenate([u, v]), np.concatenate([v, u])
+    keys = np.unique(u * rooms + v)
+    u, v = keys // rooms, keys % rooms
+    return np.concatenate([[0], np.cumsum(np.bincount(u, minlength=rooms))]), v
+
+def synthetic_tour(graph, frames, rng, stay=0.95, detected=0.5, correct=0.8, distractors=3):
+    # Random walk through the museum and the room odds of every frame: half of the frames
+    # have matches, the true room gets the highest odds in most of them.
+    indptr, indices = graph
+    rooms = len(indptr) - 1
+    path = np.zeros(frames, dtype=np.int64)
+    path[0] = rng.integers(rooms)
+    for t in range(1, frames):
+        neighbours = indices[indptr[path[t - 1]]:indptr[path[t - 1] + 1]]
+        path[t] = path[t - 1] if rng.random() < stay or len(neighbours) == 0 else rng.choice(neighbours)
+
+    odds = np.zeros((frames, rooms), dtype=np.float32)
+    for t in np.flatnonzero(rng.random(frames) < detected):
+        odds[t, rng.integers(0, rooms, distractors)] = rng.random(distractors) * 0.5
+        odds[t, path[t] if rng.random() < correct else rng.integers(rooms)] = 0.5 + rng.random() * 0.5
+        odds[t] /= odds[t].sum()
+    return path, odds
+
+def benchmark_hmm(sizes=[1000, 2000, 5000, 10000], beams=[32, 128], frames=2000, dense_limit=5000):
+    print('---------------------------------------------')
+    print('BENCHMARKING HMM ON SYNTHETIC MUSEUMS')
+    print('---------------------------------------------')
+
+    # Every filter runs the online forward step over the same synthetic tour. The
+    # accuracy is measured against the true path, the agreement against the exact
+    # filter (dense up to dense_limit rooms, sparse without beam above it).
+    rng = np.random.default_rng(0)
+    results = []
+    for rooms in sizes:
+        graph = synthetic_museum(rooms, rng)
+        path, odds = synthetic_tour(graph, frames, rng)
+
+        filters = [('sparse', {'sparse': True})] + [('beam{}'.format(b), {'sparse': True, 'beam': b}) for b in beams]
+        if rooms <= dense_limit:
+            filters.insert(0, ('dense', {}))
+
+        reference = None
+        for name, options in filters:
+            tic = time.perf_counter()
+            hmm = HMM.build(graph, 'gaussian', cache_dir=None, **options)
+            build_time = time.perf_counter() - tic
+
+            tic = time.perf_counter()
+            _, best_rooms = hmm.forward_sequence(odds)
+            step_time = (time.perf_counter() - tic) / frames
+            reference = best_rooms if reference is None else reference
+
+            results.append({'rooms': rooms, 'filter': name, 'build_s': build_time, 'step_ms': step_time * 1000,
+                'accuracy': float(np.mean(best_rooms == path)), 'agreement': float(np.mean(best_rooms == reference))})
+            print(results[-1])
+
+    df = pd.DataFrame(results)
+    print(df)
+    df.to_csv(OUT_PATH)
+
+def benchmark_undistort(frames=200, frame_shape=(1280, 720)):
+    print('---------------------------------------------')
+    print('BENCHMARKING FRAME UNDISTORTION')
+    print('---------------------------------------------')
+
+    # --csv points to the calibration file, --basefolder to a GoPro video (default:
+    # synthetic frames). The old path undistorts the full frame, crops to the ROI
+    # and resizes to the detector width, the new path is one remap.
+    cap = cv2.VideoCapture(IMAGES_PATH) if IMAGES_PATH is not None else None
+    if cap is not None:
+        frame_shape = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    rng = np.random.default_rng(0)
+
+    tic = time.perf_counter()
+    preproc = FrameProcessor(CSV_PATH, frame_shape, width=DETECTOR_WIDTH)
+    init_time = time.perf_counter() - tic
+    x, y, w, h = preproc.roi
+
+    results = []
+    for _ in range(frames):
+        if cap is not None:
+            success, img = cap.read()
+            if not success:
+                break
+        else:
+            img = cv2.GaussianBlur((rng.random(frame_shape[::-1] + (3,)) * 255).astype(np.uint8), (0, 0), 2)
+
+        tic = time.perf_counter()
+        dst = cv2.undistort(src=img, cameraMatrix=preproc.mtx, distCoeffs=preproc.dist, newCameraMatrix=preproc.refined_mtx)
+        reference = resize_with_aspectratio(dst[y:y+h, x:x+w], width=DETECTOR_WIDTH)
+        undistort_time = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        fused = preproc.undistort(img)
+        remap_time = time.perf_counter() - tic
+
+        results.append({'undistort_ms': undistort_time * 1000, 'remap_ms': remap_time * 1000,
+            'mean_abs_diff': float(np.abs(fused.astype(np.int16) - reference).mean())})
+
+    df = pd.DataFrame(results)
+    print(df.describe())
+    print('Maps built in {:.1f} ms, median {:.2f} ms -> {:.2f} ms per frame ({:.1f}x)'.format(init_time * 1000,
+        df.undistort_ms.median(), df.remap_ms.median(), df.undistort_ms.median() / df.remap_ms.median()))
+    df.to_csv(OUT_PATH)
+
+def benchmark_blur(images=200, width=400, threshold=35):
+    print('---------------------------------------------')
+    print('BENCHMARKING HAAR BLUR DETECTION')
+    print('---------------------------------------------')
+
+    # The loop reference (blur_reference.py) needs PyWavelets (requirements-dev.txt).
+    if importlib.util.find_spec('pywt') is None:
+        print('PyWavelets is not installed (pip3 install -r requirements-dev.txt), skipping the blur benchmark.')
+        return
+
+    # --basefolder points to the database images (one folder per room), default
+    # synthetic images blurred with random strength. Images are resized to the width
+    # of FrameProcessor.sharpness_metric.
+    if IMAGES_PATH is not None:
+        paths = sorted(os.path.join(root, f) for root, _, files in os.walk(IMAGES_PATH) for f in files if f.lower().endswith(('.jpg', '.png')))
+        paths = paths[::max(1, len(paths) // images)][:images]
+        imgs = [ resize_with_aspectratio(cv2.imread(p), width=width) for p in paths ]
+    else:
+        rng = np.random.default_rng(0)
+        noise = [ (rng.random((int(width * 0.75), width, 3)) * 255).astype(np.uint8) for _ in range(images) ]
+        imgs = [ cv2.GaussianBlur(img, (0, 0), float(rng.choice([0.5, 1, 2, 4]))) for img in noise ]
+
+    results = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for img in imgs:
+            tic = time.perf_counter()
+            reference = blur_detect_windows(img, threshold)
+            loop_time = time.perf_counter() - tic
+
+            tic = time.perf_counter()
+            per, blur_extent = blur_detect(img, threshold)
+            vectorized_time = time.perf_counter() - tic
+
+            identical = all(a == b or (np.isnan(a) and np.isnan(b)) for a, b in zip(reference, (per, blur_extent)))
+            results.append({'loop_ms': loop_time * 1000, 'vectorized_ms': vectorized_time * 1000, 'identical': identical})
+
+    df = pd.DataFrame(results)
+    print(df.describe())
+    print('Median {:.2f} ms -> {:.2f} ms per image ({:.1f}x), identical output for {}/{} images'.format(df.loop_ms.median(),
+        df.vectorized_ms.median(), df.loop_ms.median() / df.vectorized_ms.median(), df.identical.sum(), len(df)))
+    df.to_csv(OUT_PATH)
+
+def benchmark_sharpness(images=200, frame_shape=(1280, 720)):
+    print('---------------------------------------------')
+    print('BENCHMARKING SHARPNESS GATES')
+    print('---------------------------------------------')
+
+    # --basefolder points to the database images (one folder per room), default
+    # synthetic frames blurred with random strength. Every gate decides on a fresh
+    # FrameContext (including its resize), 'shared' is the cost when the detector
+    # already resized the frame. The agreement is measured against the current
+    # FrameProcessor.sharpness_metric, 'best_threshold' is the threshold of the gate
+    # metric with the highest agreement.
+    if IMAGES_PATH is not None:
+        paths = sorted(os.path.join(root, f) for root, _, files in os.walk(IMAGES_PATH) for f in files if f.lower().endswith(('.jpg', '.png')))
+        imgs = [ cv2.imread(p) for p in paths[::max(1, len(paths) // images)][:images] ]
+    else:
+        rng = np.random.default_rng(0)
+        noise = [ (rng.random(frame_shape[::-1] + (3,)) * 255).astype(np.uint8) for _ in range(images) ]
+        imgs = [ cv2.GaussianBlur(img, (0, 0), float(rng.choice([0.5, 1, 2, 4, 8]))) for img in noise ]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reference, reference_times = [], []
+        for img in imgs:
+            tic = time.perf_counter()
+            reference.append(FrameProcessor.sharpness_metric(img))
+            reference_times.append(time.perf_counter() - tic)
+        reference = np.array(reference)
+        results = [{'gate': 'sharpness_metric', 'ms': np.median(reference_times) * 1000, 'shared_ms': None, 'agreement': 1.0}]
+
+        for gate in [HaarGate(), LaplacianGate(), TenengradGate()]:
+            times, shared_times, decisions, metrics = [], [], [], []
+            for img in imgs:
+                tic = time.perf_counter()
+                decisions.append(gate.is_blurred(FrameContext(img)))
+                times.append(time.perf_counter() - tic)
+
+                context = FrameContext(img)
+                context.gray(DETECTOR_WIDTH)
+                tic = time.perf_counter()
+                gate.is_blurred(context)
+                shared_times.append(time.perf_counter() - tic)
+                metrics.append(gate.metric(context.gray(gate.width)))
+
+            # Blurred below the threshold: try every metric value as threshold.
+            metrics = np.nan_to_num(np.array(metrics, dtype=np.float64))
+            candidates = np.append(np.unique(metrics), np.inf)
+            agreements = [np.mean((metrics < t) == reference) for t in candidates]
+
+            results.append({'gate': type(gate).__name__, 'ms': np.median(times) * 1000, 'shared_ms': np.median(shared_times) * 1000,
+                'agreement': float(np.mean(np.array(decisions) == reference)), 'threshold': gate.threshold,
+                'best_threshold': float(candidates[np.argmax(agreements)]), 'best_agreement': float(np.max(agreements))})
+            print(results[-1])
+
+    df = pd.DataFrame(results)
+    print(df)
+    df.to_csv(OUT_PATH)
+
 # SETUP:
 if what == 'all':
     benchmark_detector()
@@ -584,6 +1045,26 @@ elif what == 'matcherfvector':
     benchmark_matcher_vector()
 elif what == 'detector':
     benchmark_detector()
+elif what == 'ann':
+    benchmark_ann()
+elif what == 'compression':
+    benchmark_compression()
+elif what == 'backbone':
+    benchmark_backbone()
+elif what == 'backbone_worker':
+    benchmark_backbone_worker()
+elif what == 'orbkernel':
+    benchmark_orb_kernel()
+elif what == 'startup':
+    benchmark_startup()
+elif what == 'hmm':
+    benchmark_hmm()
+elif what == 'undistort':
+    benchmark_undistort()
+elif what == 'blur':
+    benchmark_blur()
+elif what == 'sharpness':
+    benchmark_sharpness()
 else:
     print('Unknown argument')
     exit()
\ No newline at end of file
@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+
+"""
+Reference of the Haar blur detection: the pywt transform, sliding window loop and
+per element rules that preprocessing.blur_detect replaced. The blur benchmark and
+the tests check that blur_detect gives identical output. Needs PyWavelets
+(requirements-dev.txt), imported on the first call.
+"""
+
+def blur_detect_windows(img, threshold):
+    import pywt
+    dwt2 = lambda x: pywt.dwt2(x, 'haar')
+
+    Y = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    M, N = Y.shape
+    Y = Y[0:int(M/16)*16, 0:int(N/16)*16]
+    LL1, (LH1, HL1, HH1) = dwt2(Y)
+    LL2, (LH2, HL2, HH2) = dwt2(LL1)
+    LL3, (LH3, HL3, HH3) = dwt2(LL2)
+    E1 = np.sqrt(np.power(LH1, 2)+np.power(HL1, 2)+np.power(HH1, 2))
+    E2 = np.sqrt(np.power(LH2, 2)+np.power(HL2, 2)+np.power(HH2, 2))
+    E3 = np.sqrt(np.power(LH3, 2)+np.power(HL3, 2)+np.power(HH3, 2))
+
+    M1, N1 = E1.shape
+    Emax = np.zeros((3, int((M1/8)*(N1/8))))
+    count = 0
+    for x in range(0, M1, 8):
+        for y in range(0, N1, 8):
+            Emax[0, count] = np.max(E1[x:x+8, y:y+8])
+            Emax[1, count] = np.max(E2[x//2:x//2+4, y//2:y//2+4])
+            Emax[2, count] = np.max(E3[x//4:x//4+2, y//4:y//4+2])
+            count += 1
+
+    EdgePoint = (Emax[0] > threshold) + (Emax[1] > threshold) + (Emax[2] > threshold)
+    DAstructure = (Emax[0][EdgePoint] > Emax[1][EdgePoint]) * (Emax[1][EdgePoint] > Emax[2][EdgePoint])
+    RG, RS, BlurC = np.zeros(count), np.zeros(count), np.zeros(count)
+    for i in range(count):
+        if EdgePoint[i] == 1 and Emax[0, i] < Emax[1, i] and Emax[1, i] < Emax[2, i]:
+            RG[i] = 1
+    for i in range(count):
+        if EdgePoint[i] == 1 and Emax[1, i] > Emax[0, i] and Emax[1, i] > Emax[2, i]:
+            RS[i] = 1
+    for i in range(count):
+        if (RG[i] == 1 or RS[i] == 1) and Emax[0, i] < threshold:
+            BlurC[i] = 1
+
+    Per = np.sum(DAstructure)/np.sum(EdgePoint)
+    if (np.sum(RG) + np.sum(RS)) == 0:
+        return Per, 100
+    return Per, np.sum(BlurC) / (np.sum(RG) + np.sum(RS))
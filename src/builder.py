@@ -0,0 +1,351 @@
+import cv2
+import numpy as np
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+import multiprocessing
+
+from util import resize_with_aspectratio
+from util import printProgressBar
+from database import PaintingDatabase, TABLE_COLUMNS
+from ann import IVFPQIndex
+
+"""
+Parallel, resumable database build.
+
+    decode + ORB    worker pool, every image is decoded once, the VGG input is
+                    resized from the same decoded image
+    VGG             batched inference in the main process while the pool works ahead
+    output          every chunk of images is written to <out>.build/chunk_XXXXX.npz,
+                    an interrupted build continues at the first missing chunk
+
+When all chunks exist they are merged into the binary database at <out>.
+
+The database keeps the modification time, size and SHA-1 of every image (meta
+'files'). An update only computes the features of new and changed images, drops
+the deleted ones and carries the derived indexes (IVF-PQ, PCA) over to the new rows.
+
+Usage:
+    python3 src/builder.py data/Database src/data/keypoints.db --features 100 --workers 8
+    python3 src/builder.py data/Database src/data/keypoints.db --update
+"""
+
+def parse_filename(filename):
+    # e.g. zaal_1__IMG_20190323_111717__01.png
+    parts = filename.split("__")
+    return {
+        'id': filename,
+        'room': parts[0],
+        'photo': parts[1][4:],
+        'painting_number': int(parts[2][:2]),
+    }
+
+def file_state(path, data=None):
+    # Modification time, size and content hash of an image file.
+    stat = os.stat(path)
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': hashlib.sha1(data).hexdigest()}
+
+def init_worker():
+    # One OpenCV thread per process, the pool already uses all cores.
+    cv2.setNumThreads(1)
+
+def extract_features(args):
+    """
+    Decode one image, compute its ORB features and the (RGB) input of the network.
+    Runs in a worker process.
+    """
+
+    img_path, features, input_size = args
+
+    # The file is read once for the hash and the decoder.
+    data = np.fromfile(img_path, dtype=np.uint8)
+    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    orb = cv2.ORB_create(nfeatures=features)
+    kps, descriptors = orb.detectAndCompute(resize_with_aspectratio(img, width=800), None)
+
+    record = parse_filename(os.path.basename(img_path))
+    record['state'] = file_state(img_path, data.tobytes())
+    record['keypoints'] = np.array([(p.pt[0], p.pt[1], p.size, p.angle, p.response, p.octave, p.class_id) for p in kps], dtype=np.float32).reshape((-1, 7))
+    record['descriptors'] = np.zeros((0, 32), np.uint8) if descriptors is None else descriptors
+
+    # Nearest neighbour resize that samples the pixel centres like PIL (keras
+    # load_img(target_size=...)), INTER_NEAREST samples the top left corners. PNG
+    # images decode to the same pixels, JPEG decoders of OpenCV and PIL can differ a
+    # little: fvectors of JPEG images are close to, not equal to, generate_keypoints.
+    record['network_input'] = None
+    if input_size is not None:
+        record['network_input'] = cv2.cvtColor(cv2.resize(img, input_size, interpolation=cv2.INTER_NEAREST_EXACT), cv2.COLOR_BGR2RGB)
+
+    return record
+
+def write_chunk(path, records, fvectors):
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(r['descriptors']) for r in records])
+
+    # Written under a temporary name first, a chunk on disk is always complete.
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f,
+            table=np.array(json.dumps([{c: r[c] for c in TABLE_COLUMNS} for r in records])),
+            descriptors=np.concatenate([r['descriptors'] for r in records]),
+            keypoints=np.concatenate([r['keypoints'] for r in records]),
+            offsets=offsets,
+            fvectors=fvectors,
+            files=np.array(json.dumps({r['id']: r['state'] for r in records})))
+    os.replace(path + '.tmp', path)
+
+def merge_chunks(chunk_paths, meta):
+    tables, descriptors, keypoints, offsets, fvectors = [], [], [], [np.zeros(1, np.int64)], []
+    meta = dict(meta, files={})
+    for path in chunk_paths:
+        chunk = np.load(path)
+        tables.extend(json.loads(str(chunk['table'])))
+        meta['files'].update(json.loads(str(chunk['files'])))
+        descriptors.append(chunk['descriptors'])
+        keypoints.append(chunk['keypoints'])
+        offsets.append(chunk['offsets'][1:] + offsets[-1][-1])
+        fvectors.append(chunk['fvectors'])
+
+    return PaintingDatabase(pd.DataFrame(tables, columns=TABLE_COLUMNS), np.concatenate(descriptors),
+        np.concatenate(keypoints), np.concatenate(offsets), np.concatenate(fvectors), meta)
+
+def load_network(descriptor, threads=None):
+    # Imported here so the worker processes (and a fully checkpointed build) do not load TensorFlow.
+    from matcher import CustomResNet
+    return CustomResNet(descriptor=descriptor, intra_op_threads=threads)
+
+def process_chunks(chunks, features, neuralnet, workers=None, batch_size=32):
+    """
+    Yields the records and fvectors of every chunk (list of image paths).
+    """
+
+    input_size = None
+    if neuralnet is not None:
+        input_size = tuple(neuralnet.model.input_shape[1:3][::-1])
+
+    jobs = [(path, features, input_size) for chunk in chunks for path in chunk]
+    # Spawned, not forked: the parent already runs the threads of TensorFlow (the
+    # network is loaded first) and a forked copy of those can deadlock the workers.
+    with multiprocessing.get_context('spawn').Pool(processes=workers, initializer=init_worker) as pool:
+        # imap keeps the workers busy with the next chunk while the network runs.
+        results = pool.imap(extract_features, jobs, chunksize=4)
+
+        for chunk in chunks:
+            records = [next(results) for _ in chunk]
+
+            if neuralnet is not None:
+                x = np.stack([r['network_input'] for r in records]).astype(np.float32)
+                fvectors = neuralnet.predict(neuralnet.preprocess_batch(x), batch_size=batch_size)
+            else:
+                fvectors = np.zeros((len(records), 0), dtype=np.float32)
+
+            yield records, fvectors
+
+def build_database(directory_images, out_path, features=300, fvector_state=True, descriptor='fc2', workers=None, batch_size=32, chunk_size=256, threads=None):
+    """
+    Build the binary database of all images in directory_images using all cores.
+
+    - workers: amount of decode/ORB processes (default: all cores).
+    - batch_size: images per forward pass of the network.
+    - chunk_size: images per checkpoint.
+    - threads: TensorFlow intra-op threads of the network (default: TensorFlow decides).
+    """
+
+    build_dir = out_path.rstrip(os.sep) + '.build'
+    os.makedirs(build_dir, exist_ok=True)
+
+    filenames = sorted(os.fsdecode(f) for f in os.listdir(directory_images))
+    if len(filenames) == 0:
+        raise ValueError('No images in {}'.format(directory_images))
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    chunk_paths = [os.path.join(build_dir, 'chunk_{:05d}.npz'.format(i)) for i in range(len(chunks))]
+
+    # A checkpoint directory can only be resumed with the same settings. Chunk i holds
+    # the i-th chunk_size images of the sorted filenames: when images were added or
+    # removed the chunks cover other files and are discarded.
+    config = {'features': features, 'fvector_state': fvector_state, 'descriptor': descriptor, 'chunk_size': chunk_size,
+        'filenames': hashlib.sha1('\n'.join(filenames).encode('utf-8')).hexdigest()}
+    config_path = os.path.join(build_dir, 'config.json')
+    previous = None
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as f:
+            previous = json.load(f)
+        if {k: v for k, v in previous.items() if k != 'filenames'} != {k: v for k, v in config.items() if k != 'filenames'}:
+            raise ValueError('{} was created with other settings, remove it to start over.'.format(build_dir))
+    if previous != config:
+        if previous is not None:
+            print('The images in {} changed, the checkpoints in {} are discarded.'.format(directory_images, build_dir))
+        for f in os.listdir(build_dir):
+            if f.startswith('chunk_') and f.endswith(('.npz', '.npz.tmp')):
+                os.remove(os.path.join(build_dir, f))
+        with open(config_path, 'w') as f:
+            json.dump(config, f)
+
+    todo = [i for i in range(len(chunks)) if not os.path.exists(chunk_paths[i])]
+
+    neuralnet = None
+    if fvector_state and len(todo) > 0:
+        neuralnet = load_network(descriptor, threads)
+
+    progress = len(filenames) - sum(len(chunks[i]) for i in todo)
+    printProgressBar(progress, max(1, len(filenames)), prefix = 'Progress:', suffix = 'Complete', length = 50)
+
+    paths = [[os.path.join(os.fsdecode(directory_images), f) for f in chunks[i]] for i in todo]
+    for i, (records, fvectors) in zip(todo, process_chunks(paths, features, neuralnet, workers, batch_size)):
+        write_chunk(chunk_paths[i], records, fvectors)
+
+        progress += len(records)
+        printProgressBar(progress, max(1, len(filenames)), prefix = 'Progress:', suffix = 'Complete', length = 50)
+
+    if neuralnet is not None:
+        print('Inference: {}'.format(neuralnet.inference.stats()))
+
+    db = merge_chunks(chunk_paths, {'features': features, 'descriptor': descriptor})
+    db.save(out_path)
+
+    # The checkpoints are not needed once the database is complete.
+    for path in chunk_paths:
+        os.remove(path)
+    os.remove(config_path)
+    os.rmdir(build_dir)
+
+    return db
+
+def scan_changes(directory_images, files):
+    """
+    Compare the images in directory_images with the file states of a database.
+    Returns the names of the added, changed and removed images and the states of the
+    unchanged images whose modification time changed.
+    """
+
+    filenames = sorted(os.fsdecode(f) for f in os.listdir(directory_images))
+    added, changed, touched = [], [], {}
+    for filename in filenames:
+        state = files.get(filename)
+        if state is None:
+            added.append(filename)
+            continue
+
+        path = os.path.join(os.fsdecode(directory_images), filename)
+        stat = os.stat(path)
+        if stat.st_mtime == state['mtime'] and stat.st_size == state['size']:
+            continue
+
+        # Only hash the files whose metadata changed.
+        current = file_state(path)
+        if current['sha1'] == state['sha1']:
+            touched[filename] = current
+        else:
+            changed.append(filename)
+
+    removed = sorted(set(files) - set(filenames))
+    return added, changed, removed, touched
+
+def update_database(directory_images, db_path, neuralnet=None, workers=None, batch_size=32, chunk_size=256, threads=None):
+    """
+    Incrementally update a database directory with the images in directory_images.
+    Only new and changed images are processed, rows of deleted images are dropped. The
+    IVF-PQ index and the PCA compressed fvectors are updated with the trained quantizers.
+
+    - neuralnet: network of a running matcher, loaded when needed otherwise.
+
+    Returns a dict with the names of the added, changed and removed images.
+    """
+
+    db = PaintingDatabase.open(db_path)
+    meta = dict(db.meta)
+    ids = db.table['id'].tolist()
+
+    files = meta.get('files')
+    if files is None:
+        # Databases built before the file states were stored: the images that are
+        # already in the database are assumed unchanged.
+        directory = os.fsdecode(directory_images)
+        files = {f: file_state(os.path.join(directory, f)) for f in ids if os.path.exists(os.path.join(directory, f))}
+        files.update({f: {'mtime': None, 'size': None, 'sha1': None} for f in ids if f not in files})
+
+    added, changed, removed, touched = scan_changes(directory_images, files)
+    changes = {'added': added, 'changed': changed, 'removed': removed}
+    files = dict(files, **touched)
+    if len(added) + len(changed) + len(removed) == 0:
+        if len(touched) > 0 or 'files' not in meta:
+            PaintingDatabase.update_meta(db_path, files=files)
+        return changes
+
+    # Rows of changed images are removed and appended again with the new features.
+    dropped = set(changed) | set(removed)
+    keep = np.array([i for i, f in enumerate(ids) if f not in dropped], dtype=np.int64)
+    mapping = np.full(len(db), -1, dtype=np.int64)
+    mapping[keep] = np.arange(len(keep))
+
+    todo = sorted(added + changed)
+    records, fvectors = [], []
+    if len(todo) > 0:
+        if neuralnet is None and db.fvector_dim > 0:
+            neuralnet = load_network(meta.get('descriptor', 'fc2'), threads)
+
+        paths = [os.path.join(os.fsdecode(directory_images), f) for f in todo]
+        chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+        for chunk_records, chunk_fvectors in process_chunks(chunks, meta.get('features', 300), neuralnet if db.fvector_dim > 0 else None, workers, batch_size):
+            records.extend(chunk_records)
+            fvectors.append(chunk_fvectors)
+    fvectors = np.concatenate(fvectors) if len(fvectors) > 0 else np.zeros((0, db.fvector_dim), dtype=np.float32)
+
+    for filename in removed + changed:
+        files.pop(filename, None)
+    files.update({r['id']: r['state'] for r in records})
+    meta['files'] = files
+
+    counts = np.diff(db.offsets)
+    rows = np.flatnonzero(np.repeat(mapping, counts) >= 0)
+    offsets = np.zeros(len(keep) + len(records) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.concatenate((counts[keep], [len(r['descriptors']) for r in records])))
+
+    table = pd.concat([db.table.iloc[keep], pd.DataFrame([{c: r[c] for c in TABLE_COLUMNS} for r in records], columns=TABLE_COLUMNS)], ignore_index=True)
+    new_db = PaintingDatabase(table,
+        np.concatenate([db.descriptors[rows]] + [r['descriptors'] for r in records]),
+        np.concatenate([db.keypoints[rows]] + [r['keypoints'] for r in records]),
+        offsets,
+        np.concatenate((db.fvectors[keep], fvectors)),
+        meta)
+
+    # Derived indexes are updated in memory and saved with the new directory.
+    new_ids = np.arange(len(keep), len(new_db))
+    ann = None
+    if os.path.exists(os.path.join(db_path, 'ivfpq.npz')):
+        ann = IVFPQIndex.load(os.path.join(db_path, 'ivfpq.npz'))
+        ann.update(mapping, fvectors, new_ids, database=new_db.fvectors)
+
+    compressor, codes = None, None
+    if os.path.exists(os.path.join(db_path, 'pca.npz')):
+        compressor, codes = PaintingDatabase.open_compressed(db_path)
+        codes = np.concatenate((codes[keep], compressor.encode(fvectors) if len(fvectors) > 0 else codes[:0]))
+
+    new_db.save(db_path, ann=ann, compressor=compressor, codes=codes)
+
+    return changes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the painting database')
+    parser.add_argument('images', help='Directory with the database images', type=str)
+    parser.add_argument('out', help='Path of the database directory', type=str)
+    parser.add_argument('--features', help='Amount of ORB features per image', required=False, default=300, type=int)
+    parser.add_argument('--descriptor', help='fc2|max|gem|rmac', required=False, default='fc2', type=str)
+    parser.add_argument('--no-fvector', help='Only compute ORB features', action='store_true')
+    parser.add_argument('--workers', help='Amount of decode/ORB processes (default: all cores)', required=False, default=None, type=int)
+    parser.add_argument('--batch-size', help='Images per forward pass', required=False, default=32, type=int)
+    parser.add_argument('--chunk-size', help='Images per checkpoint', required=False, default=256, type=int)
+    parser.add_argument('--threads', help='TensorFlow intra-op threads (default: TensorFlow decides)', required=False, default=None, type=int)
+    parser.add_argument('--update', help='Only process new, changed and deleted images of an existing database', action='store_true')
+
+    args = parser.parse_args()
+    if args.update:
+        changes = update_database(args.images, args.out, workers=args.workers, batch_size=args.batch_size, chunk_size=args.chunk_size, threads=args.threads)
+        print('Added: {}, changed: {}, removed: {}'.format(len(changes['added']), len(changes['changed']), len(changes['removed'])))
+    else:
+        build_database(args.images, args.out, args.features, not args.no_fvector, args.descriptor, args.workers, args.batch_size, args.chunk_size, args.threads)
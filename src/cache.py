@@ -0,0 +1,121 @@
+import cv2
+import numpy as np
+from collections import OrderedDict
+
+"""
+Cache for the matcher results of painting crops.
+
+In a video the same painting is visible for many consecutive frames. Crops are keyed
+by a perceptual hash (DCT hash) so slightly different crops of the same painting map
+to hashes that only differ in a few bits.
+"""
+
+def perceptual_hash(img, hash_size=8):
+    """
+    64 bit DCT hash: the low frequencies of a 32x32 grayscale thumbnail compared to their median.
+    """
+
+    if len(img.shape) == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    small = cv2.resize(img, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(np.float32(small))[:hash_size, :hash_size]
+    bits = (dct > np.median(dct)).ravel()
+
+    return int(np.packbits(bits).view('>u8')[0])
+
+class CacheEntry():
+    def __init__(self, key, frame, vector=None):
+        self.key = key
+        self.frame = frame
+        self.vector = vector
+        # Ranked matches per (mode, distance metric).
+        self.matches = {}
+
+class MatchCache():
+    def __init__(self, size=64, ttl=30, max_distance=6):
+        """
+        - size: maximum amount of cached crops (least recently used is evicted).
+        - ttl: amount of frames an entry stays valid after it was computed.
+        - max_distance: maximum Hamming distance between two hashes of the same crop.
+        """
+
+        self.size = size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.frame = 0
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def next_frame(self):
+        self.frame += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def lookup(self, img):
+        """
+        Returns the hash of the crop and the cached entry (None on a miss).
+        """
+
+        key = perceptual_hash(img)
+
+        # Drop entries that are too old.
+        for k in [k for k, e in self.entries.items() if self.frame - e.frame > self.ttl]:
+            del self.entries[k]
+            self.expirations += 1
+
+        best = None
+        best_distance = self.max_distance + 1
+        for k, entry in self.entries.items():
+            distance = bin(k ^ key).count('1')
+            if distance < best_distance:
+                best, best_distance = entry, distance
+
+        if best is not None:
+            self.entries.move_to_end(best.key)
+        return key, best
+
+    def get(self, img, match_key):
+        """
+        Returns the entry of the crop (created on a miss) and the cached matches for
+        match_key, or None if they still have to be computed.
+        """
+
+        key, entry = self.lookup(img)
+        if entry is not None and match_key in entry.matches:
+            self.hits += 1
+            return entry, entry.matches[match_key]
+
+        self.misses += 1
+        if entry is None:
+            entry = self.insert(key)
+        return entry, None
+
+    def insert(self, key, vector=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        entry = CacheEntry(key, self.frame, vector)
+        self.entries[key] = entry
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / total if total > 0 else 0,
+            'entries': len(self.entries),
+        }
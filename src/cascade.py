@@ -0,0 +1,99 @@
+"""
+Adaptive cascade for the combination modes (fvector ranking, ORB re-rank).
+
+    gap         the fvector ranking is decisive when rank 2 is much further away
+                than rank 1, only the min_rerank best candidates are re-ranked
+    rerank      only the candidates whose fvector distance is close to the best one
+                are re-ranked with ORB, between min_rerank and max_rerank of them
+    early stop  heuristic: the re-rank stops when the best ORB score is below
+                stop_score and the next `patience` candidates did not beat it. This
+                is not a bound, a later candidate can still have a better score.
+
+The result is always an ORB ranking of the re-ranked candidates, like without cascade.
+
+Every stage counts how often it fired and how many ORB comparisons it saved
+compared to re-ranking max_rerank candidates.
+"""
+
+class Cascade():
+    def __init__(self, max_rerank=60, min_rerank=5, gap_ratio=0.3, rerank_ratio=1.25, stop_score=350, patience=5):
+        """
+        - max_rerank: amount of fvector candidates, the fixed re-rank set without cascade.
+        - min_rerank: smallest re-rank set.
+        - gap_ratio: only re-rank min_rerank candidates when (d2 - d1) / d2 >= gap_ratio (None = never).
+        - rerank_ratio: re-rank the candidates with a distance <= rerank_ratio * d1.
+        - stop_score: ORB score (sum of the 20 best match distances) below which the
+                      re-rank may stop early (None = never stop).
+        - patience: candidates compared after the certain match before stopping.
+        """
+
+        self.max_rerank = max_rerank
+        self.min_rerank = min_rerank
+        self.gap_ratio = gap_ratio
+        self.rerank_ratio = rerank_ratio
+        self.stop_score = stop_score
+        self.patience = patience
+
+        self.queries = 0
+        self.decisive = 0
+        self.reranked = 0
+        self.stopped = 0
+        self.compared = 0
+        self.saved_gap = 0
+        self.saved_rerank = 0
+        self.saved_stop = 0
+
+    def rerank_size(self, fvector_matches):
+        """
+        Amount of fvector candidates to re-rank with ORB (min_rerank if the fvector
+        ranking is decisive), 0 without candidates.
+        fvector_matches: (index, distance) tuples sorted on distance.
+        """
+
+        self.queries += 1
+        candidates = min(len(fvector_matches), self.max_rerank)
+        if candidates == 0:
+            return 0
+
+        if self.gap_ratio is not None and len(fvector_matches) >= 2:
+            d1, d2 = fvector_matches[0][1], fvector_matches[1][1]
+            if d2 > 0 and (d2 - d1) / d2 >= self.gap_ratio:
+                size = min(self.min_rerank, candidates)
+                self.decisive += 1
+                self.saved_gap += candidates - size
+                return size
+
+        limit = fvector_matches[0][1] * self.rerank_ratio
+        size = sum(1 for _, d in fvector_matches[:candidates] if d <= limit)
+        size = max(min(self.min_rerank, candidates), size)
+
+        self.reranked += 1
+        self.saved_rerank += candidates - size
+        return size
+
+    def stop(self, best_score, since_best, remaining):
+        """
+        True if the re-rank stops early: the best ORB score is below stop_score and
+        it was not beaten by the last since_best candidates (a heuristic, the
+        remaining candidates are not scored).
+        """
+
+        if self.stop_score is None or best_score is None or remaining == 0:
+            return False
+        if best_score <= self.stop_score and since_best >= self.patience:
+            self.stopped += 1
+            self.saved_stop += remaining
+            return True
+        return False
+
+    def stats(self):
+        return {
+            'queries': self.queries,
+            'decisive': self.decisive,
+            'reranked': self.reranked,
+            'stopped': self.stopped,
+            'compared': self.compared,
+            'saved_by_gap': self.saved_gap,
+            'saved_by_rerank_size': self.saved_rerank,
+            'saved_by_early_stop': self.saved_stop,
+        }
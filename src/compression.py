@@ -0,0 +1,120 @@
+import numpy as np
+
+from distances import Distance, FvectorEngine, CHUNK_BYTES
+
+"""
+PCA whitening and quantization of the database fvectors.
+
+The projection is learned offline on the database fvectors. The database is stored
+projected and quantized (float16 or int8 with a scale per dimension), queries are
+projected at full precision and compared with the decoded database rows (asymmetric
+distance computation: only the database side is quantized).
+"""
+
+DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+
+class FvectorCompressor():
+    def __init__(self, mean, components, scales, dtype='int8', quant_scale=None, normalize=True):
+        self.mean = mean                # (dim_in,)
+        self.components = components    # (dim, dim_in) principal directions
+        self.scales = scales            # (dim,) whitening factors (1 / sqrt(eigenvalue))
+        self.dtype = dtype
+        self.quant_scale = quant_scale  # (dim,) int8 step per dimension
+        self.normalize = normalize
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    @staticmethod
+    def train(fvectors, dim=256, whiten=True, dtype='int8', normalize=True):
+        """
+        Learn the PCA (whitening) projection on the database fvectors.
+
+        - dim: output dimension, at most min(n, dim_in).
+        - dtype: storage type of the projected vectors, float32, float16 or int8.
+        """
+
+        if dtype not in DTYPES:
+            raise ValueError('Unknown dtype: {}'.format(dtype))
+
+        fvectors = np.asarray(fvectors, dtype=np.float32)
+        mean = fvectors.mean(axis=0)
+        _, s, vt = np.linalg.svd(fvectors - mean, full_matrices=False)
+
+        dim = min(dim, len(s))
+        eigenvalues = s[:dim] ** 2 / max(1, len(fvectors) - 1)
+        if whiten:
+            scales = 1 / np.sqrt(eigenvalues + 1e-6 * eigenvalues[0])
+        else:
+            scales = np.ones(dim)
+
+        compressor = FvectorCompressor(mean, vt[:dim].astype(np.float32), scales.astype(np.float32), dtype, None, normalize)
+        if dtype == 'int8':
+            projected = compressor.project(fvectors)
+            compressor.quant_scale = np.maximum(np.abs(projected).max(axis=0), 1e-12).astype(np.float32) / 127
+        return compressor
+
+    def project(self, x):
+        projected = ((np.atleast_2d(np.asarray(x, dtype=np.float32)) - self.mean) @ self.components.T) * self.scales
+        if self.normalize:
+            projected /= np.linalg.norm(projected, axis=1, keepdims=True) + 1e-12
+        return projected
+
+    def encode(self, x):
+        projected = self.project(x)
+        if self.dtype == 'int8':
+            return np.clip(np.rint(projected / self.quant_scale), -127, 127).astype(np.int8)
+        return projected.astype(DTYPES[self.dtype])
+
+    def decode(self, codes):
+        if self.dtype == 'int8':
+            return codes.astype(np.float32) * self.quant_scale
+        return codes.astype(np.float32)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f,
+                mean=self.mean,
+                components=self.components,
+                scales=self.scales,
+                dtype=np.array(self.dtype),
+                quant_scale=np.zeros(0, np.float32) if self.quant_scale is None else self.quant_scale,
+                normalize=np.array(self.normalize))
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        quant_scale = data['quant_scale'] if len(data['quant_scale']) > 0 else None
+        return FvectorCompressor(data['mean'], data['components'], data['scales'], str(data['dtype']), quant_scale, bool(data['normalize']))
+
+class CompressedEngine(FvectorEngine):
+    """
+    FvectorEngine over the compressed database. Queries are projected in float32, the
+    database codes are decoded per block so the full precision matrix never exists.
+    """
+
+    def __init__(self, compressor, codes, p=2):
+        self.compressor = compressor
+        self.codes = np.ascontiguousarray(codes)
+        self.p = p
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def subset(self, rows):
+        return CompressedEngine(self.compressor, self.codes[rows], self.p)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def distances(self, queries, metric=Distance.EUCLIDEAN):
+        queries = self.compressor.project(queries)
+
+        rows = max(1, CHUNK_BYTES // (4 * max(1, queries.shape[0]) * self.compressor.dim))
+        result = np.empty((queries.shape[0], len(self)), dtype=np.float32)
+        for start in range(0, len(self), rows):
+            block = FvectorEngine(self.compressor.decode(self.codes[start:start + rows]), self.p)
+            result[:, start:start + rows] = block.distances(queries, metric)
+        return result
@@ -0,0 +1,253 @@
+import cv2
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import shutil
+
+from ann import IVFPQIndex
+from compression import FvectorCompressor
+
+"""
+Binary painting database.
+
+A database is a directory that contains a metadata file and a couple of
+contiguous numpy arrays. The arrays are opened memory-mapped so loading a
+database with thousands of paintings only reads the metadata.
+
+    meta.json               version, counts, the table (id, room, photo, painting_number)
+                            and the file states (mtime, size, sha1) used by incremental updates
+    descriptors.npy         (n_descriptors, 32) uint8, ORB descriptors of all images
+    keypoints.npy           (n_descriptors, 7) float32, x, y, size, angle, response, octave, class_id
+    descriptor_offsets.npy  (n_images + 1,) int64, descriptors of image i are [offsets[i], offsets[i+1])
+    fvectors.npy            (n_images, dim) float32, VGG feature vectors (dim = 0 if not generated)
+
+Optional files derived from the fvectors:
+
+    ivfpq.npz               IVF-PQ index for approximate search (see ann.py)
+    pca.npz                 PCA whitening projection and quantization parameters (see compression.py)
+    fvectors_pca.npy        (n_images, pca_dim) projected and quantized fvectors
+"""
+
+FORMAT_VERSION = 1
+TABLE_COLUMNS = ['id', 'room', 'photo', 'painting_number']
+
+class PaintingDatabase():
+    def __init__(self, table, descriptors, keypoints, offsets, fvectors, meta=None):
+        self.table = table
+        self.descriptors = descriptors
+        self.keypoints = keypoints
+        self.offsets = offsets
+        self.fvectors = fvectors
+        self.meta = {} if meta is None else meta
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def fvector_dim(self):
+        return self.fvectors.shape[1]
+
+    def image_descriptors(self, index):
+        return self.descriptors[self.offsets[index]:self.offsets[index + 1]]
+
+    def image_keypoints(self, index):
+        # Only construct cv2.KeyPoint objects when they are actually needed (visualization).
+        # Positional arguments work for both the macOS and linux OpenCV builds.
+        return [
+            cv2.KeyPoint(float(p[0]), float(p[1]), float(p[2]), float(p[3]), float(p[4]), int(p[5]), int(p[6]))
+            for p in self.keypoints[self.offsets[index]:self.offsets[index + 1]]
+        ]
+
+    @staticmethod
+    def is_database(path):
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+    @staticmethod
+    def open(path, mmap_mode='r'):
+        """
+        Open a database directory. Arrays are memory-mapped unless mmap_mode is None.
+        """
+
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError('Unsupported database version: {}'.format(meta.get('version')))
+
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+        table = pd.DataFrame(meta.pop('table'), columns=TABLE_COLUMNS)
+
+        return PaintingDatabase(table, load('descriptors'), load('keypoints'), load('descriptor_offsets'), load('fvectors'), meta)
+
+    @staticmethod
+    def from_records(records, meta=None):
+        """
+        Build an in-memory database from a list of dicts with keys id, room, photo,
+        painting_number, keypoints (n, 7), descriptors (n, 32) and fvector (dim,).
+        """
+
+        table = pd.DataFrame([{c: r[c] for c in TABLE_COLUMNS} for r in records], columns=TABLE_COLUMNS)
+
+        counts = [len(r['descriptors']) for r in records]
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        descriptors = np.zeros((offsets[-1], 32), dtype=np.uint8)
+        keypoints = np.zeros((offsets[-1], 7), dtype=np.float32)
+        for i, r in enumerate(records):
+            if counts[i] > 0:
+                descriptors[offsets[i]:offsets[i + 1]] = r['descriptors']
+                keypoints[offsets[i]:offsets[i + 1]] = r['keypoints']
+
+        # Databases generated without fvectors get an empty (n, 0) matrix.
+        dim = max([len(r['fvector']) for r in records], default=0)
+        fvectors = np.zeros((len(records), dim), dtype=np.float32)
+        if dim > 0:
+            for i, r in enumerate(records):
+                fvectors[i] = r['fvector']
+
+        return PaintingDatabase(table, descriptors, keypoints, offsets, fvectors, meta)
+
+    @staticmethod
+    def from_csv(csv_path):
+        """
+        Parse the legacy CSV file (JSON encoded keypoints, descriptors and fvectors per row).
+        """
+
+        df = pd.read_csv(csv_path, sep=',')
+        records = []
+        for _, row in df.iterrows():
+            keypoints = [(p[0][0], p[0][1], p[1], p[2], p[3], p[4], p[5]) for p in json.loads(row['keypoints'])]
+            fvector = json.loads(row['fvector']) if 'fvector' in row and isinstance(row['fvector'], str) else []
+
+            records.append({
+                'id': row['id'],
+                'room': row['room'],
+                'photo': row['photo'],
+                'painting_number': int(row['painting_number']),
+                'keypoints': np.array(keypoints, dtype=np.float32).reshape((-1, 7)),
+                'descriptors': np.array(json.loads(row['descriptors']), dtype=np.uint8).reshape((-1, 32)),
+                'fvector': fvector,
+            })
+
+        return PaintingDatabase.from_records(records)
+
+    @staticmethod
+    def compress_fvectors(path, dim=256, dtype='int8', whiten=True):
+        """
+        Learn the PCA whitening projection on the fvectors of a database directory and
+        store the projected (and quantized) fvectors next to the original ones.
+        """
+
+        db = PaintingDatabase.open(path)
+        compressor = FvectorCompressor.train(db.fvectors, dim=dim, whiten=whiten, dtype=dtype)
+        compressor.save(os.path.join(path, 'pca.npz'))
+        np.save(os.path.join(path, 'fvectors_pca.npy'), compressor.encode(db.fvectors))
+        return compressor
+
+    @staticmethod
+    def open_compressed(path, mmap_mode='r'):
+        # Returns the compressor and the compressed fvectors of a database directory.
+        compressor = FvectorCompressor.load(os.path.join(path, 'pca.npz'))
+        codes = np.load(os.path.join(path, 'fvectors_pca.npy'), mmap_mode=mmap_mode)
+        return compressor, codes
+
+    @staticmethod
+    def update_meta(path, **values):
+        # Change metadata entries of a database directory without rewriting the arrays.
+        meta_path = os.path.join(path, 'meta.json')
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        meta.update(values)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def save(self, path, ann=None, compressor=None, codes=None):
+        """
+        Write the database to a directory. The directory is written next to the
+        target and renamed afterwards so readers never see a half written database.
+
+        - ann: IVF-PQ index of the fvectors, written as ivfpq.npz.
+        - compressor, codes: PCA compressor and compressed fvectors, written as pca.npz
+                             and fvectors_pca.npy.
+        """
+
+        tmp_path = path.rstrip(os.sep) + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        np.save(os.path.join(tmp_path, 'descriptors.npy'), np.ascontiguousarray(self.descriptors, dtype=np.uint8))
+        np.save(os.path.join(tmp_path, 'keypoints.npy'), np.ascontiguousarray(self.keypoints, dtype=np.float32))
+        np.save(os.path.join(tmp_path, 'descriptor_offsets.npy'), np.ascontiguousarray(self.offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'fvectors.npy'), np.ascontiguousarray(self.fvectors, dtype=np.float32))
+
+        meta = dict(self.meta)
+        meta.update({
+            'version': FORMAT_VERSION,
+            'count': len(self),
+            'descriptor_count': int(self.offsets[-1]),
+            'fvector_dim': int(self.fvector_dim),
+            'table': self.table[TABLE_COLUMNS].astype({'painting_number': int}).to_dict(orient='list'),
+        })
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        # The derived files are part of the new directory, the database is never
+        # visible without them.
+        if ann is not None:
+            ann.save(os.path.join(tmp_path, 'ivfpq.npz'))
+        if compressor is not None:
+            compressor.save(os.path.join(tmp_path, 'pca.npz'))
+            np.save(os.path.join(tmp_path, 'fvectors_pca.npy'), codes)
+
+        # The old directory is moved aside before it is removed: a running matcher can
+        # still have its arrays memory-mapped.
+        old_path = path.rstrip(os.sep) + '.old'
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+if __name__ == '__main__':
+    """
+    Usage:
+        python3 src/database.py convert src/data/keypoints.csv src/data/keypoints.db
+        python3 src/database.py build-ann src/data/keypoints.db --nlist 64 --m 64 --nprobe 8
+        python3 src/database.py compress src/data/keypoints.db --dim 256 --dtype int8
+    """
+
+    parser = argparse.ArgumentParser(description='Painting database tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='Convert a legacy keypoint CSV to the binary format')
+    convert_parser.add_argument('csv', help='Path to the keypoint CSV', type=str)
+    convert_parser.add_argument('out', help='Path of the database directory', type=str)
+
+    ann_parser = subparsers.add_parser('build-ann', help='Build the IVF-PQ index for approximate fvector search')
+    ann_parser.add_argument('db', help='Path of the database directory', type=str)
+    ann_parser.add_argument('--nlist', help='Amount of inverted lists (default sqrt(n))', required=False, default=None, type=int)
+    ann_parser.add_argument('--m', help='Amount of PQ sub-quantizers', required=False, default=64, type=int)
+    ann_parser.add_argument('--nprobe', help='Default amount of lists visited per query', required=False, default=8, type=int)
+
+    compress_parser = subparsers.add_parser('compress', help='Learn PCA whitening and store quantized fvectors')
+    compress_parser.add_argument('db', help='Path of the database directory', type=str)
+    compress_parser.add_argument('--dim', help='Dimension after PCA', required=False, default=256, type=int)
+    compress_parser.add_argument('--dtype', help='float32|float16|int8', required=False, default='int8', type=str)
+    compress_parser.add_argument('--no-whiten', help='Only project, do not whiten', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        PaintingDatabase.from_csv(args.csv).save(args.out)
+    elif args.command == 'build-ann':
+        db = PaintingDatabase.open(args.db)
+        IVFPQIndex.build(db.fvectors, nlist=args.nlist, m=args.m, nprobe=args.nprobe).save(os.path.join(args.db, 'ivfpq.npz'))
+    elif args.command == 'compress':
+        PaintingDatabase.compress_fvectors(args.db, dim=args.dim, dtype=args.dtype, whiten=not args.no_whiten)
@@ -2,12 +2,15 @@ import numpy as np
 import cv2
 import sys
 
+from preprocessing import FrameContext
 from util import (
-    resize_with_aspectratio,
     random_color,
     order_points,
 )
 
+# Width of the images the detector works on, frames are resized to this width.
+DETECTOR_WIDTH = 500
+
 class PaintingDetector():
     def __init__(self, img=None, bbox_color=None):
         self._bbox_color = random_color() if bbox_color is None else bbox_color
@@ -16,14 +19,19 @@ class PaintingDetector():
             self.load_image(img)
 
     def load_image(self, img):
+        # img: BGR image or the FrameContext of a frame (shares the resized images).
+        context = img if isinstance(img, FrameContext) else None
+        if context is not None:
+            img = context.image
         if not type(img) == np.ndarray:
             raise ValueError()
 
-        imh, imw, _ = img.shape
-        self._img = resize_with_aspectratio(img, width=500)
+        if context is None:
+            context = FrameContext(img)
+        self._img = context.resized(DETECTOR_WIDTH)
         self._original_shape = img.shape
 
-        self._img_bg = cv2.cvtColor(self._img, cv2.COLOR_BGR2GRAY)
+        self._img_bg = context.gray(DETECTOR_WIDTH)
     
     @property
     def img(self):
@@ -0,0 +1,164 @@
+import numpy as np
+from enum import Enum
+
+class Distance(Enum):
+    EUCLIDEAN = 0
+    CITYBLOCK = 1
+    MINOWSKI = 2
+    CHEBYSHEV = 3
+    COSINE = 4
+    JACCARD = 5
+
+# Upper bound (bytes) for the (queries x rows x dim) temporaries of the broadcasted metrics.
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Euclidean pairs with |q - d|^2 <= CANCELLATION * (|q|^2 + |d|^2) are recomputed from
+# their difference in float64, the float32 expansion cancels for close vectors.
+CANCELLATION = 1e-2
+
+class FvectorEngine():
+    """
+    Batched distance computations between query fvectors and the database fvectors.
+
+    The database fvectors are kept as one contiguous float32 matrix. Every metric of
+    the Distance enum is computed for all (query, database) pairs at once and gives
+    the same result as the matching scipy.spatial.distance function, up to float32
+    rounding. The euclidean distance uses |q|^2 + |d|^2 - 2 q.d, the pairs where that
+    expansion cancels (near duplicates) are recomputed directly in float64.
+
+    - fvectors: (n, dim) matrix, may be a memory-mapped array.
+    - p: order of the minkowski distance (scipy default is 2).
+    """
+
+    def __init__(self, fvectors, p=2):
+        self.fvectors = np.ascontiguousarray(fvectors, dtype=np.float32)
+        self.p = p
+        self._sq_norms = None
+        self._norms = None
+        self._nonzero = None
+
+    def __len__(self):
+        return self.fvectors.shape[0]
+
+    def subset(self, rows):
+        # Engine over a subset of the database rows, indices of its results are positions in rows.
+        return FvectorEngine(self.fvectors[rows], self.p)
+
+    @property
+    def sq_norms(self):
+        if self._sq_norms is None:
+            self._sq_norms = np.einsum('ij,ij->i', self.fvectors, self.fvectors)
+        return self._sq_norms
+
+    @property
+    def norms(self):
+        if self._norms is None:
+            self._norms = np.sqrt(self.sq_norms)
+        return self._norms
+
+    @property
+    def nonzero(self):
+        if self._nonzero is None:
+            self._nonzero = (self.fvectors != 0).astype(np.float32)
+        return self._nonzero
+
+    def distances(self, queries, metric=Distance.EUCLIDEAN):
+        """
+        Returns a (n_queries, n) matrix with the distance of every query to every database row.
+        """
+
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+
+        if metric.value == Distance.EUCLIDEAN.value or (metric.value == Distance.MINOWSKI.value and self.p == 2):
+            q_sq = np.einsum('ij,ij->i', queries, queries)
+            scale = q_sq[:, None] + self.sq_norms[None, :]
+            sq = scale - 2 * (queries @ self.fvectors.T)
+            self._refine(queries, sq, np.nonzero(sq <= CANCELLATION * scale))
+            return np.sqrt(np.maximum(sq, 0))
+        elif metric.value == Distance.COSINE.value:
+            q_norms = np.linalg.norm(queries, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return 1 - (queries @ self.fvectors.T) / (q_norms[:, None] * self.norms[None, :])
+        elif metric.value == Distance.CITYBLOCK.value:
+            return self._broadcast(queries, lambda diff: np.abs(diff).sum(axis=2))
+        elif metric.value == Distance.CHEBYSHEV.value:
+            return self._broadcast(queries, lambda diff: np.abs(diff).max(axis=2))
+        elif metric.value == Distance.MINOWSKI.value:
+            return self._broadcast(queries, lambda diff: np.power(np.power(np.abs(diff), self.p).sum(axis=2), 1 / self.p))
+        elif metric.value == Distance.JACCARD.value:
+            return self._jaccard(queries)
+        else:
+            raise ValueError('Unknown distance metric: {}'.format(metric))
+
+    def _refine(self, queries, sq, pairs):
+        # Squared distances of the (query, row) pairs from their differences, in float64.
+        query_rows, rows = pairs
+        step = max(1, CHUNK_BYTES // (8 * max(1, self.fvectors.shape[1])))
+        for start in range(0, len(rows), step):
+            q, r = query_rows[start:start + step], rows[start:start + step]
+            diff = queries[q].astype(np.float64) - self.fvectors[r]
+            sq[q, r] = np.einsum('ij,ij->i', diff, diff)
+
+    def _chunks(self, n_queries):
+        rows = max(1, CHUNK_BYTES // (4 * max(1, n_queries) * max(1, self.fvectors.shape[1])))
+        for start in range(0, len(self), rows):
+            yield start, min(start + rows, len(self))
+
+    def _broadcast(self, queries, reduce):
+        # Metrics without a matrix product formulation are evaluated on (queries, rows, dim)
+        # blocks, the block size is bounded by CHUNK_BYTES.
+        result = np.empty((queries.shape[0], len(self)), dtype=np.float32)
+        for start, end in self._chunks(queries.shape[0]):
+            result[:, start:end] = reduce(queries[:, None, :] - self.fvectors[None, start:end, :])
+        return result
+
+    def _jaccard(self, queries):
+        # Boolean dissimilarity like scipy: (u != 0) xor (v != 0) counted over (u != 0) or (v != 0).
+        q_nonzero = (queries != 0).astype(np.float32)
+        intersection = q_nonzero @ self.nonzero.T
+        q_count = q_nonzero.sum(axis=1)[:, None]
+        db_count = self.nonzero.sum(axis=1)[None, :]
+
+        union = q_count + db_count - intersection
+        unequal = q_count + db_count - 2 * intersection
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = unequal / union
+        result[union == 0] = 0
+        return result
+
+    def match(self, queries, metric=Distance.EUCLIDEAN, k=None):
+        """
+        Rank the database for every query. Returns one list of (index, distance) tuples
+        per query, sorted on distance. Only the k closest rows are returned if k is given.
+        """
+
+        distances = self.distances(queries, metric)
+        indices = top_k(distances, k)
+        ranked = np.take_along_axis(distances, indices, axis=1)
+
+        return [list(zip(idx.tolist(), dist.tolist())) for idx, dist in zip(indices, ranked)]
+
+def top_k(distances, k=None):
+    """
+    Indices of the k smallest values of every row, sorted ascending. A partial sort
+    (partition) finds the k-th value so only the values up to it need to be sorted.
+    Ties are ordered on index, the same result as the first k of a stable full sort.
+    """
+
+    distances = np.atleast_2d(distances)
+    n = distances.shape[1]
+
+    if k is None or k >= n:
+        return np.argsort(distances, axis=1, kind='stable')
+
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+    result = np.zeros((distances.shape[0], k), dtype=np.int64)
+    for q, row in enumerate(distances):
+        if np.isnan(kth[q]):
+            result[q] = np.argsort(row, kind='stable')[:k]
+            continue
+        # Every value up to the k-th one (also the ties of the k-th value), in index order.
+        candidates = np.flatnonzero(row <= kth[q])
+        result[q] = candidates[np.argsort(row[candidates], kind='stable')[:k]]
+    return result
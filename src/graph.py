@@ -1,41 +1,97 @@
 import numpy as np
 
+from transitions import shortestPaths
+
 class Graph():
     """
     example data
         vertices = {'a', 'b', 'c', ...}
         edges = {'a' = {'b', 'c'}, ...}
+
+    Vertices are looked up by name in a dict (name -> index), the adjacency is also
+    kept as CSR arrays (indptr, indices). The CSR arrays and the connectivity/distance
+    matrices are built once and cached until the graph changes.
+
+    Graph files (see load) hold one line per vertex, in index order:
+        <vertex>: <adjacent vertices>
+    every edge is listed once, lines starting with # are comments.
     """
 
     def __init__(self, vertices = [], edges=[]):
         self.vertices = []
+        self.index = {}
         self.edges = {}
+        self._cache = {}
         for v in vertices:
             self.addVertice(v)
-        for e in edges:
-            self.addEdges()
+        self.addEdges(edges)
+
+    @staticmethod
+    def load(path):
+        vertices = []
+        edges = []
+        with open(path) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if len(line) == 0:
+                    continue
+                vertice, adjacent = line.split(':', 1)
+                vertices.append(vertice.strip())
+                edges.extend((vertices[-1], e) for e in adjacent.split())
+        return Graph(vertices, edges)
+
+    def save(self, path):
+        # Every edge on the line of the vertex that comes first.
+        with open(path, 'w') as f:
+            for i, v in enumerate(self.vertices):
+                adjacent = [e for e in dict.fromkeys(self.edges[v]) if self.index[e] >= i]
+                f.write(v + ':' + ''.join(' ' + e for e in adjacent) + '\n')
 
     def addVertice(self, vertice):
+        self.index[vertice] = len(self.vertices)
         self.vertices.append(vertice)
         self.edges[vertice] = []
-    
+        self._cache = {}
+
     def addEdges(self, edges):
         for e in edges:
             self.edges[e[0]].append(e[1])
             self.edges[e[1]].append(e[0])
-    
+        self._cache = {}
+
     def getVertices(self) -> list:
         return self.vertices
 
     def getEdges(self) -> dict:
         return self.edges
-    
+
+    def indexOf(self, vertice) -> int:
+        return self.index[vertice]
+
+    @property
+    def csr(self):
+        # (indptr, indices) of the adjacency, the neighbours of every vertex sorted on index.
+        if 'csr' not in self._cache:
+            length = len(self.vertices)
+            rows = np.repeat(np.arange(length, dtype=np.int64), [len(self.edges[v]) for v in self.vertices])
+            columns = np.array([self.index[e] for v in self.vertices for e in self.edges[v]], dtype=np.int64)
+            keys = np.unique(rows * length + columns)
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // length, minlength=length))])
+            self._cache['csr'] = (indptr, keys % length)
+        return self._cache['csr']
+
     def getConnectivityMatrix(self):
-        vertices = self.getVertices()
-        matrix = []
-        for v in vertices:
-            row = np.zeros(len(vertices))
-            for e in self.edges[v]:
-                row[vertices.index(e)]=1
-            matrix.append(row)
-        return matrix
\ No newline at end of file
+        # Cached, do not modify the returned matrix.
+        if 'connectivity' not in self._cache:
+            indptr, indices = self.csr
+            matrix = np.zeros((len(self.vertices), len(self.vertices)))
+            matrix[np.repeat(np.arange(len(self.vertices)), np.diff(indptr)), indices] = 1
+            self._cache['connectivity'] = matrix
+        return self._cache['connectivity']
+
+    def getDistanceMatrix(self, max_dist=None):
+        # Hop distances between all vertices, -1 if unreachable (in max_dist hops). Cached.
+        key = ('distances', max_dist)
+        if key not in self._cache:
+            self._cache[key] = shortestPaths(self.csr, max_dist)
+        return self._cache[key]
@@ -1,29 +1,108 @@
-from cv2 import normalize
+from transitions import SparseTransitions, csr_adjacency, neighbourhoods, shortestPaths
 from util import generate_graph
 import numpy as np
+import hashlib
 import math
+import os
+import warnings
+
+# The room that was predicted in the previous frame keeps at least this observation probability.
+PREV_BEST_FLOOR = 0.02
+
+# Built transition matrices and stationary distributions, keyed on graph_key.
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'hmm_cache')
+CACHE_VERSION = '1'
 
 class HMM():
-    def __init__(self, hidden_layers) -> None:
+    def __init__(self, hidden_layers, log_space=False, stat_distr=None, beam=None) -> None:
+        """
+        - hidden_layers: (rooms, rooms) transition matrix, row j holds the probabilities
+                         of moving from room j to every room.
+        - log_space: keep the forward state as log probabilities (no underflow on long
+                     sequences or very small observation probabilities).
+        - stat_distr: stationary distribution of the transition matrix if it is known
+                      (e.g. cached by build), computed otherwise.
+        - beam: only the beam most probable rooms are kept (and propagated) every
+                step (None = all rooms).
+        """
+
         self.hidden_layers = hidden_layers
-        self.stat_distr = self.__calculateStationaryDistribution()
+        if isinstance(hidden_layers, SparseTransitions):
+            self.transitions = hidden_layers
+        else:
+            self.transitions = np.asarray(hidden_layers, dtype=np.float64)
+        self.log_space = log_space
+        self.beam = beam
+
+        if stat_distr is None:
+            stat_distr = self.__calculateStationaryDistribution()
+        self.stat_distr = np.asarray(stat_distr, dtype=np.float64)
         self.prev_X = None
         self.prob_arr = self.stat_distr.copy()
         self.prev_best = None
         self.normalized_prob_arr = self.stat_distr.copy()
+        with np.errstate(divide='ignore'):
+            self.log_prob_arr = np.log(self.prob_arr)
     
     @staticmethod
-    def build(connectivityMatrix, distribution='gaussian', mu=0, sigma=1, max_dist=11):
-        dm = createDistanceMatrix(connectivityMatrix)
-        if distribution == 'linear':
-            matrix = createLinearDistributionMatrix(dm)
-        elif distribution == 'gaussian':
-            matrix = createGaussianDistributionMatrix(dm, mu, sigma, max_dist)
-        return HMM(matrix)
+    def build(connectivityMatrix, distribution='gaussian', mu=0, sigma=1, max_dist=11, log_space=False, cache_dir=CACHE_DIR,
+              sparse=False, beam=None):
+        """
+        HMM over the rooms of a graph, the transition probabilities follow a linear or
+        gaussian distribution of the hop distance between rooms. The transition matrix
+        and its stationary distribution are cached in cache_dir (None = no cache).
+
+        sparse: CSR transition matrix over the neighbourhoods of max_dist hops (gaussian
+        only, the linear distribution gives every pair of rooms a probability).
+        """
+
+        if distribution not in ('linear', 'gaussian'):
+            raise ValueError('Unknown distribution {}'.format(distribution))
+        if sparse and distribution != 'gaussian':
+            raise ValueError('Sparse transitions need the gaussian distribution')
+
+        key = graph_key(connectivityMatrix, distribution, mu, sigma, max_dist, sparse)
+        cache_path = None if cache_dir is None else os.path.join(cache_dir, key + '.npz')
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                if sparse:
+                    matrix = SparseTransitions(cached['indptr'], cached['indices'], cached['data'])
+                else:
+                    matrix = cached['transitions']
+                return HMM(matrix, log_space, stat_distr=cached['stat_distr'], beam=beam)
+
+        if sparse:
+            indptr, indices, distances = neighbourhoods(connectivityMatrix, max_dist - 1)
+            weights = np.array(getGaussianDistribution(mu, sigma, max_dist))[distances]
+            sums = np.add.reduceat(weights, indptr[:-1])
+            matrix = SparseTransitions(indptr, indices, weights / np.repeat(sums, np.diff(indptr)))
+            # Symmetric weights if every neighbourhood contains its neighbours (undirected graph).
+            key_pairs = np.sort(matrix.rows * len(matrix) + indices)
+            symmetric = np.array_equal(key_pairs, np.sort(indices * len(matrix) + matrix.rows))
+            hmm = HMM(matrix, log_space, stat_distr=sums / sums.sum() if symmetric else None, beam=beam)
+            arrays = {'indptr': indptr, 'indices': indices, 'data': matrix.data}
+        else:
+            if distribution == 'linear':
+                weights = linearWeights(shortestPaths(connectivityMatrix))
+            else:
+                # Only the distances below max_dist have a weight.
+                weights = gaussianWeights(shortestPaths(connectivityMatrix, max_dist - 1), mu, sigma, max_dist)
+            hmm = HMM(normalize_rows(weights), log_space, stat_distr=symmetricStationaryDistribution(weights), beam=beam)
+            arrays = {'transitions': hmm.transitions}
+
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(cache_path + '.tmp', 'wb') as f:
+                    np.savez(f, stat_distr=hmm.stat_distr, **arrays)
+                os.replace(cache_path + '.tmp', cache_path)
+            except OSError as e:
+                warnings.warn('Could not cache the HMM in {}: {}'.format(cache_dir, e))
+        return hmm
     
     def getOptimalPrediction(self, frame_room_prob, forward=True):
         ## Return False if list isn't same size
-        if len(frame_room_prob) != len(self.hidden_layers):
+        if len(frame_room_prob) != len(self.transitions):
             return False
         
         if forward:        
@@ -32,14 +111,39 @@ class HMM():
             best_pred = self.__predictWithoutSequence(frame_room_prob)
         return best_pred
     
-    def __calculateStationaryDistribution(self):
-        matrix_transposed = np.array(self.hidden_layers).T
-        eigenvals, eigenvects = np.linalg.eig(matrix_transposed)
+    def __calculateStationaryDistribution(self, tolerance=1e-12, max_iterations=10000):
+        # Power iteration, the eigendecomposition is only used if it does not converge
+        # (e.g. a periodic chain).
+        stat_distr = np.full(len(self.transitions), 1 / len(self.transitions))
+        for _ in range(max_iterations):
+            previous = stat_distr
+            stat_distr = self.propagate(previous)
+            stat_distr /= stat_distr.sum()
+            if np.abs(stat_distr - previous).max() < tolerance:
+                return stat_distr
+
+        transitions = self.transitions.toarray() if isinstance(self.transitions, SparseTransitions) else self.transitions
+        eigenvals, eigenvects = np.linalg.eig(transitions.T)
         idx = np.isclose(eigenvals, 1)
         target_eigenvect = eigenvects[:, idx]
         target_eigenvect = target_eigenvect[:, 0]
         stat_distr = target_eigenvect / sum(target_eigenvect)
-        return stat_distr
+        # The eigenvector of a real matrix can come back as complex with zero imaginary part.
+        return np.real(stat_distr)
+
+    def propagate(self, state, rows=None):
+        # state @ transitions, only the given rows of the matrix are read (default: all).
+        if isinstance(self.transitions, SparseTransitions):
+            return self.transitions.propagate(state, rows)
+        if rows is None:
+            return state @ self.transitions
+        return state[rows] @ self.transitions[rows]
+
+    def backpropagate(self, x):
+        # transitions @ x
+        if isinstance(self.transitions, SparseTransitions):
+            return self.transitions.dot(x)
+        return self.transitions @ x
 
     def __predictWithoutSequence(self, frame_room_prob):
         best_pred = (0, None)
@@ -58,59 +162,196 @@ class HMM():
         self.prev_X = best_pred[1]
         return best_pred
 
+    def step(self, state, prev_best, room_prob, log_space=None):
+        """
+        One forward step: state' = obs * (state @ transitions), normalized.
+
+        - state: probabilities (or log probabilities in log space) of the previous step.
+        - prev_best: room predicted in the previous step (None at the start).
+
+        Returns the new state, the best room (None if every room has probability 0)
+        and its unnormalized probability. A step without any probability keeps the state.
+        In beam mode only the rooms in the beam are propagated and kept.
+        """
+
+        log_space = self.log_space if log_space is None else log_space
+        rows = None
+        if self.beam is not None and len(state) > self.beam:
+            rows = np.flatnonzero(np.isfinite(state) if log_space else state > 0)
+        obs = np.array(room_prob, dtype=np.float64)
+        ## Previous prediction has min probability of 2%
+        if prev_best is not None and obs[prev_best] == 0:
+            obs[prev_best] = PREV_BEST_FLOOR
+
+        if log_space:
+            # log(exp(state) @ transitions) with the largest state shifted to 0 so the
+            # product can not underflow.
+            shift = np.max(state)
+            if not np.isfinite(shift):
+                return state, None, 0
+            with np.errstate(divide='ignore'):
+                new = np.log(obs) + np.log(self.propagate(np.exp(state - shift), rows)) + shift
+            new = self.prune(new, -np.inf)
+            best = int(np.argmax(new))
+            if not np.isfinite(new[best]):
+                return state, None, 0
+            total = new[best] + np.log(np.exp(new - new[best]).sum())
+            return new - total, best, float(np.exp(new[best]))
+
+        new = self.prune(obs * self.propagate(state, rows), 0)
+        total = new.sum()
+        if total <= 0:
+            return state, None, 0
+        best = int(np.argmax(new))
+        return new / total, best, float(new[best])
+
+    def prune(self, state, empty):
+        # Beam mode: every room outside the beam most probable rooms gets `empty`.
+        if self.beam is None or len(state) <= self.beam:
+            return state
+        keep = np.argpartition(-state, self.beam - 1)[:self.beam]
+        pruned = np.full(len(state), empty, dtype=np.float64)
+        pruned[keep] = state[keep]
+        return pruned
+
     ## Forward algorithm    
     def __forward(self, room_prob):
-        global_max = (0, None)
-        total_sum = 0
-        for i, p in enumerate(room_prob):
-            ## Previous prediction has min probability of 2%
-            if (i == self.prev_best) & (p == 0):
-                p = 0.02
-            new_room_prob = 0
-            for j, prev_prob in enumerate(self.prob_arr):
-                next_p = prev_prob * self.hidden_layers[j][i] * p
-                new_room_prob += next_p
-            self.prob_arr[i] = new_room_prob
-            total_sum += new_room_prob
-            if new_room_prob > global_max[0]:
-                global_max = (new_room_prob, i)
-        self.normalize_array(self.prob_arr, total_sum)
-        self.prev_best = global_max[1]
-        return global_max
+        state = self.log_prob_arr if self.log_space else self.prob_arr
+        state, best, value = self.step(state, self.prev_best, room_prob)
+        if best is None:
+            return (0, None)
+
+        if self.log_space:
+            self.log_prob_arr = state
+            self.prob_arr = np.exp(state)
+        else:
+            self.prob_arr = state
+        self.prev_best = best
+        return (value, best)
+
+    def forward_sequence(self, observations, log_space=None):
+        """
+        Forward algorithm over a (T, rooms) observation matrix, e.g. an offline run over
+        a full video. Starts from the current state and leaves it unchanged.
+
+        Returns the (T, rooms) normalized forward probabilities and the best room of
+        every step (-1 for steps without any probability).
+        """
+
+        log_space = self.log_space if log_space is None else log_space
+        observations = np.asarray(observations, dtype=np.float64)
+
+        if log_space:
+            with np.errstate(divide='ignore'):
+                state = np.log(self.prob_arr)
+        else:
+            state = np.asarray(self.prob_arr, dtype=np.float64)
+        prev_best = self.prev_best
+
+        probabilities = np.zeros(observations.shape, dtype=np.float64)
+        best_rooms = np.full(len(observations), -1, dtype=np.int64)
+        for t, room_prob in enumerate(observations):
+            state, best, _ = self.step(state, prev_best, room_prob, log_space)
+            probabilities[t] = np.exp(state) if log_space else state
+            if best is not None:
+                best_rooms[t] = prev_best = best
+        return probabilities, best_rooms
+
+    def emissions(self, observations, emission_floor=1e-3):
+        """
+        Observation probabilities of a (T, rooms) matrix of room odds (see
+        Localiser.calculateRoomOdds). Rows without any odds (frames without a match)
+        do not favour any room, every room keeps at least emission_floor so a room
+        without a match in one frame is unlikely instead of impossible.
+        """
+
+        observations = np.nan_to_num(np.asarray(observations, dtype=np.float64))
+        empty = observations.sum(axis=1) <= 0
+        observations[empty] = 1
+        return np.maximum(observations, emission_floor)
+
+    def forward_backward(self, observations, emission_floor=1e-3):
+        """
+        Smoothed posteriors P(room at t | all frames) of a (T, rooms) matrix of room odds.
+        Scaled forward-backward: every step is normalized, no underflow on long videos.
+        """
+
+        emissions = self.emissions(observations, emission_floor)
+        T = len(emissions)
+        alpha = np.zeros(emissions.shape, dtype=np.float64)
+        scales = np.zeros(T, dtype=np.float64)
+        if T == 0:
+            return alpha
+
+        alpha[0] = self.stat_distr * emissions[0]
+        scales[0] = alpha[0].sum()
+        alpha[0] /= scales[0]
+        for t in range(1, T):
+            alpha[t] = emissions[t] * self.propagate(alpha[t - 1])
+            scales[t] = alpha[t].sum()
+            alpha[t] /= scales[t]
+
+        beta = np.ones(emissions.shape, dtype=np.float64)
+        for t in range(T - 2, -1, -1):
+            beta[t] = self.backpropagate(emissions[t + 1] * beta[t + 1]) / scales[t + 1]
+
+        posteriors = alpha * beta
+        return posteriors / posteriors.sum(axis=1, keepdims=True)
+
+    def viterbi(self, observations, emission_floor=1e-3):
+        """
+        Most likely room path of a (T, rooms) matrix of room odds.
+        Returns the (T,) room indices and the log probability of the path.
+        """
+
+        log_emissions = np.log(self.emissions(observations, emission_floor))
+        T, rooms = log_emissions.shape
+        if T == 0:
+            return np.zeros(0, dtype=np.int64), 0.0
+
+        sparse = isinstance(self.transitions, SparseTransitions)
+        with np.errstate(divide='ignore'):
+            log_transitions = None if sparse else np.log(self.transitions)
+            delta = np.log(self.stat_distr) + log_emissions[0]
+
+        # Backpointers are the only (T, rooms) array, int32 keeps hour-long videos small.
+        backpointers = np.zeros((T, rooms), dtype=np.int32)
+        for t in range(1, T):
+            if sparse:
+                delta, backpointers[t] = self.transitions.best_predecessors(delta)
+            else:
+                scores = delta[:, None] + log_transitions
+                backpointers[t] = np.argmax(scores, axis=0)
+                delta = scores[backpointers[t], np.arange(rooms)]
+            delta = delta + log_emissions[t]
+
+        path = np.zeros(T, dtype=np.int64)
+        path[-1] = np.argmax(delta)
+        for t in range(T - 1, 0, -1):
+            path[t - 1] = backpointers[t, path[t]]
+        return path, float(delta[path[-1]])
 
     def normalize_array(self, arr, sum_total):
-        for i, prob in enumerate(arr):
-            self.prob_arr[i] = prob/sum_total
+        self.prob_arr = np.asarray(arr) / sum_total
         
 ### -- End class -- ##
 
-## Floyd Warshall
 def createDistanceMatrix(connectivityMatrix):
-    length = len(connectivityMatrix)
-    dm = [row.copy() for row in connectivityMatrix]
-    for k in range(0, length):
-        for i in range(0, length):
-            for j in range(0, length):
-                if ((i != k) & (dm[i][k] == 0)) | ((k != j) & (dm[k][j] == 0)) | (i == j) :
-                    continue
-                target = dm[i][j]
-                if target == 0:
-                    target = 999
-                if dm[i][k] + dm[k][j] < target:
-                    dm[i][j] = dm[i][k] + dm[k][j]
-    return dm
+    # Unreachable rooms get distance 0, like the Floyd Warshall this replaced.
+    return np.maximum(shortestPaths(connectivityMatrix), 0).astype(np.float64)
+
+def normalize_rows(weights):
+    # Sequential sum per row (cumsum), identical to summing the elements one by one.
+    return weights / np.cumsum(weights, axis=1)[:, -1:]
+
+def linearWeights(distanceMatrix):
+    # Rooms that can not be reached (distance < 0) get weight 0.
+    dm = np.asarray(distanceMatrix, dtype=np.float64)
+    weights = dm.max(axis=1, keepdims=True) - dm + 1
+    return np.where(dm >= 0, weights, 0)
 
 def createLinearDistributionMatrix(distanceMatrix):
-    wm = [row.copy() for row in distanceMatrix]
-    for row in wm:
-        dist_max = max(row)
-        sum = 0
-        for i, dist in enumerate(row):
-            new_val = dist_max - dist + 1
-            row[i] = new_val
-            sum += new_val
-        row /= sum
-    return wm
+    return normalize_rows(linearWeights(distanceMatrix))
 
 def getGaussianDistribution(mu, sigma, max):
     distr = []
@@ -119,19 +360,36 @@ def getGaussianDistribution(mu, sigma, max):
         distr.append(math.exp(z*z*-1/2)/math.sqrt(2*math.pi))
     return distr
 
+def gaussianWeights(distanceMatrix, mu=0, sigma=1, max_dist=15):
+    # Rooms further than max_dist hops or unreachable (distance < 0) get weight 0.
+    gauss_distr = np.array(getGaussianDistribution(mu, sigma, max_dist) + [0.0])
+    dm = np.asarray(distanceMatrix).astype(np.int64)
+    dm[(dm < 0) | (dm >= max_dist)] = max_dist
+    return gauss_distr[dm]
 
 def createGaussianDistributionMatrix(distanceMatrix, mu=0, sigma=1, max_dist=15):
-    gauss_distr = getGaussianDistribution(mu, sigma, max_dist)
-    wm = [row.copy() for row in distanceMatrix]
-    for row in wm:
-        #dist_max = max(row)
-        sum = 0
-        for i, dist in enumerate(row):
-            new_val = gauss_distr[int(dist)]
-            row[i] = new_val
-            sum += new_val
-        row /= sum
-    return wm
+    return normalize_rows(gaussianWeights(distanceMatrix, mu, sigma, max_dist))
+
+def symmetricStationaryDistribution(weights):
+    """
+    Stationary distribution of the transition matrix normalize_rows(weights) if the
+    weights are symmetric (detailed balance: pi[i] ~ sum of row i), None otherwise.
+    """
+
+    weights = np.asarray(weights, dtype=np.float64)
+    if not np.array_equal(weights, weights.T):
+        return None
+    sums = weights.sum(axis=1)
+    return sums / sums.sum()
+
+def graph_key(connectivityMatrix, *parameters):
+    # Hash of the graph structure and the parameters of the transition matrix.
+    indptr, indices = csr_adjacency(connectivityMatrix)
+    sha1 = hashlib.sha1(CACHE_VERSION.encode())
+    sha1.update(indptr.tobytes())
+    sha1.update(indices.tobytes())
+    sha1.update(repr(parameters).encode())
+    return sha1.hexdigest()
 
 def printMatrix(matrix):
     for row in matrix:
@@ -0,0 +1,92 @@
+import numpy as np
+import time
+import warnings
+
+"""
+Low overhead inference for the Keras networks.
+
+model.predict sets up the full training-loop machinery (data adapter, callbacks,
+step function) on every call, which costs more than the forward pass of a single
+crop. InferenceModel traces the forward pass once as a tf.function with a fixed input
+signature (only the batch size is variable), runs a warmup pass at startup and keeps
+latency statistics of every call.
+
+TensorFlow is only imported when it is used, like in matcher.py.
+"""
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Size the TensorFlow thread pools (None = TensorFlow default). Only possible before
+    TensorFlow executed its first operation, later calls with other values are ignored.
+    """
+
+    import tensorflow as tf
+
+    try:
+        if intra_op_threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        if (intra_op_threads not in (None, tf.config.threading.get_intra_op_parallelism_threads())
+                or inter_op_threads not in (None, tf.config.threading.get_inter_op_parallelism_threads())):
+            warnings.warn('TensorFlow is already initialized, the thread pool sizes can not be changed.')
+
+class InferenceModel():
+    def __init__(self, model, batch_size=32, warmup=True):
+        """
+        - model: Keras model with a (None, h, w, c) input.
+        - batch_size: maximum amount of images per forward pass.
+        - warmup: run the traced function once so the first real call is not slower.
+        """
+
+        import tensorflow as tf
+
+        self.model = model
+        self.batch_size = batch_size
+        self.input_shape = tuple(model.input_shape[1:])
+
+        # Traced once, every call with another batch size reuses the same graph.
+        self.forward = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec((None,) + self.input_shape, tf.float32)])
+
+        self.calls = 0
+        self.images = 0
+        self.latencies = []     # seconds per image of every call
+
+        if warmup:
+            self.forward(tf.zeros((1,) + self.input_shape, tf.float32))
+
+    def __call__(self, x, batch_size=None):
+        batch_size = self.batch_size if batch_size is None else batch_size
+        x = np.asarray(x, dtype=np.float32)
+
+        tic = time.perf_counter()
+        outputs = [self.forward(x[start:start + batch_size]).numpy() for start in range(0, len(x), batch_size)]
+        elapsed = time.perf_counter() - tic
+
+        if len(x) > 0:
+            self.calls += 1
+            self.images += len(x)
+            self.latencies.append(elapsed / len(x))
+
+        if len(outputs) == 0:
+            return np.zeros((0,) + tuple(self.model.output_shape[1:]), dtype=np.float32)
+        return np.concatenate(outputs)
+
+    def reset_stats(self):
+        self.calls = 0
+        self.images = 0
+        self.latencies = []
+
+    def stats(self):
+        # Latency per image (crop) in milliseconds.
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'calls': self.calls,
+            'images': self.images,
+            'mean_ms': float(latencies.mean()) if len(latencies) > 0 else 0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) > 0 else 0,
+            'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) > 0 else 0,
+        }
@@ -6,7 +6,7 @@ import os
 from matcher import PaintingMatcher
 from detector import PaintingDetector
 from hmm import HMM
-from preprocessing import FrameProcessor
+from sharpness import HaarGate
 from util import (
     generate_graph,
     rectify_contour
@@ -16,29 +16,40 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
 class Localiser():
 
-    def __init__(self, matcher, graph=None, hmm_distribution='linear') -> None:
+    def __init__(self, matcher, graph=None, hmm_distribution='linear', pruning=None, record_odds=False, sharpness_gate=None) -> None:
         self.matcher = matcher
+        # Crops that do not pass the gate are not matched (default: the Haar blur detection).
+        self.sharpness_gate = HaarGate() if sharpness_gate is None else sharpness_gate
+        # Optional PriorPruning, searches the likely rooms before the full DB.
+        self.pruning = pruning
+        # Room odds of every frame (zeros without a match), for offline decoding.
+        self.odds = [] if record_odds else None
         self.previous = "..."
         if graph == None:
             graph = generate_graph()
         self.graph = graph
         self.connectivity_matrix = self.graph.getConnectivityMatrix()
-        self.hmm = HMM.build(self.connectivity_matrix, hmm_distribution)
+        self.hmm = HMM.build(self.graph.csr, hmm_distribution)
     
     def localise(self, image, contours_list=[], display=False, max_room_matches=0):
+        self.matcher.next_frame()
         if len(contours_list) == 0:
+            self.record(None)
             return self.previous
 
-        dist_list = []
+        crops = []
         for contour in contours_list:
             affine_image,crop_img = rectify_contour(contour, image, display=display)
             
             # Don't try to match contour if it's blurry.
             # Results are most likely wrong anyway.
-            if FrameProcessor.sharpness_metric(crop_img):
+            if self.sharpness_gate.is_blurred(crop_img):
                 continue
+            crops.append(crop_img)
 
-            soft_matches = self.matcher.match(crop_img,display=True)
+        # All crops of the frame go through the network in one batch.
+        dist_list = []
+        for soft_matches in self.match_crops(crops):
             if len(soft_matches) == 0:
                 continue
             contour_room_dist = self.getMatchingDistances(soft_matches, max=max_room_matches)
@@ -46,10 +57,12 @@ class Localiser():
 
         # Return previous result if there are no matches
         if len(dist_list) == 0:
+            self.record(None)
             return self.previous
         
         # Calculate the chance that the frame is located in a room (for every room)
         room_odds = self.calculateRoomOdds(dist_list)
+        self.record(room_odds)
 
         room_pred = self.hmm.getOptimalPrediction(room_odds, forward=True)
         if room_pred is None or room_pred[1] is None:
@@ -58,37 +71,82 @@ class Localiser():
         self.previous = self.graph.getVertices()[room_pred[1]]
         return self.previous
     
+    def record(self, room_odds):
+        if self.odds is None:
+            return
+        if room_odds is None:
+            room_odds = np.zeros(len(self.connectivity_matrix), np.float32)
+        self.odds.append(room_odds)
+
+    def decode(self, odds=None):
+        """
+        Offline decoding of a whole video: the recorded room odds (or a (T, rooms)
+        matrix of odds) of every frame. Returns the Viterbi room path (vertex names)
+        and the (T, rooms) smoothed posteriors of forward-backward.
+        """
+
+        odds = self.odds if odds is None else odds
+        odds = np.asarray(odds, dtype=np.float64).reshape(-1, len(self.connectivity_matrix))
+
+        path, _ = self.hmm.viterbi(odds)
+        vertices = self.graph.getVertices()
+        return [vertices[i] for i in path], self.hmm.forward_backward(odds)
+
+    @property
+    def row_rooms(self):
+        # Graph vertex of every DB row.
+        return self.matcher.room_vertices(self.graph.getVertices())
+
+    def match_crops(self, crops):
+        if self.pruning is None or len(crops) == 0:
+            return self.matcher.match_batch(crops,display=True)
+
+        # Rooms that are likely before this frame (posterior of the previous frames).
+        rooms = self.pruning.rooms(self.hmm.prob_arr, self.connectivity_matrix)
+        rows = np.flatnonzero(np.isin(self.row_rooms, rooms))
+        results = self.matcher.match_batch(crops,display=True,rows=rows)
+
+        retry = [i for i, matches in enumerate(results) if not self.pruning.confident(matches)]
+        if len(retry) > 0:
+            for i, matches in zip(retry, self.matcher.match_batch([crops[i] for i in retry],display=True)):
+                results[i] = matches
+
+        if self.pruning.verify:
+            confident = [i for i in range(len(crops)) if i not in retry]
+            for i, matches in zip(confident, self.matcher.match_batch([crops[i] for i in confident])):
+                self.pruning.record_verification(results[i], matches)
+
+        self.pruning.record(len(crops), len(retry), len(rows), len(self.row_rooms))
+        return results
+
     def calculateRoomOdds(self, distance_list):
-        if len(distance_list) > 1:
-            for contour_room_dist in distance_list[1:]:
-                distance_list[0] += contour_room_dist
-
-        max_dist = max(distance_list[0])
-        dist_sum = 0
-        for i, val in enumerate(distance_list[0]):
-            if val != 0:
-                new_val = (max_dist - val + 1)
-                distance_list[0][i] = new_val
-                dist_sum += new_val
-        distance_list[0]/=dist_sum
-        return distance_list[0]
-            
+        # Summed room distances of all contours, inverted (best room = highest odds)
+        # and normalized. Rooms without a match keep odds 0.
+        total = np.add.reduce(np.asarray(distance_list, dtype=np.float32), axis=0)
+
+        odds = np.where(total != 0, total.max() - total + 1, 0).astype(np.float32)
+        if not odds.any():
+            # No room has a match: every room is equally likely.
+            return np.full(len(odds), 1 / len(odds), dtype=np.float32)
+        # Sequential float32 sum (cumsum), identical to accumulating the odds one by one.
+        odds /= np.cumsum(odds[odds != 0], dtype=np.float32)[-1]
+        return odds
 
     def getMatchingDistances(self, soft_matches, max=3):
+        # Distance + 1 of the best match of the first `max` rooms in the ranking.
         if max == 0:
             max = len(self.connectivity_matrix)
         room_dist_list = np.zeros(len(self.connectivity_matrix), np.float32)
-        room_count = 0
-        idx = 0
-        while (room_count < max) & (idx < len(soft_matches)):
-            m = soft_matches[idx]
-            room = self.matcher.get_room(m[0])
-            room_name = room.split("_")[1]
-            matrix_index = self.graph.getVertices().index(room_name)
-            if room_dist_list[matrix_index] == 0:
-                room_dist_list[matrix_index] = m[1]+1
-                room_count +=1
-            idx+=1
+        if len(soft_matches) == 0:
+            return room_dist_list
+
+        ranked = np.asarray(soft_matches, dtype=np.float64)
+        rooms = self.row_rooms[ranked[:, 0].astype(np.int64)]
+
+        # First (= best) occurrence of every room, the rooms that come first in the ranking.
+        _, first = np.unique(rooms, return_index=True)
+        first = np.sort(first)[:max]
+        room_dist_list[rooms[first]] = ranked[first, 1] + 1
         return room_dist_list
 
     @property
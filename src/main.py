@@ -1,15 +1,19 @@
 from ast import Mod
 import cv2
-import sys
+import argparse
 import numpy as np
 import pandas as pd
 
-from util import resize_with_aspectratio, vertices, room_center_coords
-from detector import PaintingDetector
+from util import vertices, room_center_coords
+from detector import PaintingDetector, DETECTOR_WIDTH
 from matcher import PaintingMatcher
 from matcher import Mode
+from cache import MatchCache
+from cascade import Cascade
+from pruning import PriorPruning
 from localiser import Localiser
-from preprocessing import FrameProcessor
+from preprocessing import FrameProcessor, FrameContext
+from sharpness import HaarGate
 from enum import Enum
 
 
@@ -78,23 +82,35 @@ def create_map(room_pred, plan, file_path, visited_rooms):
     cv2.imshow('HMM Visualization', blended_im)
 
 def main():
-    if len(sys.argv) != 7:
-        raise ValueError('Provide paths to the video, calibration file and the database file')
-    
     # CLI arguments
-    # TODO: use parser
-    video_path = sys.argv[1]
-    calibration_file = sys.argv[2]
-    database_file = sys.argv[3]
-    csv_path = sys.argv[4]
-    map_path = sys.argv[5]
-    map_contour_file = sys.argv[6]
+    parser = argparse.ArgumentParser(description='Localise a museum visitor in a video')
+    parser.add_argument('video', help='Path to the video', type=str)
+    parser.add_argument('calibration', help='Path to the GoPro calibration file', type=str)
+    parser.add_argument('database', help='Path to the database images', type=str)
+    parser.add_argument('csv', help='Path to the keypoint CSV', type=str)
+    parser.add_argument('map', help='Path to the ground plan image', type=str)
+    parser.add_argument('map_contours', help='Path to the room polygons of the ground plan', type=str)
+    parser.add_argument('--pruning', help='Search the rooms that are likely under the HMM posterior first', action='store_true')
+    parser.add_argument('--cascade', help='Adaptive ORB re-rank of the fvector candidates (combination modes)', action='store_true')
+    parser.add_argument('--cache', help='Reuse the matches of crops that stay visible over consecutive frames', action='store_true')
+    args = parser.parse_args()
+
+    video_path = args.video
+    calibration_file = args.calibration
+    database_file = args.database
+    csv_path = args.csv
+    map_path = args.map
+    map_contour_file = args.map_contours
 
     is_gopro = False
 
     MAC = False
     FEATURES = 100
 
+    # Cache for the matches of crops that are visible in consecutive frames.
+    CACHE_SIZE = 64
+    CACHE_TTL = 30 # frames
+
     # Matching mode
     #mode = Mode.ORB
     #mode = Mode.FVECTOR_EUCLIDEAN
@@ -110,10 +126,15 @@ def main():
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
     # Create pipeline instances
+    # GoPro frames are undistorted and cropped in one remap. The matcher crops the paintings
+    # from the full resolution frame, the detector gets a second remap to its own width.
     preproc = FrameProcessor(calibration_file, (width, height))
+    detector_preproc = FrameProcessor(calibration_file, (width, height), width=DETECTOR_WIDTH)
     detector = PaintingDetector()
-    matcher = PaintingMatcher(csv_path, database_file, features=FEATURES, mode=mode, MAC=MAC)
-    localiser = Localiser(matcher=matcher, hmm_distribution='gaussian')
+    matcher = PaintingMatcher(csv_path, database_file, features=FEATURES, mode=mode, MAC=MAC, cache=MatchCache(CACHE_SIZE, CACHE_TTL) if args.cache else None, cascade=Cascade() if args.cascade else None)
+    localiser = Localiser(matcher=matcher, hmm_distribution='gaussian', pruning=PriorPruning() if args.pruning else None)
+    # Gate on the frame sharpness (LaplacianGate and TenengradGate are cheaper, see benchmark.py --what sharpness).
+    sharpness_gate = HaarGate()
 
     # For map visualization
     map_img = cv2.imread(map_path)
@@ -127,19 +148,23 @@ def main():
         if not success:
             break
 
+        # Resized and grayscale versions of the frame, shared by every stage.
+        context = FrameContext(img)
+
         # Pass frame to processing pipeline if sharpness metric is within bounds.
-        is_blurred = FrameProcessor.sharpness_metric(img, print_metric=False)
+        is_blurred = sharpness_gate.is_blurred(context)
         if is_blurred:
-            cv2.imshow('Video', resize_with_aspectratio(img, width=500))
+            cv2.imshow('Video', context.resized(DETECTOR_WIDTH))
         else:
             # For videos taken with GoPro camera
             if is_gopro: 
-                img = preproc.undistort(img)
+                context = FrameContext(preproc.undistort(img), resized={DETECTOR_WIDTH: detector_preproc.undistort(img)})
 
-            detector.img = img
+            detector.img = context
             contour_results, img_with_contours = detector.contours(display=False)
 
-            room_prediction = localiser.localise(img, contour_results, display=False)
+            # The detector scales the contours back to the coordinates of the frame.
+            room_prediction = localiser.localise(context.image, contour_results, display=False)
             cv2.imshow('Video', img_with_contours)
 
             # Visualize output of the hidden markov model.
@@ -150,5 +175,14 @@ def main():
             cv2.destroyAllWindows()
             break
 
+    if matcher.cache is not None:
+        print('Match cache: {}'.format(matcher.cache.stats()))
+    if localiser.pruning is not None:
+        print('Search pruning: {}'.format(localiser.pruning.stats()))
+    if matcher.cascade is not None:
+        print('Cascade: {}'.format(matcher.cascade.stats()))
+    if matcher._neuralnet is not None:
+        print('Inference: {}'.format(matcher.neuralnet.inference.stats()))
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
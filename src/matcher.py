@@ -6,22 +6,37 @@ import os
 from enum import Enum
 
 import json
-import scipy
 import time
 
-from PIL import Image
 #from torch.autograd import Variable as V
 
 from util import resize_with_aspectratio
 from util import printProgressBar
-
-import tensorflow as tf
-
-from keras.applications.imagenet_utils import decode_predictions, preprocess_input
-from keras.models import Model
-from tensorflow.keras.applications.vgg16 import VGG16
-from scipy.spatial import distance
-from keras.preprocessing import image
+from database import PaintingDatabase
+from distances import Distance, FvectorEngine
+from compression import CompressedEngine
+from ann import IVFPQIndex, fingerprint
+from orb_index import ORBIndex, cross_check_scores, rank_scores
+from partitions import PartitionedIndex
+import builder
+from inference import InferenceModel, configure_threads
+
+# TensorFlow/Keras take seconds to import. They are loaded by load_tensorflow when the
+# first network is built, runs that only use ORB never import them.
+tf = None
+preprocess_input = None
+Model = None
+VGG16 = None
+
+def load_tensorflow():
+    global tf, preprocess_input, Model, VGG16
+    if tf is None:
+        import tensorflow
+        from keras.applications.imagenet_utils import preprocess_input as imagenet_preprocess_input
+        from keras.models import Model as KerasModel
+        from tensorflow.keras.applications.vgg16 import VGG16 as KerasVGG16
+
+        tf, preprocess_input, Model, VGG16 = tensorflow, imagenet_preprocess_input, KerasModel, KerasVGG16
 
 
 class Mode(Enum):
@@ -31,61 +46,131 @@ class Mode(Enum):
     FVECTOR_CITYBLOCK = 3
     COMBINATION_EUCLIDEAN = 4
     COMBINATION_CITYBLOCK = 5
+    FVECTOR_ANN = 6
+    ORB_INDEX = 7
+
 
-class Distance(Enum):
-    EUCLIDEAN = 0
-    CITYBLOCK = 1
-    MINOWSKI = 2
-    CHEBYSHEV = 3
-    COSINE = 4
-    JACCARD = 5
+# Global descriptors computed on the convolutional trunk of VGG16 (512-d) instead of fc2 (4096-d).
+CONV_DESCRIPTORS = ['max', 'gem', 'rmac']
 
+def pool_features(maps, method, p=3, levels=3):
+    """
+    Pool (n, h, w, c) convolutional feature maps into L2 normalized (n, c) descriptors.
+
+    - max: maximum activation per channel (MAC).
+    - gem: generalized mean pooling with power p.
+    - rmac: sum of the max pooled descriptors of square regions at `levels` scales.
+    """
+
+    maps = np.asarray(maps, dtype=np.float32)
+    n, h, w, c = maps.shape
+
+    if method == 'max':
+        vectors = maps.max(axis=(1, 2))
+    elif method == 'gem':
+        vectors = np.power(np.power(np.maximum(maps, 1e-6), p).mean(axis=(1, 2)), 1 / p)
+    elif method == 'rmac':
+        vectors = np.zeros((n, c), dtype=np.float32)
+        for l in range(1, levels + 1):
+            size = max(1, int(2 * min(h, w) / (l + 1)))
+            for y in np.unique(np.linspace(0, h - size, l + (h > w)).round().astype(int)):
+                for x in np.unique(np.linspace(0, w - size, l + (w > h)).round().astype(int)):
+                    region = maps[:, y:y + size, x:x + size, :].max(axis=(1, 2))
+                    vectors += region / (np.linalg.norm(region, axis=1, keepdims=True) + 1e-6)
+    else:
+        raise ValueError('Unknown pooling method: {}'.format(method))
+
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-6)
 
 class CustomResNet():
-    def __init__(self, MAC=False):
-        self.pretrained_model = VGG16(weights='imagenet', include_top=True)
-        self.model = Model(inputs=self.pretrained_model.input, outputs=self.pretrained_model.get_layer("fc2").output)
+    def __init__(self, MAC=False, descriptor='fc2', input_size=224, gem_p=3, intra_op_threads=None, inter_op_threads=None, warmup=True):
+        """
+        - descriptor: 'fc2' for the 4096-d output of the fully connected layers, or one of
+                      CONV_DESCRIPTORS to pool the last convolutional layer into a 512-d vector.
+                      The conv trunk skips the fully connected layers (>100M parameters).
+        - input_size: input resolution of the conv trunk (fc2 is fixed at 224x224).
+        - intra_op_threads, inter_op_threads: TensorFlow thread pools (see inference.py).
+        - warmup: run one forward pass at startup.
+        """
+
+        load_tensorflow()
+        configure_threads(intra_op_threads, inter_op_threads)
+
         self.MAC = MAC
+        self.descriptor = descriptor
+        self.gem_p = gem_p
+
+        if descriptor == 'fc2':
+            self.pretrained_model = VGG16(weights='imagenet', include_top=True)
+            self.model = Model(inputs=self.pretrained_model.input, outputs=self.pretrained_model.get_layer("fc2").output)
+        elif descriptor in CONV_DESCRIPTORS:
+            self.pretrained_model = VGG16(weights='imagenet', include_top=False, input_shape=(input_size, input_size, 3))
+            self.model = Model(inputs=self.pretrained_model.input, outputs=self.pretrained_model.get_layer("block5_conv3").output)
+        else:
+            raise ValueError('Unknown descriptor: {}'.format(descriptor))
+
+        self.inference = InferenceModel(self.model, warmup=warmup)
+
+    @property
+    def dim(self):
+        return self.model.output_shape[-1]
+
+    def predict(self, x, batch_size=32):
+        vectors = self.inference(x, batch_size=batch_size)
+        if self.descriptor != 'fc2':
+            vectors = pool_features(vectors, self.descriptor, self.gem_p)
+        return vectors
     
+    def preprocess_batch(self, x):
+        # ImageNet preprocessing of a (n, h, w, 3) RGB batch, same as load_image.
+        return preprocess_input(x)
+
     def get_feature_vector(self, img_path):
         # Reference
 
         img, x = self.load_image(img_path);
-        feat = self.model.predict(x)[0]
+        feat = self.predict(x)[0]
 
         return feat
 
-    def euclidean_match(self,img,df):
-        return self.match(img,df,dist_method=distance.euclidean)
+    def euclidean_match(self,img,engine,k=None):
+        return self.match(img,engine,Distance.EUCLIDEAN,k)
 
-    def cityblock_match(self,img,df):
-        return self.match(img,df,dist_method=distance.cityblock)
+    def cityblock_match(self,img,engine,k=None):
+        return self.match(img,engine,Distance.CITYBLOCK,k)
 
-    def minowski_match(self,img,df):
-        return self.match(img,df,dist_method=distance.minkowski)
+    def minowski_match(self,img,engine,k=None):
+        return self.match(img,engine,Distance.MINOWSKI,k)
 
-    def chebyshev_match(self,img,df):
-        return self.match(img,df,dist_method=distance.chebyshev)
+    def chebyshev_match(self,img,engine,k=None):
+        return self.match(img,engine,Distance.CHEBYSHEV,k)
 
-    def cosine_match(self,img,df):
-        return self.match(img,df,dist_method=distance.cosine)
+    def cosine_match(self,img,engine,k=None):
+        return self.match(img,engine,Distance.COSINE,k)
 
-    def jaccard_match(self,img,df):
-        return self.match(img,df,dist_method=distance.jaccard)
+    def jaccard_match(self,img,engine,k=None):
+        return self.match(img,engine,Distance.JACCARD,k)
     
-    def match(self,img,df,dist_method):
-        img_array = self.preprocess_convert(img,self.MAC)
-        vectors = self.model.predict(img_array)[0]
+    def match(self,img,engine,metric,k=None):
+        return self.match_vectors(self.get_vector(img), engine, metric, k)[0]
 
+    def get_vector(self, img):
+        img_array = self.preprocess_convert(img,self.MAC)
+        return self.predict(img_array)[0]
 
-        distances = []
-        similar_idx_cosine = [ dist_method(vectors, feat) for feat in df["fvector"]]
-        idx_closest = sorted(range(len(similar_idx_cosine)), key=lambda k: similar_idx_cosine[k])
+    def get_vectors(self, imgs, batch_size=32):
+        # All crops are resized and stacked so the network runs one forward pass per
+        # batch instead of one predict call per crop.
+        if len(imgs) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
 
-        for i in idx_closest:
-            distances.append((i,similar_idx_cosine[i]))
+        img_array = np.concatenate([self.preprocess_convert(img,self.MAC) for img in imgs])
+        return self.predict(img_array, batch_size=batch_size)
 
-        return distances        
+    def match_vectors(self, vectors, engine, metric, k=None):
+        # Score one or more fvectors (rows of a matrix) against the DB in one call.
+        # Returns a ranked list of (index, distance) per query vector.
+        return engine.match(vectors, metric, k)
 
     def load_image(self, path):
         if self.MAC:
@@ -105,7 +190,13 @@ class CustomResNet():
             return img, x
 
     def preprocess_convert(self, img, MAC):
-        if MAC:
+        if self.descriptor != 'fc2':
+            # Crops are BGR (OpenCV), the conv descriptors are computed like the DB images:
+            # RGB input with the ImageNet preprocessing.
+            res = tf.image.resize(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), self.model.input_shape[1:3])
+            x = np.expand_dims(tf.keras.utils.img_to_array(res), axis=0)
+            return preprocess_input(x)
+        elif MAC:
             res = tf.image.resize(img, self.model.input_shape[1:3])
             x = tf.keras.preprocessing.image.img_to_array(res)
             x = np.expand_dims(x, axis=0)
@@ -119,11 +210,30 @@ class CustomResNet():
             return x        
 
 class PaintingMatcher():
-    def __init__(self, path=None, directory=None, features=300, mode = Mode.ORB, MAC=False):
+    def __init__(self, path=None, directory=None, features=300, mode = Mode.ORB, MAC=False, ann_nprobe=8, ann_k=100, cache=None, compressed=False, inference_threads=None, cascade=None, rooms=None, partition_workers=None):
         self.directory = directory
         self._mode =  mode
         self.MAC = MAC
 
+        # Use the PCA whitened / quantized fvectors of the database (see PaintingDatabase.compress_fvectors).
+        self.compressed = compressed
+
+        # Optional MatchCache, reuses results of crops that were seen in recent frames.
+        self.cache = cache
+
+        # Optional Cascade for the combination modes, re-ranks a fixed top 60 with ORB otherwise.
+        self.cascade = cascade
+
+        # Only search the paintings of these rooms (values of the room column), e.g. the
+        # wing of the museum a camera covers. None searches the full DB.
+        self.rooms = rooms
+        # Threads that scan the per-room partitions of a restricted search in parallel.
+        self.partition_workers = partition_workers
+
+        # Approximate search (Mode.FVECTOR_ANN): inverted lists visited per query and amount of results.
+        self.ann_nprobe = ann_nprobe
+        self.ann_k = ann_k
+
         if path is not None:
             self.load_keypoints(path)
             self.orb = cv2.ORB_create(nfeatures=features)
@@ -134,9 +244,18 @@ class PaintingMatcher():
         else:
             raise ValueError('Path is None.')
 
-        self.neuralnet = CustomResNet(self.MAC)    
+        # Built on first use, ORB modes never load the network.
+        self._neuralnet = None
+        self.inference_threads = inference_threads
     
 
+    @property
+    def neuralnet(self):
+        # The query fvectors have to be computed with the backbone that generated the DB.
+        if self._neuralnet is None:
+            self._neuralnet = CustomResNet(self.MAC, descriptor=self.db.meta.get('descriptor', 'fc2'), intra_op_threads=self.inference_threads)
+        return self._neuralnet
+
     @property
     def mode(self):
         return self._mode
@@ -146,12 +265,21 @@ class PaintingMatcher():
         self._mode = value
 
     @staticmethod
-    def generate_keypoints(directory_images, csv_path, features=300, fvector_state = True):
-        
+    def generate_keypoints(directory_images, csv_path, features=300, fvector_state = True, descriptor='fc2'):
+        """
+        Generate the painting database. Paths ending in .csv are written in the legacy
+        JSON-in-CSV format, every other path is written as a binary database directory.
+
+        - descriptor: fvector type, see CustomResNet.
+        """
+
+        if str(csv_path).endswith('.csv') and descriptor != 'fc2':
+            raise ValueError('The CSV format only supports fc2 fvectors, use a database directory.')
+
         neuralnet = None
         if fvector_state:
-            neuralnet = CustomResNet()
-        result = []
+            neuralnet = CustomResNet(descriptor=descriptor)
+        records = []
 
         directory_list = os.listdir(directory_images)
         detector = cv2.ORB_create(nfeatures=features)
@@ -167,127 +295,218 @@ class PaintingMatcher():
             img = resize_with_aspectratio(img, width=800)
             img_keypoints, img_descriptors = detector.detectAndCompute(img,None)
 
-            keypoints = []
-            descriptors = []
-
-            for i in range(len(img_keypoints)):
-                point = img_keypoints[i]
-                descriptor  = img_descriptors[i]
-                temp_keypoint = (point.pt, point.size, point.angle, point.response, point.octave, 
-                    point.class_id) 
-
-                keypoints.append(temp_keypoint)
-                descriptors.append(descriptor)
-
-            keypoints = np.array(keypoints, dtype=object).tolist()
-            descriptors = np.array(descriptors, dtype=object).tolist()
+            keypoints = [(p.pt[0], p.pt[1], p.size, p.angle, p.response, p.octave, p.class_id) for p in img_keypoints]
 
             parts = filename.split("__")
             photo = parts[1][4:]
             painting_number = int(parts[2][:2])
-            
-            if fvector_state:
-                result.append({
-                    'id':filename,
-                    'keypoints': json.dumps(keypoints),
-                    'descriptors': json.dumps(descriptors),
-                    'room':  parts[0],
-                    'photo': photo,
-                    'painting_number': painting_number,
-                    'fvector': json.dumps(neuralnet.get_feature_vector(img_path).tolist())
-                })
-            else:
-                result.append({
-                    'id':filename,
-                    'keypoints': json.dumps(keypoints),
-                    'descriptors': json.dumps(descriptors),
-                    'room':  parts[0],
-                    'photo': photo,
-                    'painting_number': painting_number,
-                    'fvector': json.dumps([])
-                })         
+
+            records.append({
+                'id':filename,
+                'keypoints': np.array(keypoints, dtype=np.float32).reshape((-1, 7)),
+                'descriptors': np.zeros((0, 32), np.uint8) if img_descriptors is None else img_descriptors,
+                'room':  parts[0],
+                'photo': photo,
+                'painting_number': painting_number,
+                'fvector': neuralnet.get_feature_vector(img_path) if fvector_state else []
+            })
 
             # Update Progress Bar
             progress += 1
             printProgressBar(progress, len(directory_list), prefix = 'Progress:', suffix = 'Complete', length = 50)
 
-        df = pd.DataFrame(result)
-        df.to_csv(csv_path)  
+        if str(csv_path).endswith('.csv'):
+            PaintingMatcher.records_to_csv(records, csv_path)
+        else:
+            PaintingDatabase.from_records(records, meta={'features': features, 'descriptor': descriptor}).save(csv_path)
 
     @staticmethod
-    def convert_descriptors(descriptors):
-        descriptors = np.array(pd.read_json(descriptors), dtype=np.uint8)
-        return descriptors
+    def records_to_csv(records, csv_path):
+        result = []
+        for r in records:
+            # Legacy layout: ((x, y), size, angle, response, octave, class_id)
+            keypoints = [((float(p[0]), float(p[1])), float(p[2]), float(p[3]), float(p[4]), int(p[5]), int(p[6])) for p in r['keypoints']]
+
+            result.append({
+                'id': r['id'],
+                'keypoints': json.dumps(keypoints),
+                'descriptors': json.dumps(np.asarray(r['descriptors']).tolist()),
+                'room': r['room'],
+                'photo': r['photo'],
+                'painting_number': r['painting_number'],
+                'fvector': json.dumps(np.asarray(r['fvector']).tolist())
+            })
 
-    @staticmethod
-    def convert_fvector(fvectors):
-        descriptors = np.array(pd.read_json(fvectors), dtype=np.float32)
-        return descriptors
+        df = pd.DataFrame(result)
+        df.to_csv(csv_path)
 
-    @staticmethod
-    def convert_keypoints(keypoint_array, MAC):
-        keypoints_result = []
-        keypoint_array  =  np.array(pd.read_json(keypoint_array), dtype=object)
-
-        if MAC:
-            for  p in keypoint_array:
-                temp = cv2.KeyPoint(
-                    x=p[0][0],
-                    y=p[0][1],
-                    _size=p[1],
-                    _angle=p[2],
-                    _response=p[3],
-                    _octave=p[4],
-                    _class_id=p[5],
-                )
-
-                keypoints_result.append(temp)
-        else:
-            for  p in keypoint_array:
-                temp = cv2.KeyPoint(
-                    x=p[0][0],
-                    y=p[0][1],
-                    size=p[1],
-                    angle=p[2],
-                    response=p[3],
-                    octave=p[4],
-                    class_id=p[5],
-                )
-
-                keypoints_result.append(temp)
-
-        return keypoints_result
-    
     def load_keypoints(self, data_path):
-        # if not path.exist(data_path):
-        #     raise ValueError('Invalid path.')
+        self.path = data_path
 
-        self.df = pd.read_csv(data_path, ",")
-        self.df['descriptors'] = self.df['descriptors'].apply(lambda x: PaintingMatcher.convert_descriptors(x))
-        self.df['keypoints'] = self.df['keypoints'].apply(lambda x: PaintingMatcher.convert_keypoints(x,self.MAC))
-        
-        if self._mode.value != Mode.ORB.value:
-            self.df['fvector'] = self.df['fvector'].apply(lambda x: PaintingMatcher.convert_fvector(x))
+        # Binary databases are opened memory-mapped, the legacy CSV format is parsed into memory.
+        if PaintingDatabase.is_database(data_path):
+            self.db = PaintingDatabase.open(data_path)
+        elif os.path.exists(data_path):
+            self.db = PaintingDatabase.from_csv(data_path)
+        else:
+            raise ValueError('Invalid path.')
+
+        self.df = self.db.table.copy()
+        self.df['descriptors'] = [self.db.image_descriptors(i) for i in range(len(self.db))]
+        self._fvector_engine = None
+        self._ann_index = None
+        self._orb_index = None
+        self._partitions = None
+        self._room_vertices = None
+
+    def update_database(self, directory=None, workers=None):
+        """
+        Incrementally update the database with the images in directory (default: the
+        image directory of the matcher) and switch to the updated database.
+        Returns a dict with the names of the added, changed and removed images.
+        """
+
+        if not PaintingDatabase.is_database(self.path):
+            raise ValueError('Incremental updates need a binary database directory.')
+
+        directory = self.directory if directory is None else directory
+        if directory is None:
+            raise ValueError('No image directory.')
+
+        changes = builder.update_database(directory, self.path, neuralnet=self._neuralnet, workers=workers)
+        if len(changes['added']) + len(changes['changed']) + len(changes['removed']) > 0:
+            # Indices in the old database (and in cached results) are no longer valid.
+            self.load_keypoints(self.path)
+            if self.cache is not None:
+                self.cache.clear()
+        return changes
 
-    def match(self,img_t, display=False, dist_metric=Distance.EUCLIDEAN):
+    @property
+    def fvector_engine(self):
+        # Contiguous fvector matrix, only built when an fvector mode is used.
+        if self._fvector_engine is None:
+            if self.compressed:
+                self._fvector_engine = CompressedEngine(*PaintingDatabase.open_compressed(self.path))
+            else:
+                self._fvector_engine = FvectorEngine(self.db.fvectors)
+        return self._fvector_engine
+
+    @property
+    def ann_path(self):
+        # The index is stored next to (or inside) the database.
+        if PaintingDatabase.is_database(self.path):
+            return os.path.join(self.path, 'ivfpq.npz')
+        return self.path + '.ivfpq.npz'
+
+    @property
+    def ann_index(self):
+        # Load the IVF-PQ index from disk, build and store it the first time it is needed
+        # or when the stored index was built for other fvectors.
+        if self._ann_index is None:
+            if os.path.exists(self.ann_path):
+                self._ann_index = IVFPQIndex.load(self.ann_path)
+                if self._ann_index.fingerprint != fingerprint(self.db.fvectors):
+                    self._ann_index = None
+            if self._ann_index is None:
+                self._ann_index = IVFPQIndex.build(self.db.fvectors)
+                self._ann_index.save(self.ann_path)
+        return self._ann_index
+
+    @property
+    def partitions(self):
+        # Per-room ORB and fvector sub-indexes, used for restricted searches.
+        if self._partitions is None:
+            engine = self.fvector_engine if self.db.fvector_dim > 0 else None
+            self._partitions = PartitionedIndex(self.db, engine, self.rooms, self.partition_workers)
+        return self._partitions
+
+    @property
+    def orb_index(self):
+        # LSH index over the descriptors of all DB images (Mode.ORB_INDEX).
+        if self._orb_index is None:
+            self._orb_index = ORBIndex.from_database(self.db)
+        return self._orb_index
+
+    def get_keypoints(self, index):
+        return self.db.image_keypoints(index)
+
+    def match(self,img_t, display=False, dist_metric=Distance.EUCLIDEAN, vector=None, rows=None):
+        return self.match_batch([img_t], display, dist_metric, [vector], rows)[0]
+
+    def match_crop(self,img_t, display=False, dist_metric=Distance.EUCLIDEAN, vector=None, rows=None):
+        # vector: fvector of img_t if it was already computed (see match_batch).
+        # rows: sorted DB rows to search, None for the full DB.
         distances = []
 
         if(self._mode.value == Mode.ORB.value):
-            distances = self.match_mode_orb(img_t,display)
+            distances = self.match_mode_orb(img_t,display,rows)
         elif(self._mode.value == Mode.FVECTOR.value):
-            distances = self.match_fvector(img_t,display,dist_metric)
+            distances = self.match_fvector(img_t,display,dist_metric,vector,rows)
         elif(self._mode.value == Mode.FVECTOR_EUCLIDEAN.value):
-            distances = self.match_fvector(img_t,display,Distance.EUCLIDEAN)
+            distances = self.match_fvector(img_t,display,Distance.EUCLIDEAN,vector,rows)
         elif(self._mode.value == Mode.FVECTOR_CITYBLOCK.value):
-            distances = self.match_fvector(img_t,display,Distance.CITYBLOCK)
+            distances = self.match_fvector(img_t,display,Distance.CITYBLOCK,vector,rows)
         elif(self._mode.value == Mode.COMBINATION_EUCLIDEAN.value):
-            distances = self.match_combination(img_t,display,Distance.EUCLIDEAN)
+            distances = self.match_combination(img_t,display,Distance.EUCLIDEAN,vector,rows)
         elif(self._mode.value == Mode.COMBINATION_CITYBLOCK.value):
-            distances = self.match_combination(img_t,display,Distance.CITYBLOCK)
+            distances = self.match_combination(img_t,display,Distance.CITYBLOCK,vector,rows)
+        elif(self._mode.value == Mode.FVECTOR_ANN.value):
+            distances = self.match_fvector_ann(img_t,display,vector,rows)
+        elif(self._mode.value == Mode.ORB_INDEX.value):
+            distances = self.match_mode_orb_index(img_t,display,rows)
 
         return distances
 
-    def match_mode_orb(self, img_t, display):
+    def uses_fvector(self):
+        return self._mode.value not in [Mode.ORB.value, Mode.ORB_INDEX.value]
+
+    def next_frame(self):
+        # Advances the frame counter used for the time to live of cached results.
+        if self.cache is not None:
+            self.cache.next_frame()
+
+    def match_batch(self, imgs, display=False, dist_metric=Distance.EUCLIDEAN, vectors=None, rows=None):
+        """
+        Match a list of crops (e.g. all paintings of a frame, or of several frames).
+        The fvectors of all crops are computed in one forward pass. Returns one result
+        per crop, identical to calling match on every crop.
+
+        - rows: only search these DB rows (e.g. the paintings of the likely rooms).
+        """
+
+        results = [None] * len(imgs)
+        entries = [None] * len(imgs)
+        vectors = [None] * len(imgs) if vectors is None else list(vectors)
+        if self.rooms is not None:
+            rows = self.partitions.rows if rows is None else np.intersect1d(rows, self.partitions.rows)
+        if rows is not None:
+            rows = np.unique(np.asarray(rows, dtype=np.int64))
+
+        # Results of a restricted search are only reused for the same restriction.
+        match_key = (self._mode.value, dist_metric.value, None if rows is None else hash(rows.tobytes()))
+
+        if self.cache is not None:
+            for i, img in enumerate(imgs):
+                entries[i], results[i] = self.cache.get(img, match_key)
+                if vectors[i] is None:
+                    vectors[i] = entries[i].vector
+        todo = [i for i in range(len(imgs)) if results[i] is None]
+
+        if self.uses_fvector():
+            missing = [i for i in todo if vectors[i] is None]
+            if len(missing) > 0:
+                for i, vector in zip(missing, self.neuralnet.get_vectors([imgs[i] for i in missing])):
+                    vectors[i] = vector
+
+        for i in todo:
+            results[i] = self.match_crop(imgs[i], display, dist_metric, vectors[i], rows)
+            if entries[i] is not None:
+                entries[i].vector = vectors[i]
+                entries[i].matches[match_key] = results[i]
+
+        return results
+
+    def match_mode_orb(self, img_t, display, rows=None):
 
         img_t = resize_with_aspectratio(img_t, width=800)
         kp_t, des_t = self.orb.detectAndCompute(img_t,  None) # Retrieve keypoints and descriptors
@@ -298,53 +517,74 @@ class PaintingMatcher():
         
 
         # Distance list has as content (dataframe index, distance score)
-        distances = []
+        # Cross checked matches with the full DB, sum of the 20 best match distances per
+        # image (images with fewer than 20 matches are left out), same scores as bf.match.
+        if rows is None:
+            distances = rank_scores(cross_check_scores(des_t, self.db.descriptors, self.db.offsets))
+        else:
+            distances = self.partitions.orb_scores(des_t, rows=rows)
 
-        # Loop through the full DB
-        for i, desc in enumerate(self.df['descriptors']):
-            matches = self.bf.match(desc, des_t) # Retrieve matches for one image in DB
-            matches = sorted(matches, key = lambda x:x.distance) # Sort these matches
 
-            sum = 0
-            if(len(matches) >= 20): # When more than 20 matches were established all distances are added up
-                # Sum of distances (one image 20 best matches)
-                for m in matches[:20]:
-                    sum += m.distance
+        if(display):
+            self.show_orb_match(img_t,des_t,kp_t,distances)
 
-                # Add image score to the distance list
-                distances.append((i,sum))
+        return distances
 
-        # Sort all DB distance scores
-        distances = sorted(distances,key=lambda t: t[1])
 
+    def match_mode_orb_index(self, img_t, display, rows=None):
+        img_t = resize_with_aspectratio(img_t, width=800)
+        kp_t, des_t = self.orb.detectAndCompute(img_t,  None) # Retrieve keypoints and descriptors
+
+        if not type(des_t) == np.ndarray: # Check if any descriptors were returned
+            return []
+
+        # One query for the whole DB, every matched DB descriptor votes for its painting.
+        # Scores are the sum of the 20 best match distances, like match_mode_orb.
+        distances = self.orb_index.query(des_t)
+        if rows is not None:
+            distances = self.restrict(distances, rows)
 
         if(display):
             self.show_orb_match(img_t,des_t,kp_t,distances)
 
         return distances
 
+    def rank_fvectors(self, vector, dist_metric, k=None, rows=None):
+        # fvector ranking of the DB, or of the given DB rows only.
+        if rows is None:
+            return self.neuralnet.match_vectors(vector, self.fvector_engine, dist_metric, k)[0]
+
+        return self.partitions.fvector_matches(vector, dist_metric, k, rows=rows)
 
-    def match_fvector(self, img_t, display, dist_metric):
+    @staticmethod
+    def restrict(distances, rows):
+        # Keep the results of the given DB rows (for indexes over the full DB).
+        keep = set(rows.tolist())
+        return [d for d in distances if d[0] in keep]
+
+    def match_fvector(self, img_t, display, dist_metric, vector=None, rows=None):
         # Calculate distances for each image in DB (based on fvector)
-        current_fvec = []
-        if dist_metric.value == Distance.COSINE.value:
-            current_fvec = self.neuralnet.cosine_match(img_t, self.df)
-        elif dist_metric.value == Distance.EUCLIDEAN.value:
-            current_fvec = self.neuralnet.euclidean_match(img_t, self.df)     
-        elif dist_metric.value == Distance.CITYBLOCK.value:
-            current_fvec = self.neuralnet.cityblock_match(img_t, self.df)        
-        elif dist_metric.value == Distance.MINOWSKI.value:
-            current_fvec = self.neuralnet.minowski_match(img_t, self.df)
-        elif dist_metric.value == Distance.CHEBYSHEV.value:
-            current_fvec = self.neuralnet.chebyshev_match(img_t, self.df)
-        else:
-            current_fvec = self.neuralnet.jaccard_match(img_t, self.df)                   
+        if vector is None:
+            vector = self.neuralnet.get_vector(img_t)
+        current_fvec = self.rank_fvectors(vector, dist_metric, rows=rows)
 
         if(display):
             self.show_fvector_match(img_t, current_fvec)
 
         return current_fvec
     
+    def match_fvector_ann(self, img_t, display, vector=None, rows=None):
+        # Euclidean distances, only the candidates in the probed inverted lists are scored
+        # and the best ones are reranked with their exact distance.
+        if vector is None:
+            vector = self.neuralnet.get_vector(img_t)
+        current_fvec = self.ann_index.search(vector, k=self.ann_k, nprobe=self.ann_nprobe, fvectors=self.db.fvectors, rerank=self.ann_k, rows=rows)[0]
+
+        if(display):
+            self.show_fvector_match(img_t, current_fvec)
+
+        return current_fvec
+
     def show_orb_match(self, img_t, des_t, kp_t, distances, amount=1):
         for i in range(amount):
             if(len(distances) > i):
@@ -352,7 +592,7 @@ class PaintingMatcher():
                 img = resize_with_aspectratio(cv2.imread(img_path, flags = cv2.IMREAD_COLOR), width=800)
                 matches = self.bf.match(self.df.descriptors[distances[i][0]], des_t)
                 matches = sorted(matches, key = lambda x:x.distance)
-                result = cv2.drawMatches(img, self.df.keypoints[distances[i][0]], img_t, kp_t, matches[:20], None)
+                result = cv2.drawMatches(img, self.get_keypoints(distances[i][0]), img_t, kp_t, matches[:20], None)
 
                 txt = str(distances[i][1])
                 cv2.putText(img=result, text=txt, org=(100, 100), fontFace=cv2.FONT_HERSHEY_PLAIN, fontScale=8, color=(0, 255, 0), thickness=4)
@@ -378,7 +618,7 @@ class PaintingMatcher():
             
         cv2.waitKey(1)
     
-    def match_combination(self, img_t, display, dist_metric):
+    def match_combination(self, img_t, display, dist_metric, vector=None, rows=None):
         img_t = resize_with_aspectratio(img_t, width=800)
         kp_t, des_t = self.orb.detectAndCompute(img_t,  None) # Retrieve keypoints and descriptors
 
@@ -387,29 +627,38 @@ class PaintingMatcher():
             return []
         
         # Calculate distances for each image in DB (based on fvector)
-        if(dist_metric.value == Distance.EUCLIDEAN.value):
-            current_fvec = self.neuralnet.euclidean_match(img_t, self.df) 
-        else:
-            current_fvec = self.neuralnet.cityblock_match(img_t, self.df)
+        if vector is None:
+            vector = self.neuralnet.get_vector(img_t)
+        k = 60 if self.cascade is None else self.cascade.max_rerank
+        current_fvec = self.rank_fvectors(vector, dist_metric, k, rows)
+
+        candidates = current_fvec
+        if self.cascade is not None:
+            candidates = current_fvec[:self.cascade.rerank_size(current_fvec)]
 
         # Distance list has as content (dataframe index, distance score)
         distances = []
-
-        # Calculate ORB distance only for the first X matches from the fvector matcher
-        for el in current_fvec[0:60]:
-            desc = self.df.iloc[el[0]].descriptors  # Fetch descriptors
-
-            matches = self.bf.match(desc, des_t)
-            matches = sorted(matches, key = lambda x:x.distance)
-
-            sum = 0
-            if(len(matches) >= 20): # When more than 20 matches were established all distances are added up  
-                # Sum of distances (one image 20 best matches)
-                for m in matches[:20]:
-                    sum += m.distance
-
-                # Add image score to the distance list
-                distances.append((el[0],sum))
+        best_score, since_best = None, 0
+
+        # Calculate ORB distance only for the first X matches from the fvector matcher.
+        # Without cascade all candidates are scored in one block, with cascade in blocks
+        # of `patience` candidates so the early stop heuristic can be checked in between.
+        images = [el[0] for el in candidates]
+        step = len(images) if self.cascade is None else max(1, self.cascade.patience)
+        for start in range(0, len(images), step):
+            block = images[start:start + step]
+            scores = cross_check_scores(des_t, self.db.descriptors, self.db.offsets, images=block)
+            distances.extend((i, s) for i, s in zip(block, scores.tolist()) if s >= 0)
+
+            if self.cascade is not None:
+                self.cascade.compared += len(block)
+                for s in scores:
+                    if s >= 0 and (best_score is None or s < best_score):
+                        best_score, since_best = s, 0
+                    else:
+                        since_best += 1
+                if self.cascade.stop(best_score, since_best, len(images) - start - len(block)):
+                    break
 
         # Sort all DB distance scores
         distances = sorted(distances,key=lambda t: t[1])
@@ -426,6 +675,14 @@ class PaintingMatcher():
     def get_room(self,index):
         return self.df.room[index]
 
+    def room_vertices(self, vertices):
+        # Graph vertex index of every DB row (room column 'zaal_<vertex>'), computed once per DB.
+        key = tuple(vertices)
+        if self._room_vertices is None or self._room_vertices[0] != key:
+            lookup = {v: i for i, v in enumerate(vertices)}
+            self._room_vertices = (key, np.array([lookup[room.split("_")[1]] for room in self.df.room], dtype=np.int64))
+        return self._room_vertices[1]
+
     def get_photo(self,index):
         return self.df.photo[index]
 
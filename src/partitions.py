@@ -0,0 +1,146 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from distances import Distance, FvectorEngine
+from orb_index import cross_check_scores, gather
+
+"""
+Per-room partitions of the painting database.
+
+Every room gets its own contiguous ORB descriptor block and fvector matrix. A
+database written by the builder is sorted on filename, so the rows of a room are
+already contiguous and its partition is a view on the (memory-mapped) arrays:
+building the partitions of a few rooms only reads the pages of those rooms.
+
+Queries run on one room, a set of rooms or a subset of DB rows and return the same
+ranking as the full DB search restricted to those rows. Partitions are scanned in
+parallel threads (the distance kernels are numpy and release the GIL).
+"""
+
+class Partition():
+    def __init__(self, room, rows, descriptors, offsets, engine):
+        self.room = room
+        self.rows = rows                # (n,) sorted DB rows of the room
+        self.descriptors = descriptors  # ORB descriptors of the room
+        self.offsets = offsets          # (n + 1,) descriptors of rows[i] are [offsets[i], offsets[i+1])
+        self.engine = engine            # FvectorEngine over the fvectors of the room
+
+    def __len__(self):
+        return len(self.rows)
+
+class PartitionedIndex():
+    def __init__(self, db, engine=None, rooms=None, workers=None):
+        """
+        - db: PaintingDatabase.
+        - engine: fvector engine of the full DB (e.g. CompressedEngine), default exact fvectors.
+        - rooms: values of the room column to load (default: all rooms).
+        - workers: threads used to scan partitions in parallel (default: serial).
+        """
+
+        engine = FvectorEngine(db.fvectors) if engine is None else engine
+        room_column = db.table['room'].to_numpy()
+        rooms = list(dict.fromkeys(room_column)) if rooms is None else list(rooms)
+
+        self.partitions = []
+        self.row_partition = np.full(len(db), -1, dtype=np.int64)
+        for room in rooms:
+            rows = np.flatnonzero(room_column == room)
+            if len(rows) == 0:
+                continue
+
+            if rows[-1] - rows[0] + 1 == len(rows):
+                # Contiguous rows: views, nothing is copied.
+                start, end = rows[0], rows[-1] + 1
+                descriptors = db.descriptors[db.offsets[start]:db.offsets[end]]
+                offsets = np.asarray(db.offsets[start:end + 1]) - db.offsets[start]
+                fvectors = engine.subset(slice(start, end))
+            else:
+                descriptors, offsets = gather(db.descriptors, np.asarray(db.offsets), rows)
+                fvectors = engine.subset(rows)
+
+            self.row_partition[rows] = len(self.partitions)
+            self.partitions.append(Partition(room, rows, descriptors, offsets, fvectors))
+
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers) if workers is not None and workers > 1 else None
+
+    @property
+    def rooms(self):
+        return [p.room for p in self.partitions]
+
+    @property
+    def rows(self):
+        # All DB rows in the loaded partitions.
+        return np.flatnonzero(self.row_partition >= 0)
+
+    def select(self, rooms=None, rows=None):
+        """
+        Returns (partition, local indices) pairs of the partitions to search, local
+        indices are None for a full partition. Rows outside the loaded partitions are ignored.
+        """
+
+        rooms = None if rooms is None else set(rooms)
+        if rows is not None:
+            rows = np.unique(np.asarray(rows, dtype=np.int64))
+            owners = self.row_partition[rows]
+
+        selected = []
+        for index, p in enumerate(self.partitions):
+            if rooms is not None and p.room not in rooms:
+                continue
+            if rows is None:
+                selected.append((p, None))
+                continue
+
+            in_partition = rows[owners == index]
+            if len(in_partition) > 0:
+                selected.append((p, np.searchsorted(p.rows, in_partition)))
+        return selected
+
+    def map(self, fn, selected):
+        if self.executor is None or len(selected) < 2:
+            return [fn(s) for s in selected]
+        return list(self.executor.map(fn, selected))
+
+    def orb_scores(self, des_t, rooms=None, rows=None, top=20, min_matches=20):
+        """
+        Cross checked ORB scores (see cross_check_scores) of the selected paintings.
+        Returns (DB row, score) tuples sorted on score, like match_mode_orb.
+        """
+
+        des_t = np.ascontiguousarray(des_t, dtype=np.uint8)
+
+        def scan(selection):
+            p, local = selection
+            scores = cross_check_scores(des_t, p.descriptors, p.offsets, images=local, top=top, min_matches=min_matches)
+            return p.rows if local is None else p.rows[local], scores
+
+        return self.merge(self.map(scan, self.select(rooms, rows)), valid=lambda scores: scores >= 0)
+
+    def fvector_matches(self, vector, metric=Distance.EUCLIDEAN, k=None, rooms=None, rows=None):
+        """
+        fvector ranking of the selected paintings. Returns (DB row, distance) tuples
+        sorted on distance, the k closest if k is given.
+        """
+
+        def scan(selection):
+            p, local = selection
+            distances = p.engine.distances(vector, metric)[0]
+            return (p.rows, distances) if local is None else (p.rows[local], distances[local])
+
+        return self.merge(self.map(scan, self.select(rooms, rows)), k=k)
+
+    @staticmethod
+    def merge(results, k=None, valid=None):
+        # Union of the per partition results, ties are ordered on DB row like the full search.
+        if len(results) == 0:
+            return []
+
+        rows = np.concatenate([r for r, _ in results])
+        values = np.concatenate([v for _, v in results]).astype(np.float64)
+        if valid is not None:
+            keep = valid(values)
+            rows, values = rows[keep], values[keep]
+
+        order = np.lexsort((rows, values))[:k]
+        return list(zip(rows[order].tolist(), values[order].tolist()))
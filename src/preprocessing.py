@@ -1,18 +1,52 @@
 import cv2
 import numpy as np
 import sys
-import pywt
 
 from util import resize_with_aspectratio
 
+class FrameContext():
+    """
+    Images derived from one frame (resized versions and their grayscale), computed on
+    first use and shared by every stage that processes the frame: the sharpness gate,
+    the detector and the localiser.
+    """
+
+    def __init__(self, image, resized=None):
+        """
+        - image: the frame.
+        - resized: optional dict width -> frame at that width that is already
+                   available (e.g. a second undistort remap to the detector width).
+        """
+
+        self.image = image
+        self._resized = {} if resized is None else dict(resized)
+        self._gray = {}
+
+    def resized(self, width=None):
+        # Frame resized to width (None = original size).
+        if width is None or width == self.image.shape[1]:
+            return self.image
+        if width not in self._resized:
+            self._resized[width] = resize_with_aspectratio(self.image, width=width)
+        return self._resized[width]
+
+    def gray(self, width=None):
+        # Grayscale of the resized frame (resized first, like the stages did before).
+        if width not in self._gray:
+            img = self.resized(width)
+            self._gray[width] = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return self._gray[width]
+
 class FrameProcessor():
-    def __init__(self, data_file, frame_shape):
+    def __init__(self, data_file, frame_shape, width=None):
         """
         Load the camera parameters from a given file.
 
         - data_file: path to the file that contains the python objects of
                      the camera matrix etc.
         - frame_shape: Tuple (W,H) of the camera frames.
+        - width: width of the undistorted frames (e.g. the width the detector works
+                 on), default the width of the ROI.
         """
 
         with open(data_file, 'rb') as f:
@@ -24,16 +58,28 @@ class FrameProcessor():
         refined_mtx, roi = cv2.getOptimalNewCameraMatrix(self.mtx, self.dist, frame_shape, 1, frame_shape)
         self.refined_mtx = refined_mtx
         self.roi = roi
+
+        # The undistortion, the crop to the ROI and the resize are one remap: the new
+        # camera matrix is shifted to the ROI and scaled to the output size. The maps
+        # are computed once, in fixed point (CV_16SC2) like cv2.undistort does.
+        x, y, w, h = roi
+        output_shape = (w, h) if width is None else (width, int(h * width / float(w)))
+        scale_x, scale_y = output_shape[0] / w, output_shape[1] / h
+
+        output_mtx = refined_mtx.copy()
+        output_mtx[0, 0] *= scale_x
+        output_mtx[1, 1] *= scale_y
+        # Pixel centers, like cv2.resize.
+        output_mtx[0, 2] = (refined_mtx[0, 2] - x + 0.5) * scale_x - 0.5
+        output_mtx[1, 2] = (refined_mtx[1, 2] - y + 0.5) * scale_y - 0.5
+
+        self.output_shape = output_shape
+        self.map1, self.map2 = cv2.initUndistortRectifyMap(self.mtx, self.dist, None, output_mtx, output_shape, cv2.CV_16SC2)
     
     def undistort(self, img):
-        dst = cv2.undistort(src=img, cameraMatrix=self.mtx, distCoeffs=self.dist, newCameraMatrix=self.refined_mtx)
-
-        # Crop image to ROI
-        # The undistort may cause invalid pixels (closer to the edges).
-        x, y, w, h = self.roi
-        dst = dst[y:y+h, x:x+w]
-
-        return dst
+        # The undistort may cause invalid pixels (closer to the edges), the maps only
+        # cover the ROI.
+        return cv2.remap(img, self.map1, self.map2, interpolation=cv2.INTER_LINEAR)
 
     @staticmethod
     def calibrate_camera(input_video, output, draw, manual_add=True):
@@ -126,13 +172,17 @@ class FrameProcessor():
             return True
 
 def blur_detect(img, threshold):
-    # Convert image to grayscale
-    Y = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Convert image to grayscale (unless it already is)
+    Y = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
     M, N = Y.shape
     
     # Crop input image to be 3 divisible by 2
     Y = Y[0:int(M/16)*16, 0:int(N/16)*16]
+    if Y.size == 0:
+        # Less than 16 rows or columns: no window to detect edges in, sharpness_metric
+        # treats the image as blurred.
+        raise ValueError('Image of {}x{} is too small for the blur detection'.format(N, M))
     
     # Als ik het goed begrijp komt LL1 overeen met een niveau van een Gaussische piramide want dit is het gemiddelde
     # van een kleine regio van de afbeelding.
@@ -142,135 +192,83 @@ def blur_detect(img, threshold):
     # Visuele hulp: https://unix4lyfe.org/haar/
     # Afbeeldings decompositie
     
-    # .dwt2 returns an approximation and a 3tuple containing horizontal details, vertical details and diagonal details.
+    # haar_dwt2 returns an approximation and a 3tuple containing horizontal details, vertical details and diagonal details.
     # Step 1, compute Haar wavelet of input image
-    LL1,(LH1,HL1,HH1)= pywt.dwt2(Y, 'haar')
+    LL1,(LH1,HL1,HH1)= haar_dwt2(Y)
     # Another application of 2D haar to LL1
-    LL2,(LH2,HL2,HH2)= pywt.dwt2(LL1, 'haar') 
+    LL2,(LH2,HL2,HH2)= haar_dwt2(LL1)
     # Another application of 2D haar to LL2
-    LL3,(LH3,HL3,HH3)= pywt.dwt2(LL2, 'haar')
+    LL3,(LH3,HL3,HH3)= haar_dwt2(LL2)
     
     # Construct the edge map in each scale Step 2
     E1 = np.sqrt(np.power(LH1, 2)+np.power(HL1, 2)+np.power(HH1, 2))
     E2 = np.sqrt(np.power(LH2, 2)+np.power(HL2, 2)+np.power(HH2, 2))
     E3 = np.sqrt(np.power(LH3, 2)+np.power(HL3, 2)+np.power(HH3, 2))
-    
-    M1, N1 = E1.shape
 
-    # Sliding window size level 1
-    sizeM1 = 8
-    sizeN1 = 8
-    
-    # Sliding windows size level 2
-    sizeM2 = int(sizeM1/2)
-    sizeN2 = int(sizeN1/2)
-    
-    # Sliding windows size level 3
-    sizeM3 = int(sizeM2/2)
-    sizeN3 = int(sizeN2/2)
-    
-    # Number of edge maps, related to sliding windows size
-    N_iter = int((M1/sizeM1)*(N1/sizeN1))
-    
-    Emax1 = np.zeros((N_iter))
-    Emax2 = np.zeros((N_iter))
-    Emax3 = np.zeros((N_iter))
-    
-    count = 0
-    
-    # Sliding windows index of level 1
-    x1 = 0
-    y1 = 0
-    # Sliding windows index of level 2
-    x2 = 0
-    y2 = 0
-    # Sliding windows index of level 3
-    x3 = 0
-    y3 = 0
-    
-    # Sliding windows limit on horizontal dimension
-    Y_limit = N1-sizeN1
-    
-    while count < N_iter:
-        # Get the maximum value of slicing windows over edge maps 
-        # in each level
-        Emax1[count] = np.max(E1[x1:x1+sizeM1,y1:y1+sizeN1])
-        Emax2[count] = np.max(E2[x2:x2+sizeM2,y2:y2+sizeN2])
-        Emax3[count] = np.max(E3[x3:x3+sizeM3,y3:y3+sizeN3])
-        
-        # if sliding windows ends horizontal direction
-        # move along vertical direction and resets horizontal
-        # direction
-        if y1 == Y_limit:
-            x1 = x1 + sizeM1
-            y1 = 0
-            
-            x2 = x2 + sizeM2
-            y2 = 0
-            
-            x3 = x3 + sizeM3
-            y3 = 0
-            
-            count += 1
-        
-        # windows moves along horizontal dimension
-        else:
-            y1 = y1 + sizeN1
-            y2 = y2 + sizeN2
-            y3 = y3 + sizeN3
-            count += 1
+    # Maximum of every sliding window (8x8 on level 1, 4x4 on level 2, 2x2 on level 3),
+    # the windows in row major order. The windows tile the edge maps, so every maximum
+    # is a block reduction.
+    Emax1 = window_max(E1, 8)
+    Emax2 = window_max(E2, 4)
+    Emax3 = window_max(E3, 2)
     
     # Step 3
-    EdgePoint1 = Emax1 > threshold;
-    EdgePoint2 = Emax2 > threshold;
-    EdgePoint3 = Emax3 > threshold;
-    
-    # Rule 1 Edge Pojnts
-    EdgePoint = EdgePoint1 + EdgePoint2 + EdgePoint3
+    EdgePoint1 = Emax1 > threshold
+    EdgePoint2 = Emax2 > threshold
+    EdgePoint3 = Emax3 > threshold
     
-    n_edges = EdgePoint.shape[0]
+    # Rule 1 Edge Points
+    EdgePoint = EdgePoint1 | EdgePoint2 | EdgePoint3
     
     # Rule 2 Dirak-Structure or Astep-Structure
-    DAstructure = (Emax1[EdgePoint] > Emax2[EdgePoint]) * (Emax2[EdgePoint] > Emax3[EdgePoint]);
+    DAstructure = (Emax1[EdgePoint] > Emax2[EdgePoint]) & (Emax2[EdgePoint] > Emax3[EdgePoint])
     
     # Rule 3 Roof-Structure or Gstep-Structure
-    
-    RGstructure = np.zeros((n_edges))
-
-    for i in range(n_edges):
-        if EdgePoint[i] == 1:
-            if Emax1[i] < Emax2[i] and Emax2[i] < Emax3[i]:
-                RGstructure[i] = 1
+    RGstructure = EdgePoint & (Emax1 < Emax2) & (Emax2 < Emax3)
                 
     # Rule 4 Roof-Structure
-    
-    RSstructure = np.zeros((n_edges))
-
-    for i in range(n_edges):
-        if EdgePoint[i] == 1:
-            if Emax2[i] > Emax1[i] and Emax2[i] > Emax3[i]:
-                RSstructure[i] = 1
+    RSstructure = EdgePoint & (Emax2 > Emax1) & (Emax2 > Emax3)
 
     # Rule 5 Edge more likely to be in a blurred image 
-
-    BlurC = np.zeros((n_edges));
-
-    for i in range(n_edges):
-        if RGstructure[i] == 1 or RSstructure[i] == 1:
-            if Emax1[i] < threshold:
-                BlurC[i] = 1                        
+    BlurC = (RGstructure | RSstructure) & (Emax1 < threshold)
         
     # Step 6
     Per = np.sum(DAstructure)/np.sum(EdgePoint)
     
     # Step 7
-    if (np.sum(RGstructure) + np.sum(RSstructure)) == 0:
+    structures = np.float64(np.count_nonzero(RGstructure) + np.count_nonzero(RSstructure))
+    if structures == 0:
         blur_extent = 100
     else:
-        blur_extent = np.sum(BlurC) / (np.sum(RGstructure) + np.sum(RSstructure))
+        blur_extent = np.count_nonzero(BlurC) / structures
     
     return Per, blur_extent
 
+# Haar filter coefficient 1/sqrt(2), the value pywt uses.
+HAAR = np.sqrt(0.5)
+
+def haar_dwt2(x):
+    """
+    Single level 2D Haar transform of an image with even dimensions, identical to
+    pywt.dwt2(x, 'haar'): first along the rows, then along the columns, every
+    coefficient is summed in the same order as pywt (-c*a + c*b == c*b - c*a).
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    odd, even = HAAR * x[1::2], HAAR * x[0::2]
+    lo, hi = odd + even, even - odd
+
+    odd, even = HAAR * lo[:, 1::2], HAAR * lo[:, 0::2]
+    LL, HL = odd + even, even - odd
+    odd, even = HAAR * hi[:, 1::2], HAAR * hi[:, 0::2]
+    LH, HH = odd + even, even - odd
+    return LL, (LH, HL, HH)
+
+def window_max(E, size):
+    # Maxima of the size x size windows of an edge map, in row major order.
+    M, N = E.shape
+    return E.reshape(M // size, size, N // size, size).max(axis=(1, 3)).ravel()
+
 if __name__ == '__main__':
     # Code to create calibration files, should not execute if the two files exist in the data folder.
     # vid_path = '/media/robbedec/BACKUP/ugent/master/computervisie/project/data/videos/gopro/calibration_M.mp4'
@@ -0,0 +1,85 @@
+import numpy as np
+
+"""
+Search pruning with the room posterior of the HMM.
+
+The crops of a frame are first matched against the paintings of the plausible rooms
+only: the most likely rooms that together hold `mass` of the posterior, extended with
+their neighbours in the museum graph (a visitor can walk into an adjacent room
+between two frames). Crops without a confident match in that subset fall back to a
+search over the full database.
+"""
+
+class PriorPruning():
+    def __init__(self, mass=0.9, min_rooms=3, hops=1, min_gap=0.1, verify=False):
+        """
+        - mass: posterior probability covered by the selected rooms.
+        - min_rooms: minimum amount of rooms selected on the posterior.
+        - hops: graph distance of the neighbouring rooms that are added.
+        - min_gap: a restricted result is confident if rank 2 is at least this much
+                   (relative) further away than rank 1, or if there is only one result.
+        - verify: also run the full search to measure agreement (evaluation only).
+        """
+
+        self.mass = mass
+        self.min_rooms = min_rooms
+        self.hops = hops
+        self.min_gap = min_gap
+        self.verify = verify
+
+        self.frames = 0
+        self.crops = 0
+        self.fallbacks = 0
+        self.verified = 0
+        self.agreements = 0
+        self.scanned = []   # fraction of the DB scanned per frame
+
+    def rooms(self, posterior, connectivity):
+        """
+        Indices of the rooms to search first, given the posterior over all rooms and
+        the connectivity matrix of the graph.
+        """
+
+        posterior = np.real(np.asarray(posterior)).astype(np.float64)
+        order = np.argsort(-posterior, kind='stable')
+        count = np.searchsorted(np.cumsum(posterior[order]), self.mass * posterior.sum()) + 1
+        count = min(len(order), max(self.min_rooms, count))
+
+        selected = np.zeros(len(posterior), dtype=bool)
+        selected[order[:count]] = True
+
+        adjacent = np.asarray(connectivity) > 0
+        for _ in range(self.hops):
+            selected |= adjacent[selected].any(axis=0)
+        return np.flatnonzero(selected)
+
+    def confident(self, matches):
+        if len(matches) == 0:
+            return False
+        if len(matches) == 1:
+            return True
+        d1, d2 = matches[0][1], matches[1][1]
+        return d2 > 0 and (d2 - d1) / d2 >= self.min_gap
+
+    def record(self, crops, fallbacks, rows, total):
+        # Statistics of one frame: crops searched in `rows` of `total` DB rows.
+        self.frames += 1
+        self.crops += crops
+        self.fallbacks += fallbacks
+        if crops > 0 and total > 0:
+            self.scanned.append((crops * rows + fallbacks * total) / (crops * total))
+
+    def record_verification(self, restricted, full):
+        self.verified += 1
+        if len(restricted) > 0 and len(full) > 0 and restricted[0][0] == full[0][0]:
+            self.agreements += 1
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'crops': self.crops,
+            'fallbacks': self.fallbacks,
+            'hit_rate': (self.crops - self.fallbacks) / self.crops if self.crops > 0 else 0,
+            'scanned': float(np.mean(self.scanned)) if len(self.scanned) > 0 else 0,
+            'agreement': self.agreements / self.verified if self.verified > 0 else None,
+        }
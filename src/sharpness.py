@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+from abc import ABC, abstractmethod
+
+from detector import DETECTOR_WIDTH
+from preprocessing import FrameContext, blur_detect
+
+"""
+Sharpness gates: decide if a frame or crop is too blurry to process.
+
+Every gate computes one metric on the grayscale image of a FrameContext at its own
+width, gates that work at the detector width share the downscaled frame with the
+detector. Metrics (higher = sharper, except for Haar where a low Per is blurry):
+
+    HaarGate        the Haar wavelet blur detection of FrameProcessor.sharpness_metric
+    LaplacianGate   variance of the Laplacian
+    TenengradGate   mean squared Sobel gradient magnitude
+"""
+
+class SharpnessGate(ABC):
+    # Smallest number of rows and columns the metric needs, smaller images are blurred.
+    min_size = 1
+
+    def __init__(self, threshold, width=DETECTOR_WIDTH):
+        """
+        - threshold: metric value below which an image is blurred.
+        - width: width the metric is computed on (None = original size).
+        """
+
+        self.threshold = threshold
+        self.width = width
+
+    @abstractmethod
+    def metric(self, gray):
+        pass
+
+    def is_blurred(self, image):
+        # image: FrameContext or BGR image.
+        context = image if isinstance(image, FrameContext) else FrameContext(image)
+        if context.image.size == 0:
+            # Empty crop, nothing to match.
+            return True
+        try:
+            gray = context.gray(self.width)
+        except cv2.error:
+            # Crop too thin to resize to the gate width (resized height 0).
+            return True
+        if min(gray.shape) < self.min_size:
+            return True
+        return self.metric(gray) < self.threshold
+
+class HaarGate(SharpnessGate):
+    # blur_detect crops to a multiple of 16 rows and columns.
+    min_size = 16
+
+    def __init__(self, threshold=0.004, edge_threshold=35, width=400):
+        # Defaults of FrameProcessor.sharpness_metric, identical decisions.
+        super().__init__(threshold, width)
+        self.edge_threshold = edge_threshold
+
+    def metric(self, gray):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            per, _ = blur_detect(gray, self.edge_threshold)
+        return per
+
+class LaplacianGate(SharpnessGate):
+    def __init__(self, threshold=100, width=DETECTOR_WIDTH):
+        super().__init__(threshold, width)
+
+    def metric(self, gray):
+        return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+class TenengradGate(SharpnessGate):
+    def __init__(self, threshold=2000, width=DETECTOR_WIDTH):
+        super().__init__(threshold, width)
+
+    def metric(self, gray):
+        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+        return float(cv2.mean(gx * gx + gy * gy)[0])
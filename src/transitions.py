@@ -0,0 +1,209 @@
+import numpy as np
+
+"""
+Hop distances and sparse transition matrices for museum graphs with many rooms.
+
+With a gaussian distribution only the rooms within max_dist hops of a room get a
+transition probability, so every row of the transition matrix only holds the
+neighbourhood of its room. The rows are stored as CSR arrays (indptr, indices, data)
+and a forward step costs O(non-zeros) instead of O(rooms^2).
+"""
+
+def csr_adjacency(connectivityMatrix):
+    # (indptr, indices) of the edges of a dense connectivity matrix, a (indptr, indices)
+    # tuple is returned as is.
+    if isinstance(connectivityMatrix, tuple):
+        indptr, indices = connectivityMatrix
+        return np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int64)
+
+    adjacency = np.array(connectivityMatrix) != 0
+    np.fill_diagonal(adjacency, False)
+    rows, indices = np.nonzero(adjacency)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(adjacency)))])
+    return indptr, indices.astype(np.int64)
+
+def segments(indptr, rows):
+    # Positions of the CSR elements of `rows` (concatenated) and the amount per row.
+    counts = indptr[rows + 1] - indptr[rows]
+    starts = np.repeat(indptr[rows] - np.cumsum(counts) + counts, counts)
+    return starts + np.arange(counts.sum()), counts
+
+def sorted_unique(keys):
+    keys = np.sort(keys, kind='stable')
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) > 0 else keys
+
+def shortestPaths(connectivityMatrix, max_dist=None):
+    """
+    Hop distances between all rooms (breadth-first search from every room at once).
+    Element [i, j] is the amount of edges on the shortest path from room i to room j,
+    -1 if j can not be reached from i (or only in more than max_dist hops).
+    connectivityMatrix: dense matrix or CSR (indptr, indices) of the edges.
+
+    The rooms that reached a room so far are kept as bit sets (one bit per source
+    room), one BFS level ORs the bit sets of the neighbours together.
+    """
+
+    indptr, indices = csr_adjacency(connectivityMatrix)
+    length = len(indptr) - 1
+
+    dist = np.full((length, length), -1, dtype=np.int32)
+    np.fill_diagonal(dist, 0)
+    if length == 0:
+        return dist
+
+    # Incoming edges u -> v of every room v, the k-th neighbours of all rooms with
+    # more than k neighbours are ORed in one step.
+    u = np.repeat(np.arange(length), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    v, u = indices[order], u[order]
+    degrees = np.bincount(v, minlength=length)
+    rank = np.arange(len(v)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    neighbours = [(v[rank == k], u[rank == k]) for k in range(degrees.max())]
+
+    # Row v, bit s: room v is reached from source room s (64 source rooms per word).
+    sources = np.arange(length)
+    frontier = np.zeros((length, (length + 63) // 64), dtype=np.uint64)
+    frontier[sources, sources // 64] = np.left_shift(np.uint64(1), (sources % 64).astype(np.uint64))
+    visited = frontier.copy()
+
+    level = 0
+    while max_dist is None or level < max_dist:
+        level += 1
+        reached = np.zeros_like(frontier)
+        for rooms, sources in neighbours:
+            reached[rooms] |= frontier[sources]
+        reached &= ~visited
+        rooms, blocks = np.nonzero(reached)
+        if len(rooms) == 0:
+            break
+        visited |= reached
+
+        # Every (source, room) pair is extracted once, in the level it is reached,
+        # one lowest set bit of every word at a time.
+        values = reached[rooms, blocks]
+        while len(values) > 0:
+            lowest = values & (~values + np.uint64(1))
+            bit = np.log2(lowest.astype(np.float64)).astype(np.int64)
+            dist[blocks * 64 + bit, rooms] = level
+            values ^= lowest
+            left = values != 0
+            rooms, blocks, values = rooms[left], blocks[left], values[left]
+        frontier = reached
+    return dist
+
+def neighbourhoods(connectivityMatrix, max_dist):
+    """
+    Rooms within max_dist hops of every room (breadth-first search from every room at
+    once, only the reached (source, room) pairs are stored).
+    connectivityMatrix: dense matrix or CSR (indptr, indices) of the edges.
+
+    Returns CSR arrays (indptr, indices, distances), every row sorted on room and
+    starting from the room itself (distance 0) is included.
+    """
+
+    indptr, indices = csr_adjacency(connectivityMatrix)
+    length = len(indptr) - 1
+
+    sources = np.arange(length, dtype=np.int64)
+    rooms = sources.copy()
+    keys = [sources * length + rooms]
+    distances = [np.zeros(length, dtype=np.int32)]
+    visited = keys[0]
+
+    for level in range(1, max_dist + 1):
+        positions, counts = segments(indptr, rooms)
+        reached = sorted_unique(np.repeat(sources, counts) * length + indices[positions])
+
+        found = np.searchsorted(visited, reached)
+        found[found == len(visited)] = 0
+        reached = reached[visited[found] != reached]
+        if len(reached) == 0:
+            break
+
+        # Two sorted runs, the stable sort (timsort) merges them.
+        visited = np.sort(np.concatenate([visited, reached]), kind='stable')
+        sources, rooms = np.divmod(reached, length)
+        keys.append(reached)
+        distances.append(np.full(len(reached), level, dtype=np.int32))
+
+    keys = np.concatenate(keys)
+    distances = np.concatenate(distances)
+    order = np.argsort(keys, kind='stable')
+    keys, distances = keys[order], distances[order]
+
+    sources, rooms = np.divmod(keys, length)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=length))])
+    return indptr, rooms, distances
+
+class SparseTransitions():
+    def __init__(self, indptr, indices, data):
+        """
+        Transition matrix in CSR form, row i holds the probabilities of moving from
+        room i to the rooms indices[indptr[i]:indptr[i+1]].
+        """
+
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float64)
+        self.rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+        # Column order (CSC) for the maximum over the predecessors of every room (Viterbi).
+        self.by_column = np.lexsort((self.rows, self.indices))
+        self.column_starts = np.searchsorted(self.indices[self.by_column], np.arange(len(self)))
+        with np.errstate(divide='ignore'):
+            self.log_data = np.log(self.data)
+
+    @staticmethod
+    def from_dense(matrix):
+        matrix = np.asarray(matrix, dtype=np.float64)
+        rows, indices = np.nonzero(matrix)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(matrix)))])
+        return SparseTransitions(indptr, indices, matrix[rows, indices])
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def __getitem__(self, room):
+        # Dense row of one room.
+        row = np.zeros(len(self), dtype=np.float64)
+        row[self.indices[self.indptr[room]:self.indptr[room + 1]]] = self.data[self.indptr[room]:self.indptr[room + 1]]
+        return row
+
+    def toarray(self):
+        matrix = np.zeros((len(self), len(self)), dtype=np.float64)
+        matrix[self.rows, self.indices] = self.data
+        return matrix
+
+    def propagate(self, state, rows=None):
+        # state @ transitions, only the given rows are read (default: all rows).
+        if rows is None:
+            return np.bincount(self.indices, weights=self.data * state[self.rows], minlength=len(self))
+        positions, counts = segments(self.indptr, rows)
+        weights = self.data[positions] * np.repeat(state[rows], counts)
+        return np.bincount(self.indices[positions], weights=weights, minlength=len(self))
+
+    def dot(self, x):
+        # transitions @ x
+        return np.bincount(self.rows, weights=self.data * x[self.indices], minlength=len(self))
+
+    def best_predecessors(self, log_state):
+        """
+        max_i log_state[i] + log(transitions[i, j]) for every room j and the room i
+        that reaches it (the first one on ties).
+        """
+
+        values = log_state[self.rows[self.by_column]] + self.log_data[self.by_column]
+        counts = np.diff(np.append(self.column_starts, len(values)))
+        best = np.full(len(self), -np.inf)
+        if len(values) > 0:
+            # Rooms without predecessors keep -inf (reduceat does not handle empty segments).
+            best = np.where(counts > 0, np.maximum.reduceat(values, np.minimum(self.column_starts, len(values) - 1)), best)
+        first = values == np.repeat(best, counts)
+        columns, positions = np.unique(self.indices[self.by_column][first], return_index=True)
+        predecessors = np.zeros(len(self), dtype=np.int64)
+        predecessors[columns] = self.rows[self.by_column][first][positions]
+        return best, predecessors
@@ -1,11 +1,15 @@
 import cv2
+import os
 import random as rng
 import numpy as np
 import pandas as pd
 
 from graph import Graph
 
-vertices = "1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 A B C D E F G H I J K L M N O P Q R S II V".split()
+# Rooms and doors of the museum, see Graph.load for the format.
+GRAPH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'msk_graph.txt')
+
+vertices = Graph.load(GRAPH_PATH).getVertices()
 """
 room_center_coords = {
     "1": (580,475], "2": [660,475], "3": [750,475], "4": [735,405], "5": [605,405], "6": [578,328], "7": [665,328],
@@ -93,45 +97,8 @@ def rectify_contour(src_points,img,display = False):
     
     return affine_image,crop_img
 
-def generate_graph():
-    g = Graph(vertices)
-    g.addEdges([('1', '2'), ('1','II')])
-    g.addEdges([('2', '3'), ('2', '4'), ('2', '5')])
-    g.addEdges([('4', '5'), ('4', '7')])
-    g.addEdges([('5', '7'), ('5', 'II')])
-    g.addEdges([('6', '7'), ('6', 'II'), ('6', '9')])
-    g.addEdges([('7', '8'), ('7', '9')])
-    g.addEdges([('8', '13')])
-    g.addEdges([('9', '10'), ('9', 'I'), ('9', '19'), ('9', 'S')])
-    g.addEdges([('10', '11')])
-    g.addEdges([('11', '12')])
-    g.addEdges([('12', '19'), ('12', 'L'), ('12', 'S'), ('12', 'V'), ('12', 'I')])
-    g.addEdges([('13', '14'), ('13', '16')])
-    g.addEdges([('14', '15'), ('14', '16')])
-    g.addEdges([('15', '16')])
-    g.addEdges([('16', '17'), ('16', '18'), ('16', '19')])
-    g.addEdges([('17', '18'), ('17', '19')])
-    g.addEdges([('18', '19')])
-    g.addEdges([('19', 'V'), ('19', 'L'), ('19', 'I')])
-    g.addEdges([('A', 'B'), ('A', 'II')])
-    g.addEdges([('B', 'C'), ('B', 'D'), ('B', 'E')])
-    g.addEdges([('C', 'D')])
-    g.addEdges([('D', 'E'), ('D', 'G'), ('D', 'H')])
-    g.addEdges([('E', 'G'), ('E', 'II')])
-    g.addEdges([('F', 'G'), ('F', 'I'), ('F', 'II')])
-    g.addEdges([('G', 'H'), ('G', 'I')])
-    g.addEdges([('H', 'M')])
-    g.addEdges([('I', 'J'), ('I', 'M')])
-    g.addEdges([('J', 'K')])
-    g.addEdges([('K', 'L')])
-    g.addEdges([('L', 'S'), ('L', '9')])
-    g.addEdges([('M', 'P'), ('M', 'Q'), ('M', 'N')])
-    g.addEdges([('N', 'O'), ('N', 'P')])
-    g.addEdges([('O', 'P')])
-    g.addEdges([('P', 'Q'), ('P', 'R'), ('P', 'S')])
-    g.addEdges([('Q', 'R'), ('Q', 'S')])
-    g.addEdges([('R', 'S')])
-    return g
+def generate_graph(path=GRAPH_PATH):
+    return Graph.load(path)
 
 def generate_map_contours():
     """
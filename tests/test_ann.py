@@ -0,0 +1,33 @@
+import numpy as np
+
+from ann import IVFPQIndex, fingerprint
+
+def test_search_with_rerank_finds_exact_neighbours():
+    rng = np.random.default_rng(0)
+    fvectors = rng.normal(size=(1000, 64)).astype(np.float32)
+    index = IVFPQIndex.build(fvectors, m=8)
+    queries = fvectors[:5] + rng.normal(scale=0.01, size=(5, 64)).astype(np.float32)
+
+    for q, ranked in enumerate(index.search(queries, k=5, nprobe=index.nlist, fvectors=fvectors, rerank=100)):
+        assert ranked[0][0] == q
+        assert ranked[0][1] == np.sqrt(((fvectors[q] - queries[q]) ** 2).sum(dtype=np.float32))
+
+def test_search_restricted_rows():
+    rng = np.random.default_rng(1)
+    fvectors = rng.normal(size=(1000, 64)).astype(np.float32)
+    index = IVFPQIndex.build(fvectors, m=8)
+    rows = np.arange(3, 1000, 50)
+
+    for ranked in index.search(rng.normal(size=(5, 64)), k=10, nprobe=1, fvectors=fvectors, rerank=10, rows=rows):
+        assert len(ranked) == 10
+        assert set(i for i, _ in ranked) <= set(rows.tolist())
+
+def test_fingerprint_round_trip(tmp_path):
+    rng = np.random.default_rng(2)
+    fvectors = rng.normal(size=(300, 32)).astype(np.float32)
+    index = IVFPQIndex.build(fvectors, m=4)
+    index.save(str(tmp_path / 'ivfpq.npz'))
+
+    loaded = IVFPQIndex.load(str(tmp_path / 'ivfpq.npz'))
+    assert loaded.fingerprint == fingerprint(fvectors)
+    assert loaded.fingerprint != fingerprint(fvectors[:-1])
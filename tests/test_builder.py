@@ -0,0 +1,124 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from types import SimpleNamespace
+
+import builder
+from ann import IVFPQIndex, fingerprint
+from database import PaintingDatabase
+
+def image_name(i):
+    return 'zaal_{}__IMG_{:04d}__01.png'.format(i % 3, i)
+
+def write_images(directory, indices, seed=0):
+    rng = np.random.default_rng(seed)
+    for i in indices:
+        img = cv2.GaussianBlur((rng.random((120, 160, 3)) * 255).astype(np.uint8), (0, 0), 1)
+        cv2.imwrite(os.path.join(directory, image_name(i)), img)
+
+class PixelNetwork():
+    # Stand-in for CustomResNet: the pixels of the 8x8 network input are the fvector.
+    def __init__(self):
+        self.model = SimpleNamespace(input_shape=(None, 8, 8, 3))
+        self.inference = SimpleNamespace(stats=lambda: {})
+
+    def preprocess_batch(self, x):
+        return x / 255
+
+    def predict(self, x, batch_size=32):
+        return x.reshape((len(x), -1)).astype(np.float32)
+
+def test_resume_discards_stale_chunks(tmp_path, monkeypatch):
+    images = tmp_path / 'images'
+    images.mkdir()
+    write_images(str(images), range(10))
+    out = str(tmp_path / 'db')
+
+    # Interrupt the build after all chunks are written.
+    def interrupt(*args):
+        raise KeyboardInterrupt()
+    with monkeypatch.context() as m:
+        m.setattr(builder, 'merge_chunks', interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            builder.build_database(str(images), out, features=50, fvector_state=False, workers=1, chunk_size=3)
+    assert len([f for f in os.listdir(out + '.build') if f.startswith('chunk_')]) == 4
+
+    # Images added and removed before the resume: the chunks cover other files.
+    write_images(str(images), [100], seed=1)
+    os.remove(os.path.join(str(images), sorted(os.listdir(str(images)))[0]))
+    db = builder.build_database(str(images), out, features=50, fvector_state=False, workers=1, chunk_size=3)
+    assert db.table['id'].tolist() == sorted(os.listdir(str(images)))
+
+def test_resume_with_other_settings(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    write_images(str(images), range(3))
+    out = str(tmp_path / 'db')
+    os.makedirs(out + '.build')
+    with open(os.path.join(out + '.build', 'config.json'), 'w') as f:
+        f.write('{"features": 10}')
+
+    with pytest.raises(ValueError):
+        builder.build_database(str(images), out, features=50, fvector_state=False, workers=1, chunk_size=3)
+
+def test_network_input_samples_pixel_centres(tmp_path):
+    # PIL NEAREST (keras load_img) samples floor((x + 0.5) * scale).
+    img = np.random.default_rng(2).integers(0, 256, (90, 130, 3)).astype(np.uint8)
+    path = str(tmp_path / 'zaal_1__IMG_0001__01.png')
+    cv2.imwrite(path, img)
+
+    record = builder.extract_features((path, 50, (40, 30)))
+    rows = ((np.arange(30) + 0.5) * 90 / 30).astype(np.int64)
+    columns = ((np.arange(40) + 0.5) * 130 / 40).astype(np.int64)
+    np.testing.assert_array_equal(record['network_input'], img[rows][:, columns][:, :, ::-1])
+
+def test_update_matches_fresh_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(builder, 'load_network', lambda *args: PixelNetwork())
+    images = tmp_path / 'images'
+    images.mkdir()
+    write_images(str(images), range(10))
+    out = str(tmp_path / 'db')
+    builder.build_database(str(images), out, features=50, workers=1, chunk_size=4)
+
+    db = PaintingDatabase.open(out, mmap_mode=None)
+    ann = IVFPQIndex.build(db.fvectors, nlist=3, m=8)
+    ann.save(os.path.join(out, 'ivfpq.npz'))
+    compressor = PaintingDatabase.compress_fvectors(out, dim=8)
+    old_codes = dict(zip(db.table['id'], zip(*ann.encode(db.fvectors))))
+
+    # One image changed, one removed and one added.
+    write_images(str(images), [2], seed=1)
+    os.remove(os.path.join(str(images), image_name(5)))
+    write_images(str(images), [10], seed=2)
+
+    changes = builder.update_database(str(images), out, neuralnet=PixelNetwork(), workers=1)
+    assert changes == {'added': [image_name(10)], 'changed': [image_name(2)], 'removed': [image_name(5)]}
+    assert sorted(os.listdir(str(tmp_path))) == ['db', 'images']
+
+    fresh = builder.build_database(str(images), str(tmp_path / 'fresh'), features=50, workers=1, chunk_size=4)
+    updated = PaintingDatabase.open(out, mmap_mode=None)
+    assert sorted(updated.table['id']) == fresh.table['id'].tolist()
+    assert updated.meta['files'] == fresh.meta['files']
+    rows = {f: i for i, f in enumerate(updated.table['id'])}
+    for i, f in enumerate(fresh.table['id']):
+        j = rows[f]
+        np.testing.assert_array_equal(updated.image_descriptors(j), fresh.image_descriptors(i))
+        np.testing.assert_array_equal(updated.keypoints[updated.offsets[j]:updated.offsets[j + 1]], fresh.keypoints[fresh.offsets[i]:fresh.offsets[i + 1]])
+        np.testing.assert_array_equal(updated.fvectors[j], fresh.fvectors[i])
+
+    # The index and the PCA codes follow the rows with the quantizers that were trained.
+    updated_ann = IVFPQIndex.load(os.path.join(out, 'ivfpq.npz'))
+    assert updated_ann.fingerprint == fingerprint(updated.fvectors)
+    np.testing.assert_array_equal(updated_ann.coarse_centroids, ann.coarse_centroids)
+    lists = np.repeat(np.arange(updated_ann.nlist), np.diff(updated_ann.list_offsets))
+    new_lists, new_codes = ann.encode(updated.fvectors)
+    for l, code, row in zip(lists, updated_ann.codes, updated_ann.list_ids):
+        f = updated.table['id'][row]
+        expected = (new_lists[row], new_codes[row]) if f in changes['added'] + changes['changed'] else old_codes[f]
+        assert l == expected[0]
+        np.testing.assert_array_equal(code, expected[1])
+    assert sorted(updated_ann.list_ids.tolist()) == list(range(len(updated)))
+
+    _, codes = PaintingDatabase.open_compressed(out)
+    np.testing.assert_array_equal(codes, compressor.encode(updated.fvectors))
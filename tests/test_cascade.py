@@ -0,0 +1,20 @@
+from cascade import Cascade
+
+def test_decisive_gap_reranks_min_candidates():
+    cascade = Cascade(min_rerank=5, max_rerank=60, gap_ratio=0.3)
+    ranking = [(0, 1.0), (1, 3.0)] + [(i, 3.1) for i in range(2, 100)]
+    assert cascade.rerank_size(ranking) == 5
+    assert cascade.stats()['decisive'] == 1
+
+def test_rerank_size():
+    cascade = Cascade(min_rerank=5, max_rerank=60, rerank_ratio=1.25)
+    assert cascade.rerank_size([]) == 0
+    assert cascade.rerank_size([(i, 1.0 + 0.01 * i) for i in range(100)]) == 26
+    assert cascade.rerank_size([(0, 1.0), (1, 1.1), (2, 2.0)]) == 3
+
+def test_early_stop():
+    cascade = Cascade(stop_score=350, patience=5)
+    assert not cascade.stop(300, 4, 10)
+    assert not cascade.stop(400, 10, 10)
+    assert not cascade.stop(300, 5, 0)
+    assert cascade.stop(300, 5, 10)
@@ -0,0 +1,54 @@
+import json
+import numpy as np
+import pandas as pd
+
+from database import PaintingDatabase, TABLE_COLUMNS
+
+def random_records(rng, count=6, dim=16):
+    records = []
+    for i in range(count):
+        # Image 2 has no descriptors.
+        n = 0 if i == 2 else int(rng.integers(1, 30))
+        records.append({
+            'id': 'zaal_{}__IMG_{:04d}__01.png'.format(i % 3, i),
+            'room': 'zaal_{}'.format(i % 3),
+            'photo': '{:04d}'.format(i),
+            'painting_number': 1,
+            'keypoints': rng.random((n, 7)).astype(np.float32),
+            'descriptors': rng.integers(0, 256, (n, 32), dtype=np.uint8),
+            'fvector': rng.random(dim).astype(np.float32).tolist(),
+        })
+    return records
+
+def test_save_open_round_trip(tmp_path):
+    records = random_records(np.random.default_rng(0))
+    db = PaintingDatabase.from_records(records, meta={'features': 100})
+    db.save(str(tmp_path / 'db'))
+
+    opened = PaintingDatabase.open(str(tmp_path / 'db'))
+    assert PaintingDatabase.is_database(str(tmp_path / 'db'))
+    assert len(opened) == len(records)
+    assert opened.meta['features'] == 100
+    pd.testing.assert_frame_equal(opened.table, db.table)
+    for i, r in enumerate(records):
+        np.testing.assert_array_equal(opened.image_descriptors(i), r['descriptors'])
+        np.testing.assert_array_equal(opened.keypoints[opened.offsets[i]:opened.offsets[i + 1]], r['keypoints'])
+        np.testing.assert_array_equal(opened.fvectors[i], np.float32(r['fvector']))
+
+def test_from_csv_matches_records(tmp_path):
+    records = random_records(np.random.default_rng(1))
+    rows = []
+    for r in records:
+        # Legacy CSV: keypoints as ((x, y), size, angle, response, octave, class_id).
+        keypoints = [[[float(p[0]), float(p[1])]] + [float(v) for v in p[2:]] for p in r['keypoints']]
+        rows.append(dict({c: r[c] for c in TABLE_COLUMNS}, keypoints=json.dumps(keypoints),
+            descriptors=json.dumps(r['descriptors'].tolist()), fvector=json.dumps(r['fvector'])))
+    pd.DataFrame(rows).to_csv(tmp_path / 'keypoints.csv', index=False)
+
+    converted = PaintingDatabase.from_csv(str(tmp_path / 'keypoints.csv'))
+    db = PaintingDatabase.from_records(records)
+    np.testing.assert_array_equal(converted.descriptors, db.descriptors)
+    np.testing.assert_array_equal(converted.keypoints, db.keypoints)
+    np.testing.assert_array_equal(converted.offsets, db.offsets)
+    np.testing.assert_array_equal(converted.fvectors, db.fvectors)
+    assert converted.table['id'].tolist() == db.table['id'].tolist()
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from distances import Distance, FvectorEngine, top_k
+
+def reference(queries, fvectors, metric, p=2):
+    # Direct float64 definitions of the scipy.spatial.distance metrics.
+    u = np.asarray(queries, dtype=np.float64)[:, None, :]
+    v = np.asarray(fvectors, dtype=np.float64)[None, :, :]
+    if metric == Distance.EUCLIDEAN:
+        return np.sqrt(((u - v) ** 2).sum(axis=2))
+    if metric == Distance.CITYBLOCK:
+        return np.abs(u - v).sum(axis=2)
+    if metric == Distance.MINOWSKI:
+        return (np.abs(u - v) ** p).sum(axis=2) ** (1 / p)
+    if metric == Distance.CHEBYSHEV:
+        return np.abs(u - v).max(axis=2)
+    if metric == Distance.COSINE:
+        return 1 - (u * v).sum(axis=2) / (np.linalg.norm(u, axis=2) * np.linalg.norm(v, axis=2))
+    nonzero_u, nonzero_v = u != 0, v != 0
+    union = (nonzero_u | nonzero_v).sum(axis=2)
+    unequal = (nonzero_u != nonzero_v).sum(axis=2)
+    return np.where(union == 0, 0, unequal / np.maximum(union, 1))
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    # Sparse, non-negative vectors like the ReLU outputs of the network.
+    fvectors = (np.maximum(rng.normal(size=(300, 64)), 0) * 3).astype(np.float32)
+    queries = (np.maximum(rng.normal(size=(4, 64)), 0) * 3).astype(np.float32)
+    return queries, fvectors
+
+@pytest.mark.parametrize('metric', list(Distance))
+def test_distances_match_reference(data, metric):
+    queries, fvectors = data
+    engine = FvectorEngine(fvectors, p=3 if metric == Distance.MINOWSKI else 2)
+    expected = reference(queries, fvectors, metric, p=engine.p)
+    np.testing.assert_allclose(engine.distances(queries, metric), expected, rtol=1e-5, atol=1e-5)
+
+def test_distances_match_scipy(data):
+    distance = pytest.importorskip('scipy.spatial.distance')
+    queries, fvectors = data
+    engine = FvectorEngine(fvectors)
+    for metric, name in [(Distance.EUCLIDEAN, 'euclidean'), (Distance.CITYBLOCK, 'cityblock'), (Distance.CHEBYSHEV, 'chebyshev'),
+                         (Distance.COSINE, 'cosine'), (Distance.JACCARD, 'jaccard')]:
+        np.testing.assert_allclose(engine.distances(queries, metric), distance.cdist(queries, fvectors, name), rtol=1e-5, atol=1e-5)
+
+def test_euclidean_near_duplicate():
+    # The expansion |q|^2 + |d|^2 - 2 q.d cancels for near duplicates.
+    rng = np.random.default_rng(1)
+    fvectors = (np.maximum(rng.normal(size=(50, 4096)), 0) * 3).astype(np.float32)
+    queries = fvectors[:3] + rng.normal(scale=1e-3, size=(3, 4096)).astype(np.float32)
+
+    distances = FvectorEngine(fvectors).distances(queries)
+    expected = reference(queries, fvectors, Distance.EUCLIDEAN)
+    np.testing.assert_allclose(distances, expected, rtol=1e-5)
+    assert (np.diag(distances[:, :3]) > 0).all()
+
+def test_match_ranking(data):
+    queries, fvectors = data
+    engine = FvectorEngine(fvectors)
+    expected = reference(queries, fvectors, Distance.CITYBLOCK)
+    for k in [None, 1, 10]:
+        for q, ranked in enumerate(engine.match(queries, Distance.CITYBLOCK, k)):
+            order = np.argsort(expected[q], kind='stable')[:k]
+            assert [i for i, _ in ranked] == order.tolist()
+
+def test_top_k_ties():
+    distances = np.array([[3, 1, 1, 2, 1, 0]], dtype=np.float32)
+    assert top_k(distances, 3).tolist() == [[5, 1, 2]]
+    assert top_k(distances).tolist() == [np.argsort(distances[0], kind='stable').tolist()]
@@ -0,0 +1,28 @@
+import numpy as np
+
+from graph import Graph
+from util import GRAPH_PATH
+
+def test_load_save_round_trip(tmp_path):
+    graph = Graph.load(GRAPH_PATH)
+    graph.save(str(tmp_path / 'graph.txt'))
+    loaded = Graph.load(str(tmp_path / 'graph.txt'))
+
+    assert loaded.getVertices() == graph.getVertices()
+    np.testing.assert_array_equal(loaded.getConnectivityMatrix(), graph.getConnectivityMatrix())
+
+def test_csr_and_matrices():
+    graph = Graph(['a', 'b', 'c', 'd'], [('a', 'b'), ('b', 'c'), ('a', 'b')])
+    indptr, indices = graph.csr
+    assert indptr.tolist() == [0, 1, 3, 4, 4]
+    assert indices.tolist() == [1, 0, 2, 1]
+    assert graph.indexOf('c') == 2
+
+    connectivity = graph.getConnectivityMatrix()
+    np.testing.assert_array_equal(connectivity, connectivity.T)
+    assert connectivity.sum() == 4
+    np.testing.assert_array_equal(graph.getDistanceMatrix()[0], [0, 1, 2, -1])
+
+    # Changes invalidate the cached arrays.
+    graph.addEdges([('c', 'd')])
+    assert graph.getDistanceMatrix()[0].tolist() == [0, 1, 2, 3]
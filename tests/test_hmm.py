@@ -0,0 +1,169 @@
+import numpy as np
+import pytest
+
+from hmm import HMM, createDistanceMatrix, createLinearDistributionMatrix, getGaussianDistribution
+from transitions import SparseTransitions, shortestPaths
+from util import GRAPH_PATH
+from graph import Graph
+
+@pytest.fixture(scope='module')
+def graph():
+    return Graph.load(GRAPH_PATH)
+
+def observations(rooms, T=30, seed=0):
+    # Room odds of a random walk, some frames without any match.
+    rng = np.random.default_rng(seed)
+    odds = rng.random((T, rooms)) * (rng.random((T, rooms)) < 0.2)
+    odds[rng.random(T) < 0.2] = 0
+    return odds
+
+def legacy_forward(transitions, prob_arr, prev_best, room_prob):
+    # The loop the vectorized step replaced.
+    prob_arr = list(prob_arr)
+    global_max = (0, None)
+    total_sum = 0
+    for i, p in enumerate(room_prob):
+        if (i == prev_best) & (p == 0):
+            p = 0.02
+        new_room_prob = 0
+        for j, prev_prob in enumerate(prob_arr):
+            new_room_prob += prev_prob * transitions[j][i] * p
+        prob_arr[i] = new_room_prob
+        total_sum += new_room_prob
+        if new_room_prob > global_max[0]:
+            global_max = (new_room_prob, i)
+    return np.array(prob_arr) / total_sum, global_max
+
+def test_forward_matches_legacy_loop():
+    # The legacy loop updated prob_arr in place, room i already read the new values of
+    # rooms j < i. With transitions[j, i] = 0 for j < i (lower triangular) those reads
+    # do not matter and the loop is the forward step the vectorized code computes.
+    rng = np.random.default_rng(1)
+    transitions = np.tril(rng.random((6, 6)))
+    transitions /= transitions.sum(axis=1, keepdims=True)
+    hmm = HMM(transitions, stat_distr=np.full(6, 1 / 6))
+
+    state, prev_best = hmm.prob_arr.copy(), None
+    for room_prob in observations(6, T=10, seed=2):
+        if not room_prob.any():
+            continue
+        expected_state, (expected_value, expected_best) = legacy_forward(transitions, state, prev_best, room_prob)
+        value, best = hmm.getOptimalPrediction(room_prob)
+        assert best == expected_best
+        assert value == pytest.approx(expected_value)
+        np.testing.assert_allclose(hmm.prob_arr, expected_state)
+        state, prev_best = hmm.prob_arr.copy(), best
+
+def test_log_space_forward(graph):
+    hmm = HMM.build(graph.csr, 'gaussian', cache_dir=None)
+    odds = observations(len(graph.vertices))
+    probabilities, best = hmm.forward_sequence(odds)
+    log_probabilities, log_best = hmm.forward_sequence(odds, log_space=True)
+    np.testing.assert_allclose(log_probabilities, probabilities, atol=1e-12)
+    np.testing.assert_array_equal(log_best, best)
+
+def brute_force(hmm, emissions):
+    # Probability of every room path of a short sequence.
+    rooms = len(hmm.stat_distr)
+    paths = np.array(np.meshgrid(*[np.arange(rooms)] * len(emissions), indexing='ij')).reshape(len(emissions), -1).T
+    probabilities = hmm.stat_distr[paths[:, 0]] * emissions[0, paths[:, 0]]
+    for t in range(1, len(emissions)):
+        probabilities = probabilities * hmm.transitions[paths[:, t - 1], paths[:, t]] * emissions[t, paths[:, t]]
+    return paths, probabilities
+
+def test_forward_backward_and_viterbi_brute_force():
+    rng = np.random.default_rng(3)
+    transitions = rng.random((4, 4))
+    transitions /= transitions.sum(axis=1, keepdims=True)
+    hmm = HMM(transitions)
+    odds = observations(4, T=5, seed=4)
+    paths, probabilities = brute_force(hmm, hmm.emissions(odds))
+
+    posteriors = hmm.forward_backward(odds)
+    for t in range(len(odds)):
+        expected = np.bincount(paths[:, t], weights=probabilities, minlength=4) / probabilities.sum()
+        np.testing.assert_allclose(posteriors[t], expected, atol=1e-12)
+
+    path, log_prob = hmm.viterbi(odds)
+    np.testing.assert_array_equal(path, paths[np.argmax(probabilities)])
+    assert log_prob == pytest.approx(np.log(probabilities.max()))
+
+def floyd_warshall(connectivity):
+    # Reference hop distances, -1 for unreachable rooms.
+    n = len(connectivity)
+    dist = np.where(np.asarray(connectivity) > 0, 1.0, np.inf)
+    np.fill_diagonal(dist, 0)
+    for k in range(n):
+        dist = np.minimum(dist, dist[:, k:k + 1] + dist[k:k + 1, :])
+    return np.where(np.isinf(dist), -1, dist).astype(np.int64)
+
+def test_shortest_paths(graph):
+    rng = np.random.default_rng(5)
+    # The museum graph and a random graph with unreachable rooms.
+    random = np.triu(rng.random((30, 30)) < 0.05, 1)
+    for connectivity in [graph.getConnectivityMatrix(), (random | random.T).astype(np.float64)]:
+        expected = floyd_warshall(connectivity)
+        np.testing.assert_array_equal(shortestPaths(connectivity), expected)
+        np.testing.assert_array_equal(shortestPaths(connectivity, max_dist=2), np.where(expected > 2, -1, expected))
+
+@pytest.mark.parametrize('distribution', ['linear', 'gaussian'])
+def test_build_transitions(graph, distribution, tmp_path):
+    connectivity = graph.getConnectivityMatrix()
+    dm = createDistanceMatrix(connectivity)
+    if distribution == 'linear':
+        expected = createLinearDistributionMatrix(dm)
+    else:
+        # Legacy definition: every distance below max_dist has a gaussian weight.
+        weights = np.array(getGaussianDistribution(0, 1, 11))[dm.astype(np.int64)]
+        expected = weights / weights.sum(axis=1, keepdims=True)
+
+    hmm = HMM.build(graph.csr, distribution, cache_dir=str(tmp_path))
+    np.testing.assert_allclose(hmm.transitions, expected, rtol=1e-12)
+    np.testing.assert_allclose(hmm.stat_distr @ hmm.transitions, hmm.stat_distr, atol=1e-12)
+
+    # The second build comes from the cache.
+    cached = HMM.build(graph.csr, distribution, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    np.testing.assert_array_equal(cached.transitions, hmm.transitions)
+    np.testing.assert_array_equal(cached.stat_distr, hmm.stat_distr)
+
+def test_sparse_matches_dense(graph):
+    dense = HMM.build(graph.csr, 'gaussian', cache_dir=None)
+    sparse = HMM.build(graph.csr, 'gaussian', cache_dir=None, sparse=True)
+    np.testing.assert_allclose(sparse.transitions.toarray(), dense.transitions, rtol=1e-12)
+    np.testing.assert_allclose(sparse.stat_distr, dense.stat_distr, rtol=1e-12)
+
+    odds = observations(len(graph.vertices), T=60, seed=6)
+    for log_space in [False, True]:
+        probabilities, best = sparse.forward_sequence(odds, log_space=log_space)
+        expected, expected_best = dense.forward_sequence(odds, log_space=log_space)
+        np.testing.assert_allclose(probabilities, expected, atol=1e-12)
+        np.testing.assert_array_equal(best, expected_best)
+
+    np.testing.assert_allclose(sparse.forward_backward(odds), dense.forward_backward(odds), atol=1e-12)
+    path, log_prob = sparse.viterbi(odds)
+    expected_path, expected_log_prob = dense.viterbi(odds)
+    np.testing.assert_array_equal(path, expected_path)
+    assert log_prob == pytest.approx(expected_log_prob)
+
+def test_sparse_transitions_products():
+    rng = np.random.default_rng(7)
+    matrix = rng.random((8, 8)) * (rng.random((8, 8)) < 0.4)
+    transitions = SparseTransitions.from_dense(matrix)
+    x = rng.random(8)
+    np.testing.assert_array_equal(transitions.toarray(), matrix)
+    np.testing.assert_allclose(transitions.propagate(x), x @ matrix)
+    np.testing.assert_allclose(transitions.propagate(x, rows=np.array([1, 4])), x[[1, 4]] @ matrix[[1, 4]])
+    np.testing.assert_allclose(transitions.dot(x), matrix @ x)
+
+    with np.errstate(divide='ignore'):
+        scores = np.log(x)[:, None] + np.log(matrix)
+    best, predecessors = transitions.best_predecessors(np.log(x))
+    np.testing.assert_array_equal(best, scores.max(axis=0))
+    reachable = np.isfinite(best)
+    np.testing.assert_array_equal(predecessors[reachable], np.argmax(scores, axis=0)[reachable])
+
+def test_beam_keeps_best_rooms(graph):
+    hmm = HMM.build(graph.csr, 'gaussian', cache_dir=None, sparse=True, beam=5)
+    probabilities, _ = hmm.forward_sequence(observations(len(graph.vertices), T=20, seed=8))
+    assert ((probabilities > 0).sum(axis=1) <= 5).all()
@@ -0,0 +1,26 @@
+import numpy as np
+
+from localiser import Localiser
+
+def room_odds(distance_list):
+    # calculateRoomOdds does not use the state of the localiser.
+    return Localiser.__new__(Localiser).calculateRoomOdds(distance_list)
+
+def test_room_odds_match_loop():
+    rng = np.random.default_rng(0)
+    distance_list = [rng.integers(0, 400, 12).astype(np.float32) * (rng.random(12) < 0.5) for _ in range(3)]
+    odds = room_odds(distance_list)
+
+    # The loop the vectorized code replaced.
+    total = np.zeros(12, np.float32)
+    for distances in distance_list:
+        total += distances
+    expected = [total.max() - t + 1 if t != 0 else 0 for t in total]
+    s = np.float32(0)
+    for o in expected:
+        if o != 0:
+            s += np.float32(o)
+    np.testing.assert_array_equal(odds, np.float32(expected) / s)
+
+def test_room_odds_without_matches():
+    np.testing.assert_array_equal(room_odds([np.zeros(4, np.float32)]), np.full(4, 0.25, np.float32))
@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+from orb_index import ORBIndex, cross_check_scores, hamming_matrix, hamming_pairs
+
+def random_images(rng, count=8, features=60):
+    return [rng.integers(0, 256, (features, 32), dtype=np.uint8) for _ in range(count)]
+
+def flip_bits(rng, descriptors, bits=3):
+    # Copy of the descriptors with a few random bits flipped.
+    noisy = descriptors.copy()
+    for row in noisy:
+        for p in rng.choice(256, bits, replace=False):
+            row[p // 8] ^= np.uint8(1 << (7 - p % 8))
+    return noisy
+
+def test_orb_index_finds_near_duplicate():
+    rng = np.random.default_rng(0)
+    images = random_images(rng)
+    offsets = np.concatenate([[0], np.cumsum([len(d) for d in images])])
+    index = ORBIndex(np.concatenate(images), np.repeat(np.arange(len(images)), np.diff(offsets)), len(images), key_bits=8)
+
+    for target in [0, 5]:
+        ranking = index.query(flip_bits(rng, images[target]))
+        assert ranking[0][0] == target
+
+def bf_scores(images, des_t, top=20, min_matches=20):
+    # Reference: BFMatcher cross check per image, like the loop cross_check_scores replaced.
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    scores = []
+    for desc in images:
+        matches = sorted(bf.match(desc, des_t), key=lambda m: m.distance) if len(desc) > 0 else []
+        scores.append(sum(m.distance for m in matches[:top]) if len(matches) >= min_matches else -1)
+    return np.array(scores, dtype=np.float64)
+
+def test_hamming_matrix():
+    rng = np.random.default_rng(1)
+    a = rng.integers(0, 256, (40, 32), dtype=np.uint8)
+    b = rng.integers(0, 256, (30, 32), dtype=np.uint8)
+    expected = [[hamming_pairs(a[i:i + 1], b[j:j + 1])[0] for j in range(len(b))] for i in range(len(a))]
+    np.testing.assert_array_equal(hamming_matrix(a, b), expected)
+
+def test_cross_check_scores_match_bf():
+    rng = np.random.default_rng(2)
+    images = random_images(rng)
+    images[3] = images[3][:0]
+    offsets = np.concatenate([[0], np.cumsum([len(d) for d in images])])
+    descriptors = np.concatenate(images)
+    des_t = flip_bits(rng, images[1][:50], bits=20)
+
+    np.testing.assert_array_equal(cross_check_scores(des_t, descriptors, offsets), bf_scores(images, des_t))
+    subset = [6, 1, 3]
+    np.testing.assert_array_equal(cross_check_scores(des_t, descriptors, offsets, images=subset), bf_scores([images[i] for i in subset], des_t))
+
+def test_cross_check_scores_ties():
+    # Few distinct descriptors: many equal distances, BFMatcher keeps the first on ties.
+    rng = np.random.default_rng(3)
+    palette = rng.integers(0, 256, (4, 32), dtype=np.uint8)
+    images = [palette[rng.integers(0, 4, 40)] for _ in range(5)]
+    offsets = np.concatenate([[0], np.cumsum([len(d) for d in images])])
+    des_t = palette[rng.integers(0, 4, 30)]
+
+    scores = cross_check_scores(des_t, np.concatenate(images), offsets, min_matches=1, top=5)
+    np.testing.assert_array_equal(scores, bf_scores(images, des_t, min_matches=1, top=5))
@@ -0,0 +1,81 @@
+import os
+import cv2
+import numpy as np
+import pytest
+
+from preprocessing import FrameContext, FrameProcessor, blur_detect, haar_dwt2
+from util import resize_with_aspectratio
+from blur_reference import blur_detect_windows
+
+CALIBRATION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'data', 'gopro-M.npy')
+
+def test_undistort_matches_undistort_and_crop():
+    frame_shape = (640, 360)
+    rng = np.random.default_rng(0)
+    img = cv2.GaussianBlur((rng.random(frame_shape[::-1] + (3,)) * 255).astype(np.uint8), (0, 0), 2)
+    preproc = FrameProcessor(CALIBRATION, frame_shape)
+
+    # The remap replaced cv2.undistort followed by the crop to the ROI.
+    x, y, w, h = preproc.roi
+    expected = cv2.undistort(img, preproc.mtx, preproc.dist, None, preproc.refined_mtx)[y:y + h, x:x + w]
+    np.testing.assert_array_equal(preproc.undistort(img), expected)
+
+def test_undistort_to_width():
+    frame_shape = (640, 360)
+    rng = np.random.default_rng(1)
+    img = cv2.GaussianBlur((rng.random(frame_shape[::-1] + (3,)) * 255).astype(np.uint8), (0, 0), 4)
+    full = FrameProcessor(CALIBRATION, frame_shape)
+    small = FrameProcessor(CALIBRATION, frame_shape, width=200)
+
+    undistorted = small.undistort(img)
+    assert undistorted.shape[1::-1] == small.output_shape
+    # One remap instead of undistort + resize: the same image up to interpolation.
+    expected = cv2.resize(full.undistort(img), small.output_shape, interpolation=cv2.INTER_AREA)
+    assert np.abs(undistorted.astype(np.float64) - expected).mean() < 2
+
+def test_haar_dwt2_matches_pywt():
+    pywt = pytest.importorskip('pywt')
+    x = np.random.default_rng(2).integers(0, 256, (48, 64)).astype(np.uint8)
+    LL, details = haar_dwt2(x)
+    LL_ref, details_ref = pywt.dwt2(x, 'haar')
+    np.testing.assert_array_equal(LL, LL_ref)
+    for d, d_ref in zip(details, details_ref):
+        np.testing.assert_array_equal(d, d_ref)
+
+@pytest.mark.parametrize('sigma', [0.5, 1, 2, 4])
+def test_blur_detect_matches_loops(sigma):
+    pytest.importorskip('pywt')
+    rng = np.random.default_rng(3)
+    img = cv2.GaussianBlur((rng.random((300, 400, 3)) * 255).astype(np.uint8), (0, 0), sigma)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per, blur_extent = blur_detect(img, 35)
+        per_ref, blur_extent_ref = blur_detect_windows(img, 35)
+    np.testing.assert_array_equal([per, blur_extent], [per_ref, blur_extent_ref])
+
+def test_frame_context_caches_images():
+    img = np.random.default_rng(4).integers(0, 256, (300, 400, 3)).astype(np.uint8)
+    context = FrameContext(img)
+    assert context.resized() is img and context.resized(400) is img
+    assert context.resized(200) is context.resized(200)
+    assert context.gray(200).shape == (150, 200)
+    np.testing.assert_array_equal(context.gray(200), cv2.cvtColor(context.resized(200), cv2.COLOR_BGR2GRAY))
+
+@pytest.mark.parametrize('height', [20, 30])
+def test_thin_crops_are_blurred(height):
+    # Resized to width 400 the crop has less than 16 rows, gated out like before.
+    img = np.random.default_rng(5).integers(0, 256, (height, 800, 3)).astype(np.uint8)
+    with pytest.raises(ValueError):
+        blur_detect(resize_with_aspectratio(img, width=400), 35)
+    assert FrameProcessor.sharpness_metric(img)
+
+def test_frame_context_with_detector_remap():
+    # GoPro frames: full resolution remap for the crops, the detector width remap as resized frame.
+    frame_shape = (640, 360)
+    img = np.random.default_rng(6).integers(0, 256, frame_shape[::-1] + (3,)).astype(np.uint8)
+    full = FrameProcessor(CALIBRATION, frame_shape)
+    small = FrameProcessor(CALIBRATION, frame_shape, width=200)
+    context = FrameContext(full.undistort(img), resized={200: small.undistort(img)})
+
+    assert context.image.shape[1::-1] == full.output_shape
+    assert context.resized(200).shape == resize_with_aspectratio(context.image, width=200).shape
+    np.testing.assert_array_equal(context.resized(200), small.undistort(img))
@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+import pytest
+
+from preprocessing import FrameContext, FrameProcessor
+from sharpness import HaarGate, LaplacianGate, SharpnessGate, TenengradGate
+
+def frames():
+    # Sharp scene of random rectangles and increasingly blurred copies.
+    rng = np.random.default_rng(0)
+    img = np.full((360, 640, 3), 128, np.uint8)
+    for _ in range(60):
+        x, y = int(rng.integers(0, 600)), int(rng.integers(0, 330))
+        size = rng.integers(10, 80, 2)
+        cv2.rectangle(img, (x, y), (x + int(size[0]), y + int(size[1])), tuple(int(c) for c in rng.integers(0, 256, 3)), -1)
+    return [img] + [cv2.GaussianBlur(img, (0, 0), sigma) for sigma in [1, 2, 4, 8]]
+
+def test_haar_gate_matches_sharpness_metric():
+    gate = HaarGate()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for img in frames():
+            assert gate.is_blurred(FrameContext(img)) == FrameProcessor.sharpness_metric(img)
+
+@pytest.mark.parametrize('gate', [HaarGate(), LaplacianGate(), TenengradGate()])
+def test_gates_on_blur(gate):
+    imgs = frames()
+    assert not gate.is_blurred(imgs[0])
+    assert gate.is_blurred(imgs[-1])
+
+@pytest.mark.parametrize('gate', [HaarGate(), LaplacianGate(), TenengradGate()])
+def test_empty_and_thin_crops_are_blurred(gate):
+    assert gate.is_blurred(np.zeros((0, 0, 3), np.uint8))
+    assert gate.is_blurred(np.zeros((0, 20, 3), np.uint8))
+    assert gate.is_blurred(np.zeros((1, 1000, 3), np.uint8))
+
+@pytest.mark.parametrize('height', [20, 30])
+def test_haar_gate_on_thin_crops(height):
+    # Less than 16 rows at width 400: blurred for the pywt sharpness_metric, so for the gate too.
+    img = np.random.default_rng(1).integers(0, 256, (height, 800, 3)).astype(np.uint8)
+    assert HaarGate().is_blurred(img)
+    assert HaarGate().is_blurred(img) == FrameProcessor.sharpness_metric(img)
+
+def test_gate_needs_metric():
+    with pytest.raises(TypeError):
+        SharpnessGate(1)